@@ -0,0 +1,114 @@
+"""
+Per-command resource accounting.
+
+``ResourceSampler`` periodically walks a command's process tree with psutil and
+keeps running totals, so we can tell which jobs are eating the device. The
+summary is written to the command doc as ``resources`` on completion and is
+served live by the local API.
+
+Counters that only grow for the life of a process (CPU time, I/O bytes) are
+tracked per PID and summed, so work done by short-lived children is kept after
+they exit. Gauges (RSS, thread count) record the tree-wide peak; a pipeline
+samples all of its running steps' trees together, so its peaks are for
+everything running at once.
+"""
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+import psutil
+
+
+class ResourceSampler:
+    """Accumulates CPU time, peak RSS, I/O bytes and thread count for a process tree."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cpu = {}      # pid -> (user + system) seconds, last seen
+        self._io = {}       # pid -> (read_bytes, write_bytes), last seen
+        self._roots: Dict[int, psutil.Process] = {}
+        self.started_at = time.time()
+        self.finished_at = None
+        self.samples = 0
+        self.current_rss = 0
+        self.peak_rss = 0
+        self.current_threads = 0
+        self.peak_threads = 0
+        self.current_processes = 0
+        self.peak_processes = 0
+
+    def sample(self, pid: Optional[int]):
+        """Take one snapshot of ``pid`` and all of its descendants. Never raises."""
+        if pid is not None:
+            self.sample_many([pid])
+
+    def sample_many(self, pids: Iterable[int]):
+        """Take one snapshot of several process trees, summing the gauges across them. Never raises."""
+        roots = {}
+        procs = {}
+        for pid in pids:
+            try:
+                root = self._roots.get(pid) or psutil.Process(pid)
+                for proc in [root] + root.children(recursive=True):
+                    procs[proc.pid] = proc
+                roots[pid] = root
+            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                continue
+        self._roots = roots
+        if not roots:
+            return
+
+        rss = threads = alive = 0
+        cpu = {}
+        io = {}
+        for proc in procs.values():
+            try:
+                with proc.oneshot():
+                    times = proc.cpu_times()
+                    cpu[proc.pid] = times.user + times.system
+                    rss += proc.memory_info().rss
+                    threads += proc.num_threads()
+                    try:
+                        counters = proc.io_counters()
+                        io[proc.pid] = (counters.read_bytes, counters.write_bytes)
+                    except (AttributeError, psutil.AccessDenied):
+                        pass  # Not available on macOS / restricted procfs
+                alive += 1
+            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
+                continue
+
+        with self._lock:
+            for p, value in cpu.items():
+                self._cpu[p] = max(value, self._cpu.get(p, 0.0))
+            for p, value in io.items():
+                prev = self._io.get(p, (0, 0))
+                self._io[p] = (max(value[0], prev[0]), max(value[1], prev[1]))
+            self.samples += 1
+            self.current_rss = rss
+            self.peak_rss = max(self.peak_rss, rss)
+            self.current_threads = threads
+            self.peak_threads = max(self.peak_threads, threads)
+            self.current_processes = alive
+            self.peak_processes = max(self.peak_processes, alive)
+
+    def finish(self):
+        with self._lock:
+            if self.finished_at is None:
+                self.finished_at = time.time()
+            self.current_rss = self.current_threads = self.current_processes = 0
+
+    def summary(self) -> Dict[str, float]:
+        """Compact dict suitable for a Firestore field / JSON response."""
+        with self._lock:
+            end = self.finished_at or time.time()
+            return {
+                'wall_seconds': round(end - self.started_at, 2),
+                'cpu_seconds': round(sum(self._cpu.values()), 2),
+                'peak_rss_bytes': self.peak_rss,
+                'rss_bytes': self.current_rss,
+                'read_bytes': sum(r for r, _ in self._io.values()),
+                'write_bytes': sum(w for _, w in self._io.values()),
+                'peak_threads': self.peak_threads,
+                'peak_processes': self.peak_processes,
+                'samples': self.samples,
+            }
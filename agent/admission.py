@@ -0,0 +1,126 @@
+"""
+Admission control for incoming commands.
+
+A burst of heavy commands from the console can oversubscribe a small device and
+starve the agent's own heartbeat / API threads. Commands therefore pass through
+a priority queue in front of ``CommandExecutor``:
+
+ - At most ``max_concurrent_commands`` run at once.
+ - Beyond the first running command, new ones are only admitted while system
+   CPU and memory are below ``admission_cpu_threshold`` /
+   ``admission_memory_threshold`` (percent, from psutil).
+ - Higher ``priority`` (from the command document, default 0) runs first; ties
+   run in arrival order.
+
+The queue itself is purely local state — the agent mirrors it to Firestore as
+``status: 'queued'`` plus a ``queue_position`` on each waiting command doc.
+"""
+import heapq
+import itertools
+import threading
+from typing import Dict, List, Tuple
+
+import psutil
+
+DEFAULT_MAX_CONCURRENT = 4
+DEFAULT_CPU_THRESHOLD = 90.0
+DEFAULT_MEMORY_THRESHOLD = 90.0
+
+
+class CommandAdmission:
+    """Thread-safe priority queue plus the admission decision."""
+
+    def __init__(self, config: dict):
+        self._lock = threading.Lock()
+        self._heap = []
+        self._queued: Dict[str, dict] = {}
+        self._seq = itertools.count()
+        self.max_concurrent_commands = int(config.get('max_concurrent_commands', DEFAULT_MAX_CONCURRENT))
+        self.admission_cpu_threshold = float(config.get('admission_cpu_threshold', DEFAULT_CPU_THRESHOLD))
+        self.admission_memory_threshold = float(config.get('admission_memory_threshold', DEFAULT_MEMORY_THRESHOLD))
+        # Prime psutil's system-wide CPU counter so the first reading is meaningful.
+        try:
+            psutil.cpu_percent(interval=None)
+        except Exception:
+            pass
+
+    def configure(self, **settings):
+        with self._lock:
+            if settings.get('max_concurrent_commands') is not None:
+                self.max_concurrent_commands = max(1, int(settings['max_concurrent_commands']))
+            if settings.get('admission_cpu_threshold') is not None:
+                self.admission_cpu_threshold = float(settings['admission_cpu_threshold'])
+            if settings.get('admission_memory_threshold') is not None:
+                self.admission_memory_threshold = float(settings['admission_memory_threshold'])
+
+    def __contains__(self, cmd_id: str) -> bool:
+        with self._lock:
+            return cmd_id in self._queued
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._queued)
+
+    def push(self, cmd_id: str, cmd_data: dict):
+        try:
+            priority = int(cmd_data.get('priority') or 0)
+        except (TypeError, ValueError):
+            priority = 0
+        with self._lock:
+            if cmd_id in self._queued:
+                return
+            self._queued[cmd_id] = cmd_data
+            heapq.heappush(self._heap, (-priority, next(self._seq), cmd_id))
+
+    def remove(self, cmd_id: str) -> bool:
+        """Drop a queued command (e.g. cancelled before it ran)."""
+        with self._lock:
+            return self._queued.pop(cmd_id, None) is not None
+
+    def positions(self) -> Dict[str, int]:
+        """1-based queue position for every waiting command."""
+        with self._lock:
+            ordered = sorted(entry for entry in self._heap if entry[2] in self._queued)
+        return {cmd_id: i + 1 for i, (_, _, cmd_id) in enumerate(ordered)}
+
+    def system_overloaded(self) -> bool:
+        try:
+            cpu = psutil.cpu_percent(interval=None)
+            memory = psutil.virtual_memory().percent
+        except Exception:
+            return False
+        return cpu >= self.admission_cpu_threshold or memory >= self.admission_memory_threshold
+
+    def should_admit(self, running: int) -> Tuple[bool, str]:
+        """Decide whether one more command may start. Returns (admit, reason)."""
+        if running >= self.max_concurrent_commands:
+            return False, 'concurrency'
+        # Always let at least one command run, otherwise a device that is busy
+        # for unrelated reasons would never make progress on its queue.
+        if running > 0 and self.system_overloaded():
+            return False, 'load'
+        return True, ''
+
+    def admit(self, running: int) -> Tuple[List[Tuple[str, dict]], str]:
+        """Pop as many queued commands as may start now.
+
+        Returns the admitted ``(cmd_id, cmd_data)`` pairs in priority order and,
+        if the queue is still non-empty, why it stopped ('concurrency' / 'load').
+        """
+        admitted = []
+        while True:
+            with self._lock:
+                while self._heap and self._heap[0][2] not in self._queued:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    return admitted, ''
+            ok, reason = self.should_admit(running + len(admitted))
+            if not ok:
+                return admitted, reason
+            with self._lock:
+                if not self._heap:
+                    return admitted, ''
+                _, _, cmd_id = heapq.heappop(self._heap)
+                cmd_data = self._queued.pop(cmd_id, None)
+            if cmd_data is not None:
+                admitted.append((cmd_id, cmd_data))
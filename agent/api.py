@@ -1,18 +1,40 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from typing import List, Optional
+import asyncio
+import base64
+import codecs
+import json
 import psutil
 import platform
+import re
+import signal
 import subprocess
 import os
 import socket
 import time
 import threading
+try:
+    from procgroup import popen_group_kwargs, terminate_process_tree
+    import files as file_utils
+    import search as search_utils
+    import processes as process_utils
+    import sessions as session_utils
+except ImportError:
+    from agent.procgroup import popen_group_kwargs, terminate_process_tree
+    from agent import files as file_utils
+    from agent import search as search_utils
+    from agent import processes as process_utils
+    from agent import sessions as session_utils
 
 # Command registry - will be set by main.py after initialization
 # This avoids circular import issues
 active_commands_registry = {}
+# Background SearchIndexer owned by the agent (None until main.py sets it)
+search_indexer = None
 
 # Cache for outbound IP address: probing the network on every /status call adds
 # multi-second latency on a slow / down hotspot. Refresh at most every 5 min.
@@ -20,6 +42,21 @@ _IP_CACHE_TTL = 300.0
 _ip_cache: dict = {"ip": None, "ts": 0.0}
 _ip_lock = threading.Lock()
 
+# /exec bounds: every call has a timeout (so a hung command can't pin a worker
+# forever) and a per-stream output cap (so a chatty one can't exhaust memory).
+EXEC_DEFAULT_TIMEOUT = 30.0
+EXEC_MAX_TIMEOUT = 3600.0
+EXEC_DEFAULT_MAX_OUTPUT = 1024 * 1024
+EXEC_READ_CHUNK = 64 * 1024
+
+# Sampled in the background while /processes is being polled.
+process_table = process_utils.ProcessTable()
+
+# Resumable upload state lives beside the agent so sessions survive restarts.
+upload_sessions = file_utils.UploadSessions(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.uploads')
+)
+
 app = FastAPI(
     title="DontPortForward Agent API",
     description="Local API for the DontPortForward agent - provides system status, command execution, and file management",
@@ -38,13 +75,26 @@ app.add_middleware(
 class CommandRequest(BaseModel):
     command: str
     cwd: Optional[str] = None
+    timeout: float = Field(EXEC_DEFAULT_TIMEOUT, gt=0, le=EXEC_MAX_TIMEOUT)
+    max_output: int = Field(EXEC_DEFAULT_MAX_OUTPUT, ge=0, le=64 * 1024 * 1024)
+    stream: bool = False
 
 class FileReadRequest(BaseModel):
     path: str
+    offset: int = Field(0, ge=0)
+    length: Optional[int] = Field(None, ge=0, description="Bytes to read (capped at 4 MiB per call)")
+    tail_lines: Optional[int] = Field(None, ge=1, le=100000, description="Return the last N lines instead of a byte range")
+    encoding: str = Field("text", pattern="^(text|base64)$")
 
 class FileWriteRequest(BaseModel):
     path: str
     content: str
+    fsync: bool = True
+
+class UploadSessionRequest(BaseModel):
+    path: str
+    size: Optional[int] = Field(None, ge=0)
+    sha256: Optional[str] = None
 
 def _probe_ip_address() -> str:
     """Probe the primary outbound IP via a UDP socket to 8.8.8.8.
@@ -141,100 +191,544 @@ def get_status():
 def health():
     return {"status": "ok"}
 
+async def _start_exec_process(request: CommandRequest):
+    return await asyncio.create_subprocess_shell(
+        request.command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        cwd=request.cwd or os.getcwd(),
+        **popen_group_kwargs()
+    )
+
+
+async def _kill_exec_process(proc):
+    """Kill the command's whole process group and reap it.
+
+    The group is signalled even once the shell itself has exited, since
+    background jobs it started are still in it.
+    """
+    try:
+        if os.name == 'posix':
+            os.killpg(proc.pid, signal.SIGKILL)
+        elif proc.returncode is None:
+            proc.kill()
+    except (ProcessLookupError, OSError):
+        pass
+    if proc.returncode is not None:
+        return
+    try:
+        await asyncio.wait_for(proc.wait(), timeout=5)
+    except asyncio.TimeoutError:
+        pass
+
+
+async def _read_capped(stream, limit: int, out: dict, key: str):
+    """Read ``stream`` to EOF, appending at most ``limit`` bytes to ``out[key]``.
+
+    Appends in place so partial output survives a timeout cancelling the read.
+    """
+    buf = out[key]
+    while True:
+        chunk = await stream.read(EXEC_READ_CHUNK)
+        if not chunk:
+            break
+        room = limit - len(buf)
+        if room > 0:
+            buf.extend(chunk[:room])
+        if len(chunk) > room:
+            out["truncated"] = True
+
+
+def _exec_blocking(request: CommandRequest) -> dict:
+    """Thread-pool fallback for event loops without subprocess support
+    (e.g. a selector loop on Windows)."""
+    started = time.time()
+    proc = subprocess.Popen(
+        request.command,
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=request.cwd or os.getcwd(),
+        **popen_group_kwargs()
+    )
+    timed_out = False
+    try:
+        stdout, stderr = proc.communicate(timeout=request.timeout)
+    except subprocess.TimeoutExpired:
+        timed_out = True
+        terminate_process_tree(proc, grace=0)
+        stdout, stderr = proc.communicate()
+    truncated = len(stdout) > request.max_output or len(stderr) > request.max_output
+    return {
+        "stdout": stdout[:request.max_output].decode("utf-8", errors="replace"),
+        "stderr": stderr[:request.max_output].decode("utf-8", errors="replace"),
+        "returncode": proc.returncode,
+        "timed_out": timed_out,
+        "truncated": truncated,
+        "duration": round(time.time() - started, 3),
+    }
+
+
+async def _stream_exec(proc, request: CommandRequest):
+    """NDJSON stream: one ``{"stream", "data"}`` line per chunk, then a final summary line."""
+    started = time.time()
+    queue: asyncio.Queue = asyncio.Queue()
+    sent = {"stdout": 0, "stderr": 0}
+    # One decoder per stream, so a character split across chunks survives.
+    decoders = {name: codecs.getincrementaldecoder("utf-8")(errors="replace") for name in sent}
+    truncated = False
+    timed_out = False
+
+    async def pump(stream, name):
+        while True:
+            chunk = await stream.read(EXEC_READ_CHUNK)
+            if not chunk:
+                break
+            await queue.put((name, chunk))
+        await queue.put((name, None))
+
+    pumps = [
+        asyncio.create_task(pump(proc.stdout, "stdout")),
+        asyncio.create_task(pump(proc.stderr, "stderr")),
+    ]
+    deadline = started + request.timeout
+    try:
+        open_streams = 2
+        while open_streams:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                timed_out = True
+                break
+            try:
+                name, chunk = await asyncio.wait_for(queue.get(), timeout=remaining)
+            except asyncio.TimeoutError:
+                timed_out = True
+                break
+            if chunk is None:
+                open_streams -= 1
+                data = decoders[name].decode(b"", final=True)
+                if data:
+                    yield json.dumps({"stream": name, "data": data}) + "\n"
+                continue
+            room = request.max_output - sent[name]
+            if len(chunk) > room:
+                truncated = True
+                chunk = chunk[:max(room, 0)]
+            if chunk:
+                sent[name] += len(chunk)
+                data = decoders[name].decode(chunk)
+                if data:
+                    yield json.dumps({"stream": name, "data": data}) + "\n"
+        if not timed_out:
+            # A background job can close its pipes while the shell runs on.
+            try:
+                await asyncio.wait_for(proc.wait(), timeout=max(deadline - time.time(), 0))
+            except asyncio.TimeoutError:
+                timed_out = True
+        if timed_out:
+            await _kill_exec_process(proc)
+        yield json.dumps({
+            "returncode": proc.returncode,
+            "timed_out": timed_out,
+            "truncated": truncated,
+            "duration": round(time.time() - started, 3),
+        }) + "\n"
+    finally:
+        # Also runs when the client disconnects mid-stream.
+        await _kill_exec_process(proc)
+        for task in pumps:
+            task.cancel()
+
+
 @app.post("/exec")
-def execute_command(request: CommandRequest):
+async def execute_command(request: CommandRequest):
+    """
+    Run a shell command with a bounded timeout and per-stream output cap.
+
+    Runs as an async subprocess so slow commands don't hold a threadpool
+    worker. With ``stream: true`` the response is NDJSON, streamed as output
+    arrives; otherwise stdout / stderr are returned in one JSON body.
+    """
+    try:
+        proc = await _start_exec_process(request)
+    except NotImplementedError:
+        if request.stream:
+            raise HTTPException(status_code=501, detail="Streaming exec is not supported on this event loop")
+        return await run_in_threadpool(_exec_blocking, request)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+    if request.stream:
+        return StreamingResponse(_stream_exec(proc, request), media_type="application/x-ndjson")
+
+    started = time.time()
+    out = {"stdout": bytearray(), "stderr": bytearray(), "truncated": False}
+    timed_out = False
     try:
-        result = subprocess.run(
-            request.command,
-            shell=True,
-            capture_output=True,
-            text=True,
-            cwd=request.cwd or os.getcwd()
+        await asyncio.wait_for(
+            asyncio.gather(
+                _read_capped(proc.stdout, request.max_output, out, "stdout"),
+                _read_capped(proc.stderr, request.max_output, out, "stderr"),
+                proc.wait(),
+            ),
+            timeout=request.timeout,
         )
-        return {
-            "stdout": result.stdout,
-            "stderr": result.stderr,
-            "returncode": result.returncode
-        }
+    except asyncio.TimeoutError:
+        timed_out = True
     except Exception as e:
+        await _kill_exec_process(proc)
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        await _kill_exec_process(proc)
+
+    return {
+        "stdout": out["stdout"].decode("utf-8", errors="replace"),
+        "stderr": out["stderr"].decode("utf-8", errors="replace"),
+        "returncode": proc.returncode,
+        "timed_out": timed_out,
+        "truncated": out["truncated"],
+        "duration": round(time.time() - started, 3),
+    }
 
 @app.get("/files/list")
-def list_files(path: str = "."):
+def list_files(
+    path: str = ".",
+    cursor: Optional[str] = None,
+    limit: int = Query(500, ge=1, le=5000),
+    sort: str = Query("name", pattern="^(name|size|mtime)$"),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    glob: Optional[str] = Query(None, description="Filename pattern, e.g. *.log"),
+    type: str = Query("any", pattern="^(any|file|dir)$"),
+    min_size: Optional[int] = Query(None, ge=0),
+    modified_since: Optional[float] = Query(None, description="Unix timestamp"),
+    recursive: bool = False,
+    max_depth: int = Query(file_utils.MAX_LIST_DEPTH, ge=1, le=file_utils.MAX_LIST_DEPTH),
+):
+    """
+    List a directory one page at a time, sorted and filtered server-side.
+
+    Pass the returned ``next_cursor`` back as ``cursor`` for the next page. With
+    ``recursive=true`` names are relative paths, down to ``max_depth`` levels.
+    """
     try:
         abs_path = os.path.abspath(path)
         if not os.path.exists(abs_path):
             raise HTTPException(status_code=404, detail="Path not found")
-        
-        files = []
-        for item in os.listdir(abs_path):
-            item_path = os.path.join(abs_path, item)
-            try:
-                stat = os.stat(item_path)
-                files.append({
-                    "name": item,
-                    "is_dir": os.path.isdir(item_path),
-                    "size": stat.st_size,
-                    "mtime": stat.st_mtime
-                })
-            except OSError:
-                continue
-        return {"files": files, "path": abs_path}
+        if not os.path.isdir(abs_path):
+            raise HTTPException(status_code=400, detail="Not a directory")
+        return file_utils.list_directory(
+            abs_path, cursor=cursor, limit=limit, sort=sort, order=order, glob=glob,
+            kind=type, min_size=min_size, modified_since=modified_since,
+            recursive=recursive, max_depth=max_depth,
+        )
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def _notify_file_changed(path: str):
+    """Tell the search index about a file this API just wrote."""
+    if search_indexer is not None:
+        search_indexer.notify(path)
+
+def _resolve_file(path: str) -> str:
+    abs_path = os.path.abspath(path)
+    if not os.path.exists(abs_path):
+        raise HTTPException(status_code=404, detail="File not found")
+    if not os.path.isfile(abs_path):
+        raise HTTPException(status_code=400, detail="Not a file")
+    return abs_path
+
 @app.post("/files/read")
 def read_file(request: FileReadRequest):
+    """
+    Read part of a file with bounded memory.
+
+    Returns up to ``length`` bytes from ``offset`` (at most 4 MiB per call; page
+    with ``next_offset``), or the last ``tail_lines`` lines. ``encoding: base64``
+    returns the bytes untouched for binary files.
+    """
     try:
-        abs_path = os.path.abspath(request.path)
-        if not os.path.exists(abs_path):
-            raise HTTPException(status_code=404, detail="File not found")
-        if not os.path.isfile(abs_path):
-             raise HTTPException(status_code=400, detail="Not a file")
-             
-        with open(abs_path, 'r', encoding='utf-8', errors='replace') as f:
-            content = f.read()
-        return {"content": content, "path": abs_path}
+        abs_path = _resolve_file(request.path)
+        if request.tail_lines:
+            data, offset, size = file_utils.read_tail(abs_path, request.tail_lines)
+        else:
+            offset = request.offset
+            data, size = file_utils.read_range(abs_path, offset, request.length)
+
+        end = offset + len(data)
+        if request.encoding == "base64":
+            content = base64.b64encode(data).decode("ascii")
+        else:
+            content = data.decode("utf-8", errors="replace")
+        return {
+            "content": content,
+            "path": abs_path,
+            "encoding": request.encoding,
+            "size": size,
+            "offset": offset,
+            "length": len(data),
+            "next_offset": end if end < size else None,
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/files/raw")
+def read_file_raw(request: Request, path: str, gzip: bool = False):
+    """
+    Stream a file's raw bytes. Supports a single HTTP ``Range`` (206 Partial
+    Content), or ``gzip=true`` to compress on the fly (ranges are ignored then,
+    since they would refer to the compressed representation).
+    """
+    try:
+        abs_path = _resolve_file(path)
+        size = os.path.getsize(abs_path)
+        headers = {"Accept-Ranges": "bytes"}
+
+        if gzip:
+            headers["Content-Encoding"] = "gzip"
+            return StreamingResponse(
+                file_utils.iter_gzip(file_utils.iter_file(abs_path)),
+                media_type="application/octet-stream",
+                headers=headers,
+            )
+
+        try:
+            byte_range = file_utils.parse_range(request.headers.get("range"), size)
+        except ValueError:
+            raise HTTPException(status_code=416, detail="Range not satisfiable",
+                                headers={"Content-Range": f"bytes */{size}"})
+
+        if byte_range is None:
+            headers["Content-Length"] = str(size)
+            return StreamingResponse(file_utils.iter_file(abs_path), media_type="application/octet-stream",
+                                     headers=headers)
+
+        start, end = byte_range
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(file_utils.iter_file(abs_path, start, end), status_code=206,
+                                 media_type="application/octet-stream", headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/files/write")
 def write_file(request: FileWriteRequest):
+    """Write a (small) text file atomically: temp file, fsync, rename."""
     try:
         abs_path = os.path.abspath(request.path)
-        # Ensure directory exists
-        os.makedirs(os.path.dirname(abs_path), exist_ok=True)
-        
-        with open(abs_path, 'w', encoding='utf-8') as f:
-            f.write(request.content)
-        return {"status": "success", "path": abs_path}
+        writer = file_utils.AtomicWriter(abs_path, fsync=request.fsync)
+        try:
+            writer.write(request.content.encode('utf-8'))
+            result = writer.commit()
+        except Exception:
+            writer.abort()
+            raise
+        _notify_file_changed(abs_path)
+        return {"status": "success", "path": abs_path, "size": result["size"]}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/processes")
-def list_processes():
+@app.put("/files/upload")
+async def upload_file(request: Request, path: str, sha256: Optional[str] = None, fsync: bool = True):
+    """
+    Stream the raw request body to ``path``. Chunks go to a temp file that is
+    checksum-verified (if ``sha256`` is given), fsynced and renamed into place,
+    so the target is never left half-written.
+    """
+    abs_path = os.path.abspath(path)
     try:
-        current_user = None
-        try:
-            current_user = psutil.Process().username()
-        except Exception:
-            pass
+        writer = await run_in_threadpool(file_utils.AtomicWriter, abs_path, sha256, fsync)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    try:
+        async for chunk in request.stream():
+            if chunk:
+                await run_in_threadpool(writer.write, chunk)
+        result = await run_in_threadpool(writer.commit)
+    except file_utils.ChecksumMismatch as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception as e:
+        await run_in_threadpool(writer.abort)
+        raise HTTPException(status_code=500, detail=str(e))
+    _notify_file_changed(abs_path)
+    return {"status": "success", **result}
+
+@app.post("/files/uploads")
+def create_upload(request: UploadSessionRequest):
+    """Start a resumable upload. Returns an ``upload_id`` and the current ``offset`` (0)."""
+    try:
+        record = upload_sessions.create(os.path.abspath(request.path), request.size, request.sha256)
+        return _upload_status(record)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def _upload_status(record: dict) -> dict:
+    return {
+        "upload_id": record["upload_id"],
+        "path": record["path"],
+        "offset": record["offset"],
+        "size": record.get("size"),
+    }
+
+def _get_upload(upload_id: str) -> dict:
+    try:
+        return upload_sessions.get(upload_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Upload not found")
+
+@app.get("/files/uploads/{upload_id}")
+def get_upload(upload_id: str):
+    """Current offset of a resumable upload — where the next chunk must start."""
+    return _upload_status(_get_upload(upload_id))
+
+@app.put("/files/uploads/{upload_id}")
+async def append_upload(upload_id: str, request: Request, offset: int = Query(..., ge=0)):
+    """Append the raw request body at ``offset`` (must equal the upload's current offset)."""
+    _get_upload(upload_id)
+    try:
+        record, f = await run_in_threadpool(upload_sessions.open_for_append, upload_id, offset)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    try:
+        # Whatever arrives before a dropped connection is kept; the client
+        # resumes from the offset reported by GET.
+        async for chunk in request.stream():
+            if chunk:
+                await run_in_threadpool(f.write, chunk)
+    finally:
+        await run_in_threadpool(f.close)
+        upload_sessions.release(upload_id)
+    return _upload_status(_get_upload(upload_id))
+
+@app.post("/files/uploads/{upload_id}/complete")
+def complete_upload(upload_id: str, fsync: bool = True):
+    """Verify (size / sha256 if given at creation), fsync and rename the upload into place."""
+    _get_upload(upload_id)
+    try:
+        result = upload_sessions.complete(upload_id, fsync=fsync)
+    except file_utils.ChecksumMismatch as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    _notify_file_changed(result["path"])
+    return {"status": "success", **result}
+
+@app.delete("/files/uploads/{upload_id}")
+def abort_upload(upload_id: str):
+    _get_upload(upload_id)
+    upload_sessions.abort(upload_id)
+    return {"status": "success", "upload_id": upload_id}
 
-        procs = []
-        for proc in psutil.process_iter(['pid', 'name', 'username', 'status', 'cpu_percent', 'memory_percent']):
+@app.get("/files/search")
+def search_files(
+    q: str = Query(..., min_length=1),
+    regex: bool = False,
+    case_sensitive: bool = False,
+    path: Optional[str] = Query(None, description="Limit to this directory (defaults to all indexed roots)"),
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = None,
+):
+    """
+    Search file contents. Paths inside the indexed roots (the shared folder plus
+    any configured search_roots) are narrowed with the trigram index first;
+    other paths fall back to a bounded scan. Results are paged with
+    ``next_cursor``; a page may also end early when the time budget runs out.
+    """
+    try:
+        if regex:
             try:
-                # Filter by current user if available to reduce noise
-                if current_user and proc.info.get('username') != current_user:
-                    continue
-                    
-                procs.append(proc.info)
-            except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.ZombieProcess):
-                pass
-                
-        # Sort by CPU usage descending
-        procs.sort(key=lambda x: x.get('cpu_percent', 0), reverse=True)
-        
-        return {"processes": procs}
+                re.compile(q)
+            except re.error as e:
+                raise HTTPException(status_code=400, detail=f"Invalid regex: {e}")
+
+        resume = None
+        if cursor:
+            try:
+                resume = tuple(json.loads(base64.urlsafe_b64decode(cursor.encode())))
+            except Exception:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+
+        index = search_indexer.index if search_indexer is not None else None
+        if index is not None and (path is None or index.covers(path)):
+            candidates = index.candidates(q, regex, under=path)
+            indexed = True
+        elif path is not None:
+            abs_path = os.path.abspath(path)
+            if not os.path.isdir(abs_path):
+                raise HTTPException(status_code=404, detail="Path not found")
+            candidates = search_utils.unindexed_candidates(abs_path)
+            indexed = False
+        else:
+            raise HTTPException(status_code=503, detail="Search index is not available; pass a path to scan")
+
+        result = search_utils.search(q, candidates, regex=regex, case_sensitive=case_sensitive,
+                                     limit=limit, cursor=resume)
+        next_cursor = result["next_cursor"]
+        return {
+            "query": q,
+            "matches": result["matches"],
+            "candidates": len(candidates),
+            "files_scanned": result["files_scanned"],
+            "indexed": indexed,
+            "next_cursor": base64.urlsafe_b64encode(json.dumps(next_cursor).encode()).decode() if next_cursor else None,
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/processes")
+def list_processes(
+    user: Optional[str] = Query("me", description="'me' (agent's user), 'all', or a username"),
+    name: Optional[str] = Query(None, description="Substring of the name or command line"),
+    status: Optional[str] = None,
+    min_cpu: float = Query(0.0, ge=0),
+    min_memory_mb: float = Query(0.0, ge=0),
+    sort: str = Query("cpu", pattern="^(cpu|memory|pid|name|threads|started)$"),
+    order: str = Query("desc", pattern="^(asc|desc)$"),
+    limit: int = Query(100, ge=1, le=5000, description="Top-N after sorting"),
+    offset: int = Query(0, ge=0),
+    tree: bool = Query(False, description="Nest children under parents with subtree CPU / memory totals"),
+    root_pid: Optional[int] = Query(None, description="With tree=true, only this process's subtree"),
+):
+    """
+    List processes from the cached process table. CPU% is measured between
+    background samples (100% = one core) rather than read cold per request.
+    In tree mode filters pick the matching processes first and limit/offset
+    page through the top-level nodes.
+    """
+    try:
+        procs = process_table.snapshot()
+        if user == "me":
+            user = process_utils.current_username()
+        elif user == "all":
+            user = None
+        procs = process_utils.filter_processes(
+            procs, user=user, name=name, status=status,
+            min_cpu=min_cpu, min_rss_bytes=int(min_memory_mb * 1024 * 1024),
+        )
+        descending = order == "desc"
+        if tree:
+            items = process_utils.sort_tree(process_utils.build_tree(procs, root_pid), sort, descending)
+        else:
+            items = process_utils.sort_processes(procs, sort, descending)
+        page = items[offset:offset + limit]
+        return {
+            "processes": page,
+            "total": len(items),
+            "offset": offset,
+            "next_offset": offset + limit if offset + limit < len(items) else None,
+            **process_table.stats(),
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -249,11 +743,31 @@ def kill_process(pid: int):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/sessions")
+def list_sessions():
+    """Persistent shell sessions (commands with a 'session' name) and their state."""
+    return {"sessions": session_utils.manager.list()}
+
+@app.delete("/sessions/{name}")
+def close_session(name: str):
+    """End a shell session; its next command starts a fresh shell."""
+    if not session_utils.manager.close(name):
+        raise HTTPException(status_code=404, detail="Session not found")
+    return {"status": "closed", "name": name}
+
 @app.get("/commands/{cmd_id}/output")
-def get_command_output(cmd_id: str, seconds: int = Query(60, ge=1, le=3600, description="Number of seconds of output to retrieve")):
+def get_command_output(
+    cmd_id: str,
+    seconds: int = Query(60, ge=1, le=3600, description="Number of seconds of output to retrieve"),
+    since_stdout: Optional[int] = Query(None, ge=0, description="Only stdout lines after this cursor"),
+    since_stderr: Optional[int] = Query(None, ge=0, description="Only stderr lines after this cursor"),
+):
     """
     Get recent output for a command. Output is stored in memory only, not in database.
     Returns the last N seconds of output (default 60 seconds).
+
+    Passing since_stdout / since_stderr (from a previous response's cursor)
+    returns only lines produced after it, plus the new cursor.
     """
     try:
         # Try to get from registry
@@ -261,6 +775,18 @@ def get_command_output(cmd_id: str, seconds: int = Query(60, ge=1, le=3600, desc
             raise HTTPException(status_code=404, detail="Command not found or no longer available")
         
         executor = active_commands_registry[cmd_id]
+        if since_stdout is not None or since_stderr is not None:
+            delta = executor.get_output_since(
+                {"stdout": since_stdout, "stderr": since_stderr}, seconds=seconds)
+            return {
+                "cmd_id": cmd_id,
+                "output": delta["stdout"],
+                "error": delta["stderr"],
+                "cursor": delta["cursor"],
+                "gap": delta["gap"],
+                "more": delta["more"],
+                "status": "active" if executor.process and executor.process.poll() is None else "completed"
+            }
         stdout, stderr = executor.get_recent_output(seconds=seconds)
         
         return {
@@ -297,3 +823,70 @@ def get_all_command_output(cmd_id: str):
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/commands/{cmd_id}/output/search")
+def search_command_output(
+    cmd_id: str,
+    q: Optional[str] = Query(None, description="Substring (or regex with regex=true) to match"),
+    regex: bool = False,
+    case_sensitive: bool = False,
+    levels: Optional[List[str]] = Query(None, description="Log levels to keep: critical, error, warning, info, debug"),
+    stream: str = Query("both", pattern="^(stdout|stderr|both)$"),
+    context: int = Query(0, ge=0, le=20, description="Lines of context before and after each match"),
+    max_matches: int = Query(100, ge=1, le=1000),
+    last: bool = Query(False, description="Keep the last max_matches matches instead of the first"),
+):
+    """
+    Search a command's in-memory output and return only the matching lines,
+    with absolute line numbers and optional context.
+    """
+    try:
+        if cmd_id not in active_commands_registry:
+            raise HTTPException(status_code=404, detail="Command not found or no longer available")
+
+        executor = active_commands_registry[cmd_id]
+        try:
+            result = executor.search_output({
+                "pattern": q,
+                "regex": regex,
+                "case_sensitive": case_sensitive,
+                "levels": levels,
+                "stream": stream,
+                "context": context,
+                "max_matches": max_matches,
+                "last": last,
+            })
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        return {
+            "cmd_id": cmd_id,
+            **result,
+            "status": "active" if executor.process and executor.process.poll() is None else "completed"
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/commands/{cmd_id}/resources")
+def get_command_resources(cmd_id: str):
+    """
+    Get resource usage for a command's process tree: CPU time, current / peak RSS,
+    I/O bytes, peak thread and process counts, and wall time. Live while running.
+    """
+    try:
+        if cmd_id not in active_commands_registry:
+            raise HTTPException(status_code=404, detail="Command not found or no longer available")
+
+        executor = active_commands_registry[cmd_id]
+        return {
+            "cmd_id": cmd_id,
+            "resources": executor.get_resource_usage(),
+            "status": "active" if executor.process and executor.process.poll() is None else "completed"
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
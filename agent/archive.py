@@ -0,0 +1,106 @@
+"""
+Helpers for archiving old command documents to Storage.
+
+Finished commands older than the retention window are moved out of the
+``commands`` subcollection into one gzipped NDJSON bundle per UTC day
+(``agents/{device}/history/{YYYY-MM-DD}.ndjson.gz``). Each bundle has an index
+doc (``devices/{device}/history_index/{YYYY-MM-DD}``) listing the commands it
+holds, so the console can find an archived command without downloading
+bundles.
+
+Bundles are appended to by adding a new gzip member (gzip readers treat
+concatenated members as one stream), and records already in the bundle are
+skipped. So if the agent dies after an upload but before deleting the
+archived docs, the next run can redo the work safely.
+"""
+import base64
+import gzip
+import io
+import json
+from datetime import date, datetime, timezone
+from typing import Dict, Iterable, List, Tuple
+
+# Per-bundle cap on index entries; past it the index only has the counts.
+INDEX_MAX_ENTRIES = 2000
+INDEX_COMMAND_CHARS = 120
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode('ascii')
+    # GeoPoint, DocumentReference, ... — keep something readable.
+    path = getattr(value, 'path', None)
+    return path if isinstance(path, str) else str(value)
+
+
+def day_key(completed_at) -> str:
+    """UTC day a command belongs to, as ``YYYY-MM-DD``."""
+    if isinstance(completed_at, datetime):
+        if completed_at.tzinfo is None:
+            completed_at = completed_at.replace(tzinfo=timezone.utc)
+        return completed_at.astimezone(timezone.utc).strftime('%Y-%m-%d')
+    return 'undated'
+
+
+def encode_record(cmd_id: str, data: dict) -> str:
+    return json.dumps(dict(data, id=cmd_id), default=_json_default, sort_keys=True)
+
+
+def read_bundle(data: bytes) -> List[dict]:
+    """All records in a bundle (any number of gzip members); skips bad lines."""
+    if not data:
+        return []
+    records = []
+    with gzip.GzipFile(fileobj=io.BytesIO(data)) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def append_bundle(existing: bytes, records: Iterable[Tuple[str, dict]]) -> Tuple[bytes, List[dict], int]:
+    """Append ``(cmd_id, data)`` records not already in ``existing``.
+
+    Returns ``(bundle_bytes, index_entries, added)`` where ``index_entries``
+    summarises every record in the resulting bundle.
+    """
+    old = read_bundle(existing)
+    seen = {r.get('id') for r in old}
+    entries = [_index_entry(r) for r in old]
+    lines = []
+    for cmd_id, data in records:
+        if cmd_id in seen:
+            continue
+        seen.add(cmd_id)
+        line = encode_record(cmd_id, data)
+        lines.append(line)
+        entries.append(_index_entry(json.loads(line)))
+    if not lines:
+        return existing, entries, 0
+    member = gzip.compress(('\n'.join(lines) + '\n').encode('utf-8'))
+    return existing + member, entries, len(lines)
+
+
+def _index_entry(record: dict) -> Dict[str, str]:
+    return {
+        'id': record.get('id', ''),
+        'command': str(record.get('command') or '')[:INDEX_COMMAND_CHARS],
+        'status': record.get('status', ''),
+        'completed_at': record.get('completed_at') or '',
+    }
+
+
+def index_doc(day: str, path: str, entries: List[dict], size: int) -> dict:
+    entries = sorted(entries, key=lambda e: e['completed_at'])
+    return {
+        'day': day,
+        'path': path,
+        'count': len(entries),
+        'size_bytes': size,
+        'commands': entries[:INDEX_MAX_ENTRIES],
+        'commands_truncated': len(entries) > INDEX_MAX_ENTRIES,
+    }
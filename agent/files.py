@@ -0,0 +1,482 @@
+"""
+File helpers for the local API.
+
+Reads go through ``mmap`` so a ranged read or tail of a multi-GB log only
+touches the pages it needs, and raw reads are streamed in fixed-size chunks so
+memory stays bounded regardless of file size.
+
+Writes go to a temp file beside the target and are renamed into place only
+once complete (and optionally checksum-verified and fsynced), so a crash or a
+dropped connection never leaves a truncated file behind.
+"""
+import base64
+import fnmatch
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from typing import Iterator, List, Optional, Tuple
+
+READ_CHUNK = 256 * 1024
+# Upper bound on what a single JSON /files/read call returns; callers page
+# through bigger files with ``offset`` / ``next_offset``.
+MAX_READ_BYTES = 4 * 1024 * 1024
+
+
+def _map(f, size):
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+
+
+def read_range(path: str, offset: int = 0, length: Optional[int] = None) -> Tuple[bytes, int]:
+    """Return ``(data, file_size)`` for ``length`` bytes starting at ``offset``."""
+    length = MAX_READ_BYTES if length is None else min(length, MAX_READ_BYTES)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if offset >= size or length <= 0:
+            return b'', size
+        mm = _map(f, size)
+        try:
+            return mm[offset:offset + length], size
+        finally:
+            mm.close()
+
+
+def read_tail(path: str, lines: int, max_bytes: int = MAX_READ_BYTES) -> Tuple[bytes, int, int]:
+    """Return ``(data, start_offset, file_size)`` for the last ``lines`` lines.
+
+    Scans backwards for newlines in the mapped file, never returning more than
+    ``max_bytes`` (the start is clipped if the lines are that long).
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0 or lines <= 0:
+            return b'', size, size
+        mm = _map(f, size)
+        try:
+            floor = max(0, size - max_bytes)
+            end = size
+            # A trailing newline terminates the last line; it doesn't start a new one.
+            pos = size - 1 if mm[size - 1:size] == b'\n' else size
+            start = floor
+            for _ in range(lines):
+                nl = mm.rfind(b'\n', floor, pos)
+                if nl < 0:
+                    start = floor
+                    break
+                start = nl + 1
+                pos = nl
+            return mm[start:end], start, size
+        finally:
+            mm.close()
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single-range ``Range: bytes=...`` header into inclusive ``(start, end)``.
+
+    Returns None for no / unsupported header (serve the whole file). Raises
+    ValueError if the range can't be satisfied.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    spec = header[len('bytes='):].strip()
+    start_s, _, end_s = spec.partition('-')
+    if start_s == '':
+        # Suffix range: last N bytes.
+        suffix = int(end_s)
+        if suffix <= 0:
+            raise ValueError("Unsatisfiable range")
+        if size == 0:
+            return None  # Nothing to range over; serve the empty body
+        return max(0, size - suffix), size - 1
+    start = int(start_s)
+    end = int(end_s) if end_s else size - 1
+    if start >= size or end < start:
+        raise ValueError("Unsatisfiable range")
+    return start, min(end, size - 1)
+
+
+def iter_file(path: str, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+    """Yield the bytes ``start..end`` (inclusive) of ``path`` in chunks."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = None if end is None else end - start + 1
+        while remaining is None or remaining > 0:
+            chunk = f.read(READ_CHUNK if remaining is None else min(READ_CHUNK, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+
+def iter_gzip(chunks: Iterator[bytes], level: int = 6) -> Iterator[bytes]:
+    """Gzip-compress a chunk stream on the fly."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+    for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+# Directory listing limits: recursion depth and how many entries one listing
+# may scan before it stops (reported as ``truncated``).
+MAX_LIST_DEPTH = 10
+MAX_LIST_SCAN = 200000
+# Sorted listings that span several pages are cached briefly so paging through
+# a huge directory costs one scan, not one per page. The cache holds at most
+# this many entries across all listings (one maximal scan).
+LISTING_CACHE_TTL = 30.0
+LISTING_CACHE_MAX_ENTRIES = MAX_LIST_SCAN
+_listing_cache = OrderedDict()
+_listing_lock = threading.Lock()
+
+
+def _scan_tree(root: str, recursive: bool, max_depth: int, glob: Optional[str], kind: str,
+               min_size: Optional[int], modified_since: Optional[float]) -> Tuple[List[dict], bool]:
+    """Walk ``root`` with scandir, returning matching entries and whether the scan was cut short."""
+    entries = []
+    scanned = 0
+    stack = [(root, '', 0)]
+    while stack:
+        directory, prefix, depth = stack.pop()
+        try:
+            it = os.scandir(directory)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                scanned += 1
+                if scanned > MAX_LIST_SCAN:
+                    return entries, True
+                try:
+                    # d_type from readdir: no extra syscall on Linux.
+                    is_dir = entry.is_dir()
+                except OSError:
+                    continue
+                rel = prefix + entry.name
+                if recursive and is_dir and depth + 1 < max_depth and not entry.is_symlink():
+                    stack.append((entry.path, rel + '/', depth + 1))
+                if kind == 'file' and is_dir or kind == 'dir' and not is_dir:
+                    continue
+                if glob and not fnmatch.fnmatch(entry.name, glob):
+                    continue
+                try:
+                    st = entry.stat()  # cached on the entry after the first call
+                except OSError:
+                    continue
+                if min_size is not None and st.st_size < min_size:
+                    continue
+                if modified_since is not None and st.st_mtime < modified_since:
+                    continue
+                entries.append({
+                    "name": rel,
+                    "is_dir": is_dir,
+                    "size": st.st_size,
+                    "mtime": st.st_mtime,
+                })
+    return entries, False
+
+
+def _prune_listing_cache(now: float):
+    """Drop expired listings, then the oldest until the entry budget holds. Call under _listing_lock."""
+    for key in [k for k, cached in _listing_cache.items() if now - cached[0] >= LISTING_CACHE_TTL]:
+        del _listing_cache[key]
+    total = sum(len(cached[1]) for cached in _listing_cache.values())
+    while total > LISTING_CACHE_MAX_ENTRIES:
+        _, cached = _listing_cache.popitem(last=False)
+        total -= len(cached[1])
+
+
+def _encode_cursor(key: str, offset: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"k": key, "o": offset}).encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> Tuple[str, int]:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return data["k"], int(data["o"])
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def list_directory(path: str, cursor: Optional[str] = None, limit: int = 500, sort: str = 'name',
+                   order: str = 'asc', glob: Optional[str] = None, kind: str = 'any',
+                   min_size: Optional[int] = None, modified_since: Optional[float] = None,
+                   recursive: bool = False, max_depth: int = MAX_LIST_DEPTH) -> dict:
+    """One page of a filtered, sorted listing plus a ``next_cursor`` for the following page."""
+    max_depth = max(1, min(max_depth, MAX_LIST_DEPTH)) if recursive else 1
+    key = json.dumps([path, sort, order, glob, kind, min_size, modified_since, recursive, max_depth])
+    offset = 0
+    if cursor:
+        cursor_key, offset = _decode_cursor(cursor)
+        if cursor_key != key:
+            raise ValueError("Cursor does not match this listing")
+
+    # The first page always rescans so it's fresh; later pages reuse that scan
+    # while it's recent, so offsets stay consistent across the pages.
+    now = time.time()
+    cached = None
+    if cursor:
+        with _listing_lock:
+            _prune_listing_cache(now)
+            cached = _listing_cache.get(key)
+    if cached is None:
+        entries, truncated = _scan_tree(path, recursive, max_depth, glob, kind, min_size, modified_since)
+        sort_key = {
+            'name': lambda e: e["name"].lower(),
+            'size': lambda e: e["size"],
+            'mtime': lambda e: e["mtime"],
+        }.get(sort, lambda e: e["name"].lower())
+        entries.sort(key=sort_key, reverse=(order == 'desc'))
+        cached = (now, entries, truncated)
+        # Only a listing with more pages to come is worth keeping.
+        if offset + limit < len(entries):
+            with _listing_lock:
+                _listing_cache[key] = cached
+                _listing_cache.move_to_end(key)
+                _prune_listing_cache(now)
+
+    _, entries, truncated = cached
+    page = entries[offset:offset + limit]
+    end = offset + len(page)
+    return {
+        "files": page,
+        "path": path,
+        "total": len(entries),
+        "truncated": truncated,
+        "next_cursor": _encode_cursor(key, end) if end < len(entries) else None,
+    }
+
+
+class ChecksumMismatch(ValueError):
+    pass
+
+
+def _process_umask() -> int:
+    # The only way to read the umask is to set it; done once, at import.
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+# Mode for a newly created file, as open() would give it.
+_NEW_FILE_MODE = 0o666 & ~_process_umask()
+
+
+def _fsync_dir(path: str):
+    """Persist a rename by fsyncing the containing directory (POSIX only)."""
+    if os.name != 'posix':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    for chunk in iter_file(path):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def finalize_file(temp_path: str, target: str, expected_sha256: Optional[str] = None,
+                  fsync: bool = True, actual_sha256: Optional[str] = None) -> dict:
+    """Verify ``temp_path`` and atomically rename it over ``target``.
+
+    Removes the temp file and raises ChecksumMismatch if the digest doesn't match.
+    A symlink at ``target`` is written through, not replaced, so the temp file
+    must be on the same filesystem as the file it points to.
+    """
+    if expected_sha256:
+        actual_sha256 = actual_sha256 or sha256_file(temp_path)
+        if actual_sha256.lower() != expected_sha256.lower():
+            os.remove(temp_path)
+            raise ChecksumMismatch(f"sha256 mismatch: expected {expected_sha256}, got {actual_sha256}")
+    real_target = os.path.realpath(target)
+    # mkstemp creates 0600 files; keep the existing file's mode, or use the usual default.
+    try:
+        mode = os.stat(real_target).st_mode & 0o7777
+    except OSError:
+        mode = _NEW_FILE_MODE
+    os.chmod(temp_path, mode)
+    if fsync:
+        with open(temp_path, 'rb+') as f:
+            os.fsync(f.fileno())
+    os.replace(temp_path, real_target)
+    if fsync:
+        _fsync_dir(os.path.dirname(real_target))
+    result = {"path": target, "size": os.path.getsize(real_target)}
+    if actual_sha256:
+        result["sha256"] = actual_sha256
+    return result
+
+
+class AtomicWriter:
+    """Streams chunks into a temp file next to ``target``; ``commit()`` renames it into place."""
+
+    def __init__(self, target: str, expected_sha256: Optional[str] = None, fsync: bool = True):
+        self.target = target
+        self.expected_sha256 = expected_sha256
+        self.fsync = fsync
+        self.size = 0
+        self._digest = hashlib.sha256()
+        # Beside the file a symlink points to, so commit() can rename over it.
+        real_target = os.path.realpath(target)
+        directory = os.path.dirname(real_target)
+        os.makedirs(directory, exist_ok=True)
+        fd, self.temp_path = tempfile.mkstemp(prefix=f".{os.path.basename(real_target)}.", suffix=".tmp", dir=directory)
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk: bytes):
+        self._file.write(chunk)
+        self._digest.update(chunk)
+        self.size += len(chunk)
+
+    def commit(self) -> dict:
+        self._file.close()
+        return finalize_file(self.temp_path, self.target, self.expected_sha256, self.fsync,
+                             actual_sha256=self._digest.hexdigest())
+
+    def abort(self):
+        try:
+            self._file.close()
+        finally:
+            try:
+                os.remove(self.temp_path)
+            except OSError:
+                pass
+
+
+class UploadSessions:
+    """Resumable uploads that survive flaky links and agent restarts.
+
+    Each session is a ``.part`` file beside the target plus a small JSON record
+    in ``state_dir``. Clients append chunks at the offset the session reports,
+    so after a dropped connection they ask for the offset and carry on.
+    """
+
+    # Abandoned sessions are discarded after this long without a chunk.
+    EXPIRY_SECONDS = 7 * 24 * 3600
+
+    def __init__(self, state_dir: str):
+        self.state_dir = state_dir
+        self._lock = threading.Lock()
+        self._writing = set()  # upload IDs with a chunk currently being appended
+
+    def _record_path(self, upload_id: str) -> str:
+        if not upload_id or not all(c.isalnum() for c in upload_id):
+            raise KeyError(upload_id)
+        return os.path.join(self.state_dir, f"{upload_id}.json")
+
+    def _save(self, record: dict):
+        os.makedirs(self.state_dir, exist_ok=True)
+        path = self._record_path(record["upload_id"])
+        with open(path + ".tmp", 'w') as f:
+            json.dump(record, f)
+        os.replace(path + ".tmp", path)
+
+    def get(self, upload_id: str) -> dict:
+        try:
+            with open(self._record_path(upload_id)) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            raise KeyError(upload_id)
+        try:
+            record["offset"] = os.path.getsize(record["part_path"])
+        except OSError:
+            record["offset"] = 0
+        return record
+
+    def create(self, target: str, size: Optional[int] = None, sha256: Optional[str] = None) -> dict:
+        self.expire_stale()
+        upload_id = uuid.uuid4().hex
+        real_target = os.path.realpath(target)
+        directory = os.path.dirname(real_target)
+        os.makedirs(directory, exist_ok=True)
+        part_path = os.path.join(directory, f".{os.path.basename(real_target)}.{upload_id}.part")
+        open(part_path, 'wb').close()
+        record = {
+            "upload_id": upload_id,
+            "path": target,
+            "part_path": part_path,
+            "size": size,
+            "sha256": sha256,
+            "created_at": time.time(),
+            "updated_at": time.time(),
+        }
+        self._save(record)
+        record["offset"] = 0
+        return record
+
+    def open_for_append(self, upload_id: str, offset: int):
+        """Return ``(record, file)`` positioned at ``offset``; ValueError if it isn't the current end.
+
+        Call ``release(upload_id)`` once the chunk has been written.
+        """
+        with self._lock:
+            if upload_id in self._writing:
+                raise ValueError("Another chunk is already being written to this upload")
+            record = self.get(upload_id)
+            if offset != record["offset"]:
+                raise ValueError(f"Expected offset {record['offset']}, got {offset}")
+            record["updated_at"] = time.time()
+            self._save({k: v for k, v in record.items() if k != "offset"})
+            self._writing.add(upload_id)
+            return record, open(record["part_path"], 'ab')
+
+    def release(self, upload_id: str):
+        with self._lock:
+            self._writing.discard(upload_id)
+
+    def complete(self, upload_id: str, fsync: bool = True) -> dict:
+        with self._lock:
+            if upload_id in self._writing:
+                raise ValueError("A chunk is still being written to this upload")
+            record = self.get(upload_id)
+            if record.get("size") is not None and record["offset"] != record["size"]:
+                raise ValueError(f"Upload incomplete: {record['offset']} of {record['size']} bytes")
+            try:
+                result = finalize_file(record["part_path"], record["path"], record.get("sha256"), fsync)
+            finally:
+                self._discard_record(upload_id)
+            return result
+
+    def abort(self, upload_id: str):
+        with self._lock:
+            record = self.get(upload_id)
+            try:
+                os.remove(record["part_path"])
+            except OSError:
+                pass
+            self._discard_record(upload_id)
+
+    def _discard_record(self, upload_id: str):
+        try:
+            os.remove(self._record_path(upload_id))
+        except OSError:
+            pass
+
+    def expire_stale(self):
+        if not os.path.isdir(self.state_dir):
+            return
+        cutoff = time.time() - self.EXPIRY_SECONDS
+        for name in os.listdir(self.state_dir):
+            if not name.endswith(".json"):
+                continue
+            upload_id = name[:-len(".json")]
+            try:
+                record = self.get(upload_id)
+            except KeyError:
+                continue
+            if record.get("updated_at", 0) < cutoff:
+                print(f"Discarding stale upload {upload_id} for {record.get('path')}")
+                self.abort(upload_id)
@@ -0,0 +1,161 @@
+"""
+Per-command resource limits.
+
+Limits come from the command document's ``limits`` map, falling back to the
+device doc's ``command_limits`` defaults. Supported keys (all optional):
+
+ - ``cpu_seconds``: CPU time, enforced with ``RLIMIT_CPU`` (SIGXCPU, then SIGKILL).
+ - ``memory_mb``: address space via ``RLIMIT_AS``, plus ``memory.max`` in a cgroup.
+ - ``open_files``: file descriptors via ``RLIMIT_NOFILE``.
+ - ``cpu_percent``: share of one CPU via cgroup ``cpu.max`` (cgroup only).
+ - ``wall_seconds``: wall-clock time, enforced by the executor's poll loop.
+
+rlimits are applied in the child between fork and exec. Where the agent runs
+in a delegated, writable cgroup v2 hierarchy (e.g. a systemd unit with
+``Delegate=yes``) each command also gets its own child cgroup so memory
+pressure is contained to that command. Everything degrades gracefully: on
+Windows or without cgroup access, the limits that can't be applied are skipped.
+"""
+import os
+from typing import Callable, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+LIMIT_KEYS = ('cpu_seconds', 'memory_mb', 'open_files', 'cpu_percent', 'wall_seconds')
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+CPU_PERIOD_US = 100000
+
+
+def resolve_limits(cmd_data: dict, defaults: Optional[dict]) -> dict:
+    """Merge the command's ``limits`` over the device defaults, dropping junk values."""
+    merged = {}
+    for source in (defaults or {}, (cmd_data or {}).get('limits') or {}):
+        if not isinstance(source, dict):
+            continue
+        for key in LIMIT_KEYS:
+            value = source.get(key)
+            if value is None:
+                continue
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                continue
+            if value > 0:
+                merged[key] = value
+    return merged
+
+
+def _set_rlimit(which, value: int, grace: int = 0):
+    """Set the soft limit to ``value`` and the hard limit ``grace`` above it."""
+    _, hard = resource.getrlimit(which)
+    # An unprivileged process can't raise its hard limit, so clamp to it.
+    if hard != resource.RLIM_INFINITY:
+        value = min(value, hard)
+        new_hard = min(value + grace, hard)
+    else:
+        new_hard = value + grace
+    resource.setrlimit(which, (value, new_hard))
+
+
+class CommandLimits:
+    """Applies one command's limits: rlimits in the child, an optional cgroup around it."""
+
+    def __init__(self, cmd_id: str, limits: dict):
+        self.cmd_id = cmd_id
+        self.limits = limits
+        self.cgroup_path = None
+
+    @property
+    def wall_seconds(self) -> Optional[float]:
+        return self.limits.get('wall_seconds')
+
+    def setup(self):
+        """Create the per-command cgroup if we can. Never raises."""
+        if not (self.limits.get('memory_mb') or self.limits.get('cpu_percent')):
+            return
+        try:
+            self.cgroup_path = _create_cgroup(self.cmd_id, self.limits)
+        except Exception as e:
+            print(f"[{self.cmd_id}] cgroup limits unavailable, using rlimits only: {type(e).__name__}: {e}")
+            self.cgroup_path = None
+
+    def preexec_fn(self) -> Optional[Callable[[], None]]:
+        """Return a function for ``Popen(preexec_fn=...)``, or None if there's nothing to do."""
+        if os.name != 'posix' or resource is None:
+            return None
+        limits = self.limits
+        cgroup_procs = os.path.join(self.cgroup_path, 'cgroup.procs') if self.cgroup_path else None
+        if not (cgroup_procs or limits.get('cpu_seconds') or limits.get('memory_mb') or limits.get('open_files')):
+            return None
+
+        def apply():
+            # Runs in the child after fork: keep it to plain syscalls and
+            # swallow errors so a limit we can't set doesn't stop the command.
+            if cgroup_procs:
+                try:
+                    with open(cgroup_procs, 'w') as f:
+                        f.write(str(os.getpid()))
+                except OSError:
+                    pass
+            for key, which, scale, grace in (
+                ('cpu_seconds', resource.RLIMIT_CPU, 1, 5),  # SIGXCPU, SIGKILL 5s later
+                ('memory_mb', resource.RLIMIT_AS, 1024 * 1024, 0),
+                ('open_files', resource.RLIMIT_NOFILE, 1, 0),
+            ):
+                if limits.get(key):
+                    try:
+                        _set_rlimit(which, int(limits[key] * scale), grace)
+                    except (ValueError, OSError):
+                        pass
+        return apply
+
+    def cleanup(self):
+        if not self.cgroup_path:
+            return
+        try:
+            os.rmdir(self.cgroup_path)
+        except OSError:
+            # Still has live processes (stragglers that escaped the kill); the
+            # directory is harmless and goes away with the agent's cgroup.
+            pass
+        self.cgroup_path = None
+
+
+def _agent_cgroup_dir() -> Optional[str]:
+    """Path of the cgroup v2 directory the agent runs in, if it's unified and writable."""
+    if not os.path.exists(os.path.join(CGROUP_ROOT, 'cgroup.controllers')):
+        return None
+    try:
+        with open('/proc/self/cgroup') as f:
+            for line in f:
+                if line.startswith('0::'):
+                    path = os.path.join(CGROUP_ROOT, line[3:].strip().lstrip('/'))
+                    return path if os.access(path, os.W_OK) else None
+    except OSError:
+        return None
+    return None
+
+
+def _create_cgroup(cmd_id: str, limits: dict) -> Optional[str]:
+    base = _agent_cgroup_dir()
+    if not base:
+        return None
+    path = os.path.join(base, f"dpf-cmd-{cmd_id}")
+    os.makedirs(path, exist_ok=True)
+    try:
+        if limits.get('memory_mb'):
+            with open(os.path.join(path, 'memory.max'), 'w') as f:
+                f.write(str(int(limits['memory_mb'] * 1024 * 1024)))
+        if limits.get('cpu_percent'):
+            quota = max(1000, int(CPU_PERIOD_US * limits['cpu_percent'] / 100))
+            with open(os.path.join(path, 'cpu.max'), 'w') as f:
+                f.write(f"{quota} {CPU_PERIOD_US}")
+    except OSError:
+        # Controller not enabled for our subtree — don't leave an empty cgroup behind.
+        os.rmdir(path)
+        raise
+    return path
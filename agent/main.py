@@ -4,20 +4,39 @@ from firebase_admin import firestore
 from firebase_admin import storage
 import threading
 import time
+import signal
 import subprocess
 import platform
 import os
 import json
+import gzip
 import sys
+import shlex
 import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 import uvicorn
 from dotenv import load_dotenv
 from pathlib import Path
 import warnings
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from requests.exceptions import RequestException, ConnectionError, Timeout
 from google.api_core import exceptions as google_exceptions
 try:
     from api import app as api_app
+    from scheduler import AdaptiveScheduler, TimerQueue
+    from admission import CommandAdmission
+    from limits import CommandLimits, resolve_limits
+    from accounting import ResourceSampler
+    from procgroup import popen_group_kwargs, terminate_process_tree, reap_orphans
+    from search import SearchIndex, SearchIndexer
+    from output import parse_query, query_buffer, OutputSpill, OutputNormalizer, preview, PREVIEW_HEAD_FRACTION
+    import archive
+    from pyworker import SpawnError, WarmPythonPool, pool_supported
+    from pipeline import parse_pipeline, PipelineRun
+    import sessions
+    import schedules as schedule_utils
     from retry import (
         with_retry,
         NETWORK_EXCEPTIONS,
@@ -26,6 +45,18 @@ try:
     )
 except ImportError:
     from agent.api import app as api_app
+    from agent.scheduler import AdaptiveScheduler, TimerQueue
+    from agent.admission import CommandAdmission
+    from agent.limits import CommandLimits, resolve_limits
+    from agent.accounting import ResourceSampler
+    from agent.procgroup import popen_group_kwargs, terminate_process_tree, reap_orphans
+    from agent.search import SearchIndex, SearchIndexer
+    from agent.output import parse_query, query_buffer, OutputSpill, OutputNormalizer, preview, PREVIEW_HEAD_FRACTION
+    from agent import archive
+    from agent.pyworker import SpawnError, WarmPythonPool, pool_supported
+    from agent.pipeline import parse_pipeline, PipelineRun
+    from agent import sessions
+    from agent import schedules as schedule_utils
     from agent.retry import (
         with_retry,
         NETWORK_EXCEPTIONS,
@@ -64,20 +95,136 @@ if not STORAGE_BUCKET:
 
 DEVICE_ID = os.getenv("DEVICE_ID", platform.node())
 SHARED_FOLDER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shared')
+SEARCH_INDEX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.search_index', 'index.json.gz')
+# Last known 'schedules' config and finished scheduled runs awaiting upload.
+SCHEDULES_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.schedules.json')
+SCHEDULE_JOURNAL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.schedule_journal.ndjson')
 API_URL = "http://localhost:8000"
+# Batched 'api' commands: max requests per command and how many run at once.
+API_BATCH_MAX_REQUESTS = 50
+API_BATCH_CONCURRENCY = 8
 
 # Default configuration values (can be overridden by Firestore config)
 DEFAULT_CONFIG = {
     'polling_rate': 30,
     'sleep_polling_rate': 60,
     'idle_timeout': 60,
+    'deep_sleep_polling_rate': 240,
+    'deep_idle_timeout': 600,
     'heartbeat_interval': 60,
     'max_output_chars': 50000,
+    'max_concurrent_commands': 4,
+    'admission_cpu_threshold': 90,
+    'admission_memory_threshold': 90,
+    # Default per-command limits (see limits.py); a command's own 'limits' map wins.
+    'command_limits': {},
+    # Extra directories indexed for /files/search besides the shared folder.
+    'search_roots': [],
+    # Finished commands older than this move to Storage bundles (0 = keep forever).
+    'history_retention_days': 14,
+    # Modules imported once by the warm interpreter behind 'python' commands.
+    'python_preload': [],
+    # Recurring commands run on-device (see schedules.py).
+    'schedules': {},
+    # Collapse progress-bar redraws / repeated lines, and strip ANSI colour codes.
+    'compact_output': True,
+    'strip_ansi': False,
 }
 
+# Fallback poll tuning. The poll reads only command docs created after a cursor
+# (minus a small overlap for server-timestamp skew), so steady-state reads are
+# near zero. While the snapshot listener is demonstrably healthy, the poll only
+# runs every FALLBACK_POLL_HEALTHY_INTERVAL seconds as a safety net.
+FALLBACK_POLL_PAGE_SIZE = 50
+FALLBACK_POLL_MAX_PAGES = 10
+FALLBACK_POLL_OVERLAP = timedelta(seconds=5)
+FALLBACK_POLL_HEALTHY_INTERVAL = 600
+SEEN_COMMAND_IDS_MAX = 2000
+
+# How soon to retry establishing the command listener after it fails to start,
+# independent of the (possibly long, while idle) fallback poll interval.
+LISTENER_RETRY_DELAY = 30
+
+# While the command queue is blocked on CPU / memory load (rather than the
+# concurrency limit), re-check admission this often.
+ADMISSION_RETRY_DELAY = 5
+# Only the head of a long queue gets its queue_position kept up to date, so a
+# single admission doesn't fan out into hundreds of Firestore writes.
+QUEUE_POSITION_PUBLISH_LIMIT = 25
+# How long an admitted command waits for an in-flight 'queued' write on its
+# doc before marking itself processing (so that write can't land last).
+QUEUE_WRITE_WAIT = 10
+
+# How often a running command's process tree is sampled for resource accounting.
+RESOURCE_SAMPLE_INTERVAL = 2.0
+# Poll cadence of a pipeline's step loop; short so dependent steps start promptly.
+PIPELINE_POLL_INTERVAL = 0.25
+PIPELINE_PUBLISH_INTERVAL = 2.0
+
+# Command history archival (see archive.py). Each pass moves at most
+# ARCHIVE_PAGE_SIZE * ARCHIVE_MAX_PAGES docs, so a big backlog drains over
+# several passes instead of hogging the link.
+ARCHIVE_INTERVAL = 6 * 60 * 60
+ARCHIVE_STARTUP_DELAY = 120
+ARCHIVE_PAGE_SIZE = 200
+ARCHIVE_MAX_PAGES = 10
+FIRESTORE_BATCH_LIMIT = 500
+
+# Startup cleanup of commands left pending / processing by a previous run.
+# Pages stay below FIRESTORE_BATCH_LIMIT so each page is one batch.
+CLEANUP_PAGE_SIZE = 300
+CLEANUP_MAX_ATTEMPTS = 8
+CLEANUP_RETRY_MAX_DELAY = 300
+
+# Scheduled runs are uploaded this long after the first one finishes, so runs
+# close together share a batch; failed uploads are retried after
+# SCHEDULE_SYNC_RETRY. The schedule timer re-checks at least every
+# SCHEDULE_MAX_SLEEP so wall-clock jumps are noticed.
+SCHEDULE_SYNC_DELAY = 120
+SCHEDULE_SYNC_RETRY = 300
+SCHEDULE_SYNC_BATCH = 50
+SCHEDULE_MAX_SLEEP = 300
+
 # Global config that gets populated on boot
 agent_config = DEFAULT_CONFIG.copy()
 
+# Shared keep-alive session for calls to the local API, so 'api' commands and
+# heartbeats reuse connections instead of opening a new one per request.
+api_session = requests.Session()
+api_session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=API_BATCH_CONCURRENCY * 2))
+
+
+def call_local_api(method, endpoint, body=None, params=None, timeout=10):
+    """One request to the local API over the shared session, retried on connection errors."""
+    return with_retry(
+        lambda: api_session.request(method, f"{API_URL}{endpoint}", json=body, params=params, timeout=timeout),
+        exceptions=(ConnectionError, Timeout),
+        operation_name=f"API request {method} {endpoint}",
+    )
+
+
+# Warm interpreter for 'python' commands (see pyworker.py); created on first use.
+python_pool = None
+_python_pool_lock = threading.Lock()
+
+
+def get_python_pool():
+    """The shared WarmPythonPool, or None where forking a warm interpreter isn't supported."""
+    global python_pool
+    if not pool_supported():
+        return None
+    with _python_pool_lock:
+        if python_pool is None:
+            python_pool = WarmPythonPool(agent_config.get('python_preload'))
+        return python_pool
+
+
+def _api_response_body(response):
+    try:
+        return response.json()
+    except Exception:
+        return response.text
+
 # Global registry to track active commands for API access
 # Format: {cmd_id: CommandExecutor instance}
 # This will be shared with api.py
@@ -114,9 +261,11 @@ class FileSyncer(threading.Thread):
     Background thread that syncs files between the local 'shared' folder
     and the Firebase Storage bucket.
     """
-    def __init__(self, device_id):
+    def __init__(self, device_id, scheduler=None, on_file_changed=None):
         super().__init__()
         self.device_id = device_id
+        self.scheduler = scheduler
+        self.on_file_changed = on_file_changed  # Called with the local path after a download / delete
         self.should_stop = False
         self.local_path = SHARED_FOLDER_PATH
         self._consecutive_failures = 0
@@ -140,6 +289,9 @@ class FileSyncer(threading.Thread):
                 should_stop=lambda: self.should_stop,
             )
 
+            if self.scheduler:
+                self.scheduler.record_network_result(blobs is not None)
+
             if blobs is None:
                 self._consecutive_failures += 1
                 # Quiet, exponential backoff up to 5 minutes between attempts.
@@ -191,6 +343,7 @@ class FileSyncer(threading.Thread):
                             suppress_final_error=True,
                             should_stop=lambda: self.should_stop,
                         )
+                        self._notify_changed(local_file_path)
 
                 # Local -> Remote Sync (Deletion)
                 remote_filenames = {os.path.basename(b.name) for b in blobs if os.path.basename(b.name)}
@@ -201,63 +354,507 @@ class FileSyncer(threading.Thread):
                         print(f"File deleted remotely, removing local: {filename}")
                         try:
                             os.remove(os.path.join(self.local_path, filename))
+                            self._notify_changed(os.path.join(self.local_path, filename))
                         except Exception as e:
                             print(f"Error deleting {filename}: {e}")
 
             except Exception as e:
                 print(f"Error in FileSyncer (non-network): {type(e).__name__}: {e}")
 
-            for _ in range(10):
-                if self.should_stop:
-                    break
+            # Re-read the interval every second so a command arriving while the
+            # device is asleep brings sync back to the active cadence quickly.
+            slept = 0
+            while not self.should_stop and slept < self._sync_interval():
                 time.sleep(1)
+                slept += 1
+
+    def _notify_changed(self, path):
+        if self.on_file_changed:
+            try:
+                self.on_file_changed(path)
+            except Exception as e:
+                print(f"FileSyncer: change notification failed for {path}: {e}")
+
+    def _sync_interval(self):
+        if self.scheduler:
+            return self.scheduler.sync_interval()
+        return 10
 
     def stop(self):
         self.should_stop = True
 
+class CommandArchiver(threading.Thread):
+    """
+    Background thread that moves finished commands older than
+    ``history_retention_days`` out of Firestore into daily gzipped NDJSON
+    bundles in Storage, with an index doc per day.
+    """
+    def __init__(self, device_id, device_ref):
+        super().__init__(daemon=True)
+        self.device_id = device_id
+        self.device_ref = device_ref
+        self.should_stop = False
+        self._wake = threading.Event()
+
+    def run(self):
+        self._wake.wait(ARCHIVE_STARTUP_DELAY)
+        while not self.should_stop:
+            try:
+                archived = self.archive_once()
+                if archived:
+                    print(f"Archived {archived} old command(s) to Storage.")
+            except Exception as e:
+                print(f"Error in CommandArchiver: {type(e).__name__}: {e}")
+            self._wake.wait(ARCHIVE_INTERVAL)
+
+    def stop(self):
+        self.should_stop = True
+        self._wake.set()
+
+    def archive_once(self):
+        """One bounded archival pass. Returns how many commands were moved."""
+        try:
+            retention_days = float(agent_config.get('history_retention_days') or 0)
+        except (TypeError, ValueError):
+            retention_days = 0
+        if retention_days <= 0:
+            return 0
+        cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+        bucket = storage.bucket()
+        commands_ref = self.device_ref.collection('commands')
+        archived = 0
+
+        for _ in range(ARCHIVE_MAX_PAGES):
+            if self.should_stop:
+                break
+            # Only finished commands have completed_at, so the range alone
+            # excludes anything still pending or running.
+            query = (
+                commands_ref
+                .where(field_path='completed_at', op_string='<', value=cutoff)
+                .order_by('completed_at')
+                .limit(ARCHIVE_PAGE_SIZE)
+            )
+            docs = with_retry(
+                lambda: list(query.get()),
+                operation_name="list commands to archive",
+                suppress_final_error=True,
+                should_stop=lambda: self.should_stop,
+            )
+            if not docs:
+                break
+
+            by_day = {}
+            for doc in docs:
+                data = doc.to_dict() or {}
+                by_day.setdefault(archive.day_key(data.get('completed_at')), []).append((doc.id, data))
+
+            # Upload every bundle before deleting anything, so a failure part
+            # way through never loses history.
+            for day, records in by_day.items():
+                if not self._write_bundle(bucket, day, records):
+                    return archived
+
+            for i in range(0, len(docs), FIRESTORE_BATCH_LIMIT):
+                chunk = docs[i:i + FIRESTORE_BATCH_LIMIT]
+
+                def delete_chunk(chunk=chunk):
+                    batch = db.batch()
+                    for doc in chunk:
+                        batch.delete(doc.reference)
+                    batch.commit()
+
+                if with_retry(
+                    delete_chunk,
+                    operation_name="delete archived commands",
+                    suppress_final_error=True,
+                    should_stop=lambda: self.should_stop,
+                ) is None:
+                    return archived
+                archived += len(chunk)
+
+            if len(docs) < ARCHIVE_PAGE_SIZE:
+                break
+        return archived
+
+    def _write_bundle(self, bucket, day, records):
+        """Append records to the day's bundle and refresh its index doc. True on success."""
+        path = f"agents/{self.device_id}/history/{day}.ndjson.gz"
+        blob = bucket.blob(path)
+
+        def do_write():
+            existing = blob.download_as_bytes() if blob.exists() else b''
+            data, entries, added = archive.append_bundle(existing, records)
+            if added:
+                blob.upload_from_string(data, content_type='application/gzip')
+            self.device_ref.collection('history_index').document(day).set(
+                dict(archive.index_doc(day, path, entries, len(data)),
+                     updated_at=firestore.SERVER_TIMESTAMP)
+            )
+            return True
+
+        return with_retry(
+            do_write,
+            operation_name=f"archive history bundle {day}",
+            suppress_final_error=True,
+            should_stop=lambda: self.should_stop,
+        ) is True
+
+
 class CommandExecutor(threading.Thread):
     """
     Handles the execution of a single command (shell or API) in a separate thread.
     Captures stdout/stderr in memory, only writes to Firestore on-demand or completion.
     Optimized for long-running scripts to minimize Firestore writes.
     """
-    def __init__(self, cmd_id, cmd_data, device_ref):
+    def __init__(self, cmd_id, cmd_data, device_ref, on_finished=None, cmd_ref=None):
         super().__init__()
         self.cmd_id = cmd_id
+        self.on_finished = on_finished  # Called from this thread once the command is done
+        self.finished = False
         self.cmd_data = cmd_data
         self.device_ref = device_ref
-        self.cmd_ref = device_ref.collection('commands').document(cmd_id)
+        # Scheduled runs pass a JournalRef (schedules.py) and have no command doc.
+        self.journaled = cmd_ref is not None
+        self.cmd_ref = cmd_ref if cmd_ref is not None else device_ref.collection('commands').document(cmd_id)
         self.process = None
         self.should_stop = False
         self.output_buffer = []  # List of (timestamp, line) tuples for stdout
         self.error_buffer = []   # List of (timestamp, line) tuples for stderr
+        # Lines ever appended per stream; with the buffer length this gives the
+        # absolute line number of buffer[0] once old lines have been dropped.
+        self.lines_total = {'stdout': 0, 'stderr': 0}
+        self._output_lock = threading.Lock()
+        # Lines pushed out of the buffers, kept for the Storage upload of
+        # output too big for the command doc (created on first overflow).
+        self.spills = {'stdout': None, 'stderr': None}
         self.last_heartbeat = time.time()
-        self.kill_listener = None
         # Use config values (from Firestore or defaults)
         self.heartbeat_interval = float(agent_config.get('heartbeat_interval', 60))
         self.command_start_time = time.time()
         self.max_memory_lines = 10000  # Keep last 10k lines in memory
         self.max_output_chars = agent_config.get('max_output_chars', 50000)  # Limit output size sent to Firestore
+        # Output compaction (see output.OutputNormalizer); a command may override either.
+        self.compact_output = bool(cmd_data.get('compact_output', agent_config.get('compact_output', True)))
+        self.strip_ansi = bool(cmd_data.get('strip_ansi', agent_config.get('strip_ansi', False)))
+        self.normalizers = []
+        self.limits = CommandLimits(cmd_id, resolve_limits(cmd_data, agent_config.get('command_limits')))
+        self.timed_out = False
+        self.resources = None  # ResourceSampler, created when the subprocess starts
+        self.pipeline = None   # PipelineRun for 'pipeline' commands
+        self.after_queue_write = None  # Event set once a pending 'queued' write has landed
+
+    def run_api_command(self):
+        """Call the local API for an 'api' command and record the response.
+
+        A single request comes from ``endpoint`` / ``method`` / ``body``. A
+        ``requests`` list of such maps (each optionally with ``params``) runs
+        them concurrently over the shared session and stores all responses
+        as one JSON array in ``output``, so a dashboard refresh is one
+        command round-trip instead of several.
+        """
+        batch = self.cmd_data.get('requests')
+        try:
+            if batch is not None:
+                if not isinstance(batch, list) or not batch:
+                    raise ValueError("'requests' must be a non-empty list")
+                if len(batch) > API_BATCH_MAX_REQUESTS:
+                    raise ValueError(f"At most {API_BATCH_MAX_REQUESTS} requests per batch")
+                print(f"[{self.cmd_id}] API batch: {len(batch)} requests")
+
+                def run_one(item):
+                    item = item if isinstance(item, dict) else {}
+                    endpoint = item.get('endpoint', '/health')
+                    method = item.get('method', 'GET')
+                    result = {'endpoint': endpoint, 'method': method}
+                    try:
+                        response = call_local_api(method, endpoint, item.get('body'), item.get('params'))
+                        result.update(status_code=response.status_code, body=_api_response_body(response))
+                    except Exception as e:
+                        result.update(status_code=None, error=str(e))
+                    return result
+
+                with ThreadPoolExecutor(max_workers=min(len(batch), API_BATCH_CONCURRENCY)) as pool:
+                    results = list(pool.map(run_one, batch))
+                output_data = json.dumps(results, indent=2)
+                # Worst outcome wins: 599 stands in for a request that never got a response.
+                return_code = max(r['status_code'] or 599 for r in results)
+            else:
+                endpoint = self.cmd_data.get('endpoint', '/health')
+                method = self.cmd_data.get('method', 'GET')
+                body = self.cmd_data.get('body', {})
+                print(f"[{self.cmd_id}] API Request: {method} {endpoint}")
+                response = call_local_api(method, endpoint, body)
+                body = _api_response_body(response)
+                output_data = body if isinstance(body, str) else json.dumps(body, indent=2)
+                return_code = response.status_code
+
+            with_retry(
+                lambda: self.cmd_ref.update({
+                    'output': output_data,
+                    'status': 'completed',
+                    'return_code': return_code,
+                    'completed_at': firestore.SERVER_TIMESTAMP
+                }),
+                operation_name="record API result",
+                log_prefix=f"[{self.cmd_id}]",
+                suppress_final_error=True,
+            )
+
+        except Exception as e:
+            error_msg = f"Network error: {str(e)}" if isinstance(e, (ConnectionError, Timeout)) else str(e)
+            print(f"[{self.cmd_id}] API request failed: {error_msg}")
+            with_retry(
+                lambda: self.cmd_ref.update({
+                    'error': error_msg,
+                    'status': 'completed',
+                    'completed_at': firestore.SERVER_TIMESTAMP
+                }),
+                operation_name="record API error",
+                log_prefix=f"[{self.cmd_id}]",
+                suppress_final_error=True,
+            )
 
-    def _read_stream(self, stream, buffer):
+    def start_python(self, env):
+        """Start a 'python' command, forked from the warm interpreter where possible.
+
+        Runs ``script`` (relative paths are in the shared folder) with ``args``,
+        or inline ``code``. Without either, ``command`` is read as
+        ``script [args...]``. Falls back to a fresh interpreter if the warm
+        pool is unsupported or certainly didn't start the job.
+        """
+        script = self.cmd_data.get('script')
+        code = self.cmd_data.get('code')
+        args = [str(a) for a in self.cmd_data.get('args') or []]
+        if not script and not code:
+            parts = shlex.split(self.cmd_data.get('command') or '')
+            if not parts:
+                raise ValueError("A python command needs 'script', 'code' or 'command'")
+            script, args = parts[0], parts[1:]
+        if script and not os.path.isabs(script):
+            script = os.path.join(SHARED_FOLDER_PATH, script)
+        cwd = os.path.dirname(os.path.abspath(__file__))
+
+        pool = get_python_pool()
+        if pool is not None:
+            try:
+                return pool.spawn({
+                    'script': script,
+                    'code': code if not script else None,
+                    'args': args,
+                    'cwd': cwd,
+                    'env': env,
+                    'limits': self.limits.limits,
+                    'cgroup_path': self.limits.cgroup_path,
+                })
+            except SpawnError as e:
+                print(f"[{self.cmd_id}] Warm Python unavailable, starting a fresh interpreter: {e}")
+
+        argv = [sys.executable, '-u'] + ([script] if script else ['-c', code]) + args
+        return subprocess.Popen(
+            argv,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            env=env,
+            cwd=cwd,
+            preexec_fn=self.limits.preexec_fn(),
+            **popen_group_kwargs()
+        )
+
+    def run_pipeline(self, env):
+        """Run a 'pipeline' command's DAG of shell steps (see pipeline.py). Returns the exit code.
+
+        Steps run in this thread's poll loop, several at once when their
+        dependencies allow. Their output goes into the command's buffers
+        prefixed with ``[step]``. The command doc's ``steps`` list is
+        rewritten when steps start or finish (at most every
+        PIPELINE_PUBLISH_INTERVAL seconds).
+        """
+        steps, max_parallel = parse_pipeline(self.cmd_data)
+        self.pipeline = run = PipelineRun(steps, max_parallel)
+        self.resources = ResourceSampler()
+        agent_dir = os.path.dirname(os.path.abspath(__file__))
+        wall_seconds = self.limits.wall_seconds
+        running = {}  # step name -> (process, reader threads, ResourceSampler)
+        last_sample = 0.0
+        last_publish = 0.0
+        dirty = False
+
+        def publish():
+            with_retry(
+                lambda: self.cmd_ref.update({
+                    'steps': run.status(),
+                    'last_activity': firestore.SERVER_TIMESTAMP,
+                }),
+                max_retries=2,
+                retry_delay=0.5,
+                max_delay=2.0,
+                operation_name="publish pipeline steps",
+                log_prefix=f"[{self.cmd_id}]",
+                suppress_final_error=True,
+                should_stop=lambda: self.should_stop,
+            )
+
+        def reap(step, timed_out=False):
+            process, threads, sampler = running.pop(step.name)
+            if not timed_out and not self.cmd_data.get('keep_background'):
+                reap_orphans(process)
+            for thread in threads:
+                thread.join(timeout=2)
+            sampler.finish()
+            run.finish(step, process.returncode, timed_out=timed_out, resources=sampler.summary())
+            print(f"[{self.cmd_id}] Step '{step.name}' {step.status} (return code {process.returncode})")
+
+        try:
+            while True:
+                changed = False
+                now = time.time()
+                if wall_seconds and not self.should_stop and now - self.command_start_time > wall_seconds:
+                    print(f"[{self.cmd_id}] Wall-clock limit of {wall_seconds:g}s exceeded.")
+                    self.timed_out = True
+                    self.should_stop = True
+                if self.should_stop:
+                    print(f"[{self.cmd_id}] Kill signal received. Terminating pipeline...")
+                    run.cancel_pending()
+                    for name, (process, _, _) in list(running.items()):
+                        terminate_process_tree(process)
+                        reap(run.steps[name])
+                        run.steps[name].status = 'cancelled'
+                    break
+
+                for step in run.ready():
+                    step_env = dict(env, **step.env)
+                    cwd = os.path.join(agent_dir, step.cwd) if step.cwd else agent_dir
+                    try:
+                        process = subprocess.Popen(
+                            step.command,
+                            shell=True,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            text=True,
+                            env=step_env,
+                            cwd=cwd,
+                            preexec_fn=self.limits.preexec_fn(),
+                            **popen_group_kwargs()
+                        )
+                    except OSError as e:
+                        self._append_lines(self.error_buffer, 'stderr', [f"[{step.name}] Could not start: {e}\n"])
+                        run.start(step)
+                        run.finish(step, None)
+                        changed = True
+                        continue
+                    run.start(step)
+                    threads = [
+                        threading.Thread(target=self._read_stream, daemon=True,
+                                         args=(process.stdout, self.output_buffer, 'stdout', f"[{step.name}] ")),
+                        threading.Thread(target=self._read_stream, daemon=True,
+                                         args=(process.stderr, self.error_buffer, 'stderr', f"[{step.name}] ")),
+                    ]
+                    for thread in threads:
+                        thread.start()
+                    running[step.name] = (process, threads, ResourceSampler())
+                    print(f"[{self.cmd_id}] Step '{step.name}' started: {step.command}")
+                    changed = True
+
+                sample = now - last_sample >= RESOURCE_SAMPLE_INTERVAL
+                if sample:
+                    # One snapshot across all running steps, so the command's
+                    # peaks are for what ran concurrently.
+                    self.resources.sample_many([process.pid for process, _, _ in running.values()])
+                for name, (process, _, sampler) in list(running.items()):
+                    step = run.steps[name]
+                    if sample:
+                        sampler.sample(process.pid)
+                    if process.poll() is not None:
+                        reap(step)
+                        changed = True
+                    elif step.timeout and now - step.started_at > step.timeout:
+                        print(f"[{self.cmd_id}] Step '{name}' exceeded its {step.timeout:g}s timeout.")
+                        terminate_process_tree(process)
+                        reap(step, timed_out=True)
+                        changed = True
+                if sample:
+                    last_sample = now
+
+                if run.done():
+                    break
+                # Coalesce bursts of step transitions into one write.
+                dirty = dirty or changed
+                if dirty and now - last_publish >= PIPELINE_PUBLISH_INTERVAL:
+                    publish()
+                    last_publish = now
+                    dirty = False
+                self.send_heartbeat()
+                time.sleep(PIPELINE_POLL_INTERVAL)
+        finally:
+            for process, _, _ in running.values():
+                if process.poll() is None:
+                    terminate_process_tree(process)
+        return run.return_code()
+
+    def terminate(self):
+        """Stop the command's process tree; for a session command, only what it started."""
+        if isinstance(self.process, sessions.SessionCommand):
+            self.process.interrupt()
+        else:
+            terminate_process_tree(self.process)
+
+    def _read_stream(self, stream, buffer, name, prefix=''):
+        normalizer = None
+        # Session streams are always read untranslated (the shell outlives
+        # this command's settings), so their line endings need normalising.
+        if self.compact_output or self.strip_ansi or isinstance(self.process, sessions.SessionCommand):
+            normalizer = OutputNormalizer(strip_escapes=self.strip_ansi, compact=self.compact_output)
+            if self.compact_output:
+                try:
+                    # Keep '\r' line endings visible so redraws can be collapsed.
+                    stream.reconfigure(newline='')
+                except (AttributeError, ValueError, OSError):
+                    pass
+            self.normalizers.append(normalizer)
         try:
             for line in iter(stream.readline, ''):
                 if line:
-                    # Store with timestamp for time-based queries
-                    buffer.append((time.time(), line))
-                    # Limit memory usage by keeping only recent lines
-                    if len(buffer) > self.max_memory_lines:
-                        buffer.pop(0)  # Remove oldest line
+                    lines = normalizer.feed(line) if normalizer else [line]
+                    if lines:
+                        self._append_lines(buffer, name, [prefix + l for l in lines])
                 else:
                     break
         except Exception:
             pass
         finally:
+            if normalizer:
+                self._append_lines(buffer, name, [prefix + l for l in normalizer.flush()])
             try:
                 stream.close()
             except:
                 pass
 
+    def _append_lines(self, buffer, name, lines):
+        with self._output_lock:
+            for line in lines:
+                # Store with timestamp for time-based queries
+                buffer.append((time.time(), line))
+                self.lines_total[name] += 1
+                # Limit memory usage by keeping only recent lines
+                if len(buffer) > self.max_memory_lines:
+                    _, dropped = buffer.pop(0)  # Remove oldest line
+                    self._spill(name, dropped)
+
+    def _spill(self, name, line):
+        """Keep a line dropped from the buffer for the final upload. Caller holds _output_lock."""
+        spill = self.spills[name]
+        if spill is None:
+            try:
+                spill = OutputSpill(self.cmd_id, name, int(self.max_output_chars * PREVIEW_HEAD_FRACTION))
+            except OSError as e:
+                print(f"[{self.cmd_id}] Could not create output spill file, early {name} will be lost: {e}")
+                spill = False  # Don't try again for every line
+            self.spills[name] = spill
+        if spill:
+            spill.write(line)
+
     def run(self):
         command_str = self.cmd_data.get('command')
         command_type = self.cmd_data.get('type', 'shell')
@@ -265,26 +862,22 @@ class CommandExecutor(threading.Thread):
         print(f"[{self.cmd_id}] Executing: {command_str}")
         self.command_start_time = time.time()
 
-        # Subscribing to the doc lets us receive kill_signal / output_request
-        # events. If the subscribe fails (slow / flaky network) we still want
-        # the command to run — kill via Firestore won't work until the network
-        # recovers, but the subprocess and its output remain intact.
-        try:
-            self.kill_listener = self.cmd_ref.on_snapshot(self.on_doc_update)
-        except Exception as e:
-            print(f"[{self.cmd_id}] Failed to subscribe to command doc (will run without live kill signal): {type(e).__name__}: {e}")
-            self.kill_listener = None
+        # kill_signal / output_request events arrive through the Agent's single
+        # listener on processing commands, which calls on_doc_update.
 
         # Register this command in the global registry for API access
         active_commands_registry[self.cmd_id] = self
 
         try:
+            if self.after_queue_write is not None:
+                self.after_queue_write.wait(QUEUE_WRITE_WAIT)
             # Mark as processing. If the network is down we still proceed with the
             # subprocess; the heartbeat / final-status writes will catch up later.
             with_retry(
                 lambda: self.cmd_ref.update({
                     'status': 'processing',
-                    'started_at': firestore.SERVER_TIMESTAMP
+                    'started_at': firestore.SERVER_TIMESTAMP,
+                    'queue_position': firestore.DELETE_FIELD
                 }),
                 operation_name="mark command processing",
                 log_prefix=f"[{self.cmd_id}]",
@@ -309,99 +902,88 @@ class CommandExecutor(threading.Thread):
                 return
 
             if command_type == 'api':
-                endpoint = self.cmd_data.get('endpoint', '/health')
-                method = self.cmd_data.get('method', 'GET')
-                body = self.cmd_data.get('body', {})
-                print(f"[{self.cmd_id}] API Request: {method} {endpoint}")
-                
-                try:
-                    url = f"{API_URL}{endpoint}"
-
-                    def make_api_request():
-                        return requests.request(method, url, json=body, timeout=10)
-
-                    response = with_retry(
-                        make_api_request,
-                        exceptions=(ConnectionError, Timeout),
-                        operation_name="API request",
-                        log_prefix=f"[{self.cmd_id}]"
-                    )
-
-                    try:
-                        output_data = json.dumps(response.json(), indent=2)
-                    except Exception:
-                        output_data = response.text
-
-                    with_retry(
-                        lambda: self.cmd_ref.update({
-                            'output': output_data,
-                            'status': 'completed',
-                            'return_code': response.status_code,
-                            'completed_at': firestore.SERVER_TIMESTAMP
-                        }),
-                        operation_name="record API result",
-                        log_prefix=f"[{self.cmd_id}]",
-                        suppress_final_error=True,
-                    )
-
-                except Exception as e:
-                    error_msg = f"Network error: {str(e)}" if isinstance(e, (ConnectionError, Timeout)) else str(e)
-                    print(f"[{self.cmd_id}] API request failed: {error_msg}")
-                    with_retry(
-                        lambda: self.cmd_ref.update({
-                            'error': error_msg,
-                            'status': 'completed',
-                            'completed_at': firestore.SERVER_TIMESTAMP
-                        }),
-                        operation_name="record API error",
-                        log_prefix=f"[{self.cmd_id}]",
-                        suppress_final_error=True,
-                    )
+                self.run_api_command()
                 return
 
-            if not command_str:
+            if not command_str and command_type not in ('python', 'pipeline'):
                 raise ValueError("No command string provided")
 
             env = os.environ.copy()
             env["PYTHONUNBUFFERED"] = "1"
 
-            self.process = subprocess.Popen(
-                command_str,
-                shell=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                env=env,
-                cwd=os.path.dirname(os.path.abspath(__file__))
-            )
+            self.limits.setup()
+            if command_type == 'pipeline':
+                return_code = self.run_pipeline(env)
+            else:
+                session_name = self.cmd_data.get('session')
+                if command_type == 'python':
+                    self.process = self.start_python(env)
+                elif session_name:
+                    # Persistent shell: cwd and exported variables carry over.
+                    self.process = sessions.manager.run(
+                        str(session_name), command_str,
+                        cwd=os.path.dirname(os.path.abspath(__file__)),
+                        env=env,
+                        should_stop=lambda: self.should_stop,
+                    )
+                else:
+                    self.process = subprocess.Popen(
+                        command_str,
+                        shell=True,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                        text=True,
+                        env=env,
+                        cwd=os.path.dirname(os.path.abspath(__file__)),
+                        preexec_fn=self.limits.preexec_fn(),
+                        # Own session / process group, so cancel reaches the whole tree.
+                        **popen_group_kwargs()
+                    )
+                wall_seconds = self.limits.wall_seconds
+                self.resources = ResourceSampler()
+                last_sample = 0.0
             
-            stdout_thread = threading.Thread(target=self._read_stream, args=(self.process.stdout, self.output_buffer))
-            stderr_thread = threading.Thread(target=self._read_stream, args=(self.process.stderr, self.error_buffer))
-            stdout_thread.daemon = True
-            stderr_thread.daemon = True
-            stdout_thread.start()
-            stderr_thread.start()
+                stdout_thread = threading.Thread(target=self._read_stream, args=(self.process.stdout, self.output_buffer, 'stdout'))
+                stderr_thread = threading.Thread(target=self._read_stream, args=(self.process.stderr, self.error_buffer, 'stderr'))
+                stdout_thread.daemon = True
+                stderr_thread.daemon = True
+                stdout_thread.start()
+                stderr_thread.start()
+
+                while True:
+                    if time.time() - last_sample >= RESOURCE_SAMPLE_INTERVAL:
+                        self.resources.sample(self.process.pid)
+                        last_sample = time.time()
+
+                    if wall_seconds and not self.should_stop and time.time() - self.command_start_time > wall_seconds:
+                        print(f"[{self.cmd_id}] Wall-clock limit of {wall_seconds:g}s exceeded.")
+                        self.timed_out = True
+                        self.should_stop = True
 
-            while True:
-                if self.should_stop:
-                    print(f"[{self.cmd_id}] Kill signal received. Terminating...")
-                    self.process.terminate()
-                    try:
-                        self.process.wait(timeout=5)
-                    except subprocess.TimeoutExpired:
-                        self.process.kill()
-                    break
+                    if self.should_stop:
+                        print(f"[{self.cmd_id}] Kill signal received. Terminating...")
+                        self.terminate()
+                        stdout_thread.join(timeout=2)
+                        stderr_thread.join(timeout=2)
+                        break
 
-                if self.process.poll() is not None:
-                    stdout_thread.join(timeout=1)
-                    stderr_thread.join(timeout=1)
-                    break
+                    if self.process.poll() is not None:
+                        # Background jobs left in the group would hold the output
+                        # pipes open forever; reap them unless asked not to.
+                        # Session shells keep theirs: they belong to the session.
+                        if not self.cmd_data.get('keep_background') and not session_name:
+                            if reap_orphans(self.process):
+                                print(f"[{self.cmd_id}] Terminated background processes left by the command.")
+                        stdout_thread.join(timeout=2)
+                        stderr_thread.join(timeout=2)
+                        break
                 
-                # Send minimal heartbeat periodically (no output, just alive signal)
-                self.send_heartbeat()
-                time.sleep(1.0)  # Check every 1s
+                    # Send minimal heartbeat periodically (no output, just alive signal)
+                    self.send_heartbeat()
+                    time.sleep(1.0)  # Check every 1s
 
-            return_code = self.process.returncode
+                return_code = self.process.returncode
+            self.resources.finish()
 
             # Write final output once when command completes
             self.write_final_output()
@@ -413,6 +995,11 @@ class CommandExecutor(threading.Thread):
             }
             if self.should_stop:
                 update_data['status'] = 'cancelled'
+            if self.timed_out:
+                update_data['timed_out'] = True
+            if self.pipeline is not None:
+                update_data['steps'] = self.pipeline.status()
+            update_data['resources'] = self.resources.summary()
 
             # Retry final status update with the long profile — losing this means
             # the UI thinks the command is still running.
@@ -444,19 +1031,26 @@ class CommandExecutor(threading.Thread):
                 suppress_final_error=True
             )
         finally:
-            if self.kill_listener:
-                try:
-                    self.kill_listener.unsubscribe()
-                except Exception as e:
-                    print(f"[{self.cmd_id}] Error unsubscribing kill listener: {type(e).__name__}: {e}")
             if self.process and self.process.poll() is None:
-                 self.process.terminate()
+                self.terminate()
+            self.limits.cleanup()
+            with self._output_lock:
+                for name, spill in self.spills.items():
+                    if spill:
+                        spill.cleanup()
+                    self.spills[name] = False  # A late reader line mustn't start a new spill
             # Unregister after a delay to allow API access to final output
             def cleanup():
                 time.sleep(300)  # Keep for 5 minutes after completion
                 if self.cmd_id in active_commands_registry:
                     del active_commands_registry[self.cmd_id]
             threading.Thread(target=cleanup, daemon=True).start()
+            self.finished = True
+            if self.on_finished:
+                try:
+                    self.on_finished(self.cmd_id)
+                except Exception as e:
+                    print(f"[{self.cmd_id}] Error in completion callback: {type(e).__name__}: {e}")
 
     def send_heartbeat(self):
         """Send a minimal heartbeat to show the command is still alive.
@@ -475,8 +1069,8 @@ class CommandExecutor(threading.Thread):
         result = with_retry(
             lambda: self.cmd_ref.update({
                 'last_activity': firestore.SERVER_TIMESTAMP,
-                'output_lines': len(self.output_buffer),
-                'error_lines': len(self.error_buffer)
+                'output_lines': self.lines_total['stdout'],
+                'error_lines': self.lines_total['stderr']
             }),
             max_retries=2,
             retry_delay=0.5,
@@ -494,24 +1088,42 @@ class CommandExecutor(threading.Thread):
             self.last_heartbeat = current_time - max(self.heartbeat_interval - 10, 0)
 
     def write_final_output(self):
-        """Write final output when command completes. Called once at the end."""
-        stdout, stderr = self.get_all_output()
-
-        # Truncate to max size (keep the end, which is most recent)
-        if len(stdout) > self.max_output_chars:
-            stdout = "... (truncated)\n" + stdout[-self.max_output_chars:]
-        if len(stderr) > self.max_output_chars:
-            stderr = "... (truncated)\n" + stderr[-self.max_output_chars:]
+        """Write final output when command completes. Called once at the end.
 
+        Output over ``max_output_chars`` is uploaded in full to Storage as gzip
+        (``agents/{device}/outputs/{cmd_id}/{stream}.log.gz``); the doc then
+        gets a head + tail preview and an ``output_ref`` / ``error_ref``. If the
+        upload fails we fall back to keeping just the end, as before.
+        """
         update_data = {
             'last_activity': firestore.SERVER_TIMESTAMP,
-            'output_lines': len(self.output_buffer),
-            'error_lines': len(self.error_buffer)
+            'output_lines': self.lines_total['stdout'],
+            'error_lines': self.lines_total['stderr']
         }
-        if stdout:
-            update_data['output'] = stdout
-        if stderr:
-            update_data['error'] = stderr
+        compacted = sum(n.collapsed for n in self.normalizers)
+        if compacted:
+            update_data['compacted_lines'] = compacted
+        for name, buffer, field in (('stdout', self.output_buffer, 'output'),
+                                    ('stderr', self.error_buffer, 'error')):
+            with self._output_lock:
+                lines = [line for _, line in buffer]
+                spill = self.spills[name] or None
+            text = "".join(lines)
+            total_chars = len(text) + (spill.chars if spill else 0)
+            if total_chars <= self.max_output_chars and not spill:
+                if text:
+                    update_data[field] = text
+                continue
+
+            # A journaled run may finish offline; don't hold it up on Storage.
+            ref = None if self.journaled else self._upload_full_output(name, lines, spill)
+            if ref:
+                head = spill.head if spill else text
+                update_data[field] = preview(head, text, total_chars, self.max_output_chars)
+                update_data[f'{field}_ref'] = ref
+            else:
+                # Truncate to max size (keep the end, which is most recent)
+                update_data[field] = "... (truncated)\n" + text[-self.max_output_chars:]
 
         # The final output is important — use the long retry profile so we
         # don't drop it when the network is slow but eventually reachable.
@@ -524,6 +1136,46 @@ class CommandExecutor(threading.Thread):
             suppress_final_error=True,
         )
     
+    def _upload_full_output(self, name, lines, spill):
+        """Upload one stream's complete output as gzip. Returns a reference dict or None."""
+        path = f"agents/{self.device_ref.id}/outputs/{self.cmd_id}/{name}.log.gz"
+        try:
+            if spill:
+                with self._output_lock:
+                    local_path = spill.finish(lines)
+                data = None
+            else:
+                data = gzip.compress("".join(lines).encode('utf-8'))
+
+            blob = storage.bucket().blob(path)
+            # Stored gzip-encoded so a download URL serves plain text.
+            blob.content_encoding = 'gzip'
+
+            def do_upload():
+                if data is None:
+                    blob.upload_from_filename(local_path, content_type='text/plain; charset=utf-8')
+                else:
+                    blob.upload_from_string(data, content_type='text/plain; charset=utf-8')
+
+            result = with_retry(
+                lambda: do_upload() or True,
+                max_retries=LONG_MAX_RETRIES,
+                max_delay=LONG_MAX_DELAY,
+                operation_name=f"upload full {name}",
+                log_prefix=f"[{self.cmd_id}]",
+                suppress_final_error=True,
+            )
+            if result is None:
+                return None
+            return {
+                'path': path,
+                'lines': self.lines_total[name],
+                'compressed_bytes': os.path.getsize(local_path) if data is None else len(data),
+            }
+        except Exception as e:
+            print(f"[{self.cmd_id}] Could not upload full {name}: {type(e).__name__}: {e}")
+            return None
+
     def get_recent_output(self, seconds=60):
         """Get output from the last N seconds. Returns (stdout, stderr) as strings."""
         current_time = time.time()
@@ -535,6 +1187,78 @@ class CommandExecutor(threading.Thread):
         
         return "".join(recent_out), "".join(recent_err)
     
+    def get_output_since(self, cursor=None, seconds=60, max_chars=None):
+        """Output appended after ``cursor``, for incremental polling.
+
+        ``cursor`` maps stream name -> absolute number of lines already seen (as
+        returned in a previous call's ``cursor``); with no cursor this starts
+        from the last ``seconds`` of output. At most ``max_chars`` per stream
+        are returned, with ``more`` set if the caller should ask again. ``gap``
+        means lines between the cursor and the oldest buffered line were dropped.
+        """
+        cursor = cursor if isinstance(cursor, dict) else None
+        max_chars = max_chars or self.max_output_chars
+        cutoff_time = time.time() - seconds
+        result = {'cursor': {}, 'gap': False, 'more': False}
+        for name, buffer in (('stdout', self.output_buffer), ('stderr', self.error_buffer)):
+            with self._output_lock:
+                snapshot = list(buffer)
+                total = self.lines_total[name]
+            first_line = total - len(snapshot) + 1
+            since = cursor.get(name) if cursor else None
+            if not isinstance(since, int) or since < 0 or since > total:
+                # No (or a foreign) cursor: fall back to the time window.
+                start = next((i for i, (ts, _) in enumerate(snapshot) if ts >= cutoff_time), len(snapshot))
+            else:
+                start = since - (first_line - 1)
+                if start < 0:
+                    result['gap'] = True
+                    start = 0
+            chunk, size, end = [], 0, start
+            while end < len(snapshot) and (size + len(snapshot[end][1]) <= max_chars or not chunk):
+                chunk.append(snapshot[end][1])
+                size += len(snapshot[end][1])
+                end += 1
+            if end < len(snapshot):
+                result['more'] = True
+            result[name] = "".join(chunk)
+            result['cursor'][name] = first_line - 1 + end
+        return result
+
+    def search_output(self, query):
+        """Matching lines (with context) from the in-memory buffers; see output.py.
+
+        Raises ValueError for an invalid query.
+        """
+        parsed = parse_query(query)
+        streams = [('stdout', self.output_buffer), ('stderr', self.error_buffer)]
+        if parsed['stream'] != 'both':
+            streams = [(n, b) for n, b in streams if n == parsed['stream']]
+
+        matches = []
+        total = 0
+        for name, buffer in streams:
+            with self._output_lock:
+                snapshot = list(buffer)
+                first_line = self.lines_total[name] - len(snapshot) + 1
+            result = query_buffer(snapshot, first_line, name, parsed)
+            matches.extend(result['matches'])
+            total += result['total_matches']
+
+        # Interleave both streams by time, then re-apply the first / last N cap.
+        matches.sort(key=lambda m: m['timestamp'])
+        limit = parsed['max_matches']
+        matches = matches[-limit:] if parsed['from_end'] else matches[:limit]
+        return {
+            'matches': matches,
+            'total_matches': total,
+            'truncated': total > len(matches),
+        }
+
+    def get_resource_usage(self):
+        """Resource summary so far (live while running), or None before the process starts."""
+        return self.resources.summary() if self.resources else None
+
     def get_all_output(self):
         """Get all output. Returns (stdout, stderr) as strings."""
         return "".join(line for _, line in self.output_buffer), "".join(line for _, line in self.error_buffer)
@@ -560,13 +1284,36 @@ class CommandExecutor(threading.Thread):
                         # Only process if we haven't handled this request yet
                         if request_id and request_id != getattr(self, '_last_request_id', None):
                             self._last_request_id = request_id
-                            # Get requested output and write to Firestore
-                            stdout, stderr = self.get_recent_output(seconds=seconds)
-                            output_update = {
-                                'output': stdout,
-                                'error': stderr,
-                                'output_request': firestore.DELETE_FIELD  # Clear the request
-                            }
+                            if 'since' in output_request:
+                                # Incremental variant: only lines after the
+                                # caller's cursor, plus the new cursor.
+                                delta = self.get_output_since(output_request.get('since'), seconds=seconds)
+                                output_update = {
+                                    'output_delta': dict(delta, request_id=request_id,
+                                                         since=output_request.get('since')),
+                                    'output_lines': self.lines_total['stdout'],
+                                    'error_lines': self.lines_total['stderr'],
+                                    'output_request': firestore.DELETE_FIELD
+                                }
+                            elif 'query' in output_request:
+                                # Search variant: only the matching lines go back,
+                                # in their own field so 'output' stays the log tail.
+                                try:
+                                    result = self.search_output(output_request['query'])
+                                except ValueError as e:
+                                    result = {'error': str(e)}
+                                output_update = {
+                                    'output_query': dict(result, request_id=request_id),
+                                    'output_request': firestore.DELETE_FIELD
+                                }
+                            else:
+                                # Get requested output and write to Firestore
+                                stdout, stderr = self.get_recent_output(seconds=seconds)
+                                output_update = {
+                                    'output': stdout,
+                                    'error': stderr,
+                                    'output_request': firestore.DELETE_FIELD  # Clear the request
+                                }
                             with_retry(
                                 lambda: self.cmd_ref.update(output_update),
                                 max_retries=2,
@@ -576,7 +1323,7 @@ class CommandExecutor(threading.Thread):
                                 suppress_final_error=True
                             )
         except Exception as e:
-            print(f"Error in kill listener: {e}")
+            print(f"[{self.cmd_id}] Error handling command doc update: {e}")
 
 
 class Agent:
@@ -590,19 +1337,57 @@ class Agent:
         self.doc_ref = db.collection('devices').document(self.device_id)
         self.watch = None
         self.device_watch = None
+        # One listener for all running commands' control fields (kill_signal,
+        # output_request), dispatched to executors by ID. Started with the
+        # first command and kept open.
+        self.control_watch = None
         self.active_commands = {} # cmd_id -> CommandExecutor
         self.last_activity_time = time.time()
-        self.file_syncer = FileSyncer(device_id)
         self.last_listener_event = time.time()  # Track when listener last fired
         self.listener_restart_count = 0  # Track how many times we've restarted the listener
+        self.listener_has_fired = False  # Has the current listener delivered a snapshot yet?
+        # Fallback poll state: created_at cursor plus the IDs we've already seen
+        # (from either the listener or the poll), bounded to the most recent ones.
+        # The cursor only moves on the poll's own results, so a command the
+        # listener missed can't be skipped by a newer one it delivered. It
+        # starts at the server-side boot time (see fetch_boot_time).
+        self.poll_cursor = None
+        self.last_fallback_poll = 0.0
+        self.seen_command_ids = OrderedDict()
+        self._seen_lock = threading.Lock()
+        # Server timestamp of this run's registration (boot_at on the device
+        # doc). Commands created before it belong to a previous run.
+        self.server_boot_time = None
+        self._boot_at_written = False
 
         # Load config from Firestore document on boot
         self.load_config_from_firestore()
 
-        # Use config values (from Firestore or defaults)
-        self.polling_rate = agent_config.get('polling_rate', 30)
-        self.sleep_polling_rate = agent_config.get('sleep_polling_rate', 60)
-        self.idle_timeout = agent_config.get('idle_timeout', 60)
+        # Heartbeat, fallback polling and file sync cadence all come from the
+        # scheduler, which tracks activity / viewer presence / link quality.
+        self.scheduler = AdaptiveScheduler(agent_config)
+        # Content search index over the shared folder (+ configured roots),
+        # kept fresh by FileSyncer / API write notifications.
+        self.search_indexer = SearchIndexer(SearchIndex(self.search_roots(), SEARCH_INDEX_PATH))
+        self.file_syncer = FileSyncer(device_id, scheduler=self.scheduler,
+                                      on_file_changed=self.search_indexer.notify)
+        self.archiver = CommandArchiver(device_id, self.doc_ref)
+        # Recurring commands from the 'schedules' config, and their finished
+        # runs waiting to be uploaded.
+        self.schedules = schedule_utils.ScheduleTable()
+        self.schedule_journal = schedule_utils.RunJournal(SCHEDULE_JOURNAL_PATH)
+        self.mode = self.scheduler.tier()
+        # Main-loop timer queue. Periodic tasks ('heartbeat', 'listener_health',
+        # 'mode') each have a deadline; events schedule 'reap' / 'reschedule' at
+        # zero delay to be handled immediately.
+        self.timers = TimerQueue()
+        # Commands wait here until admission control lets them start.
+        self.admission = CommandAdmission(agent_config)
+        self._admission_lock = threading.RLock()
+        self._published_queue_positions = {}  # cmd_id -> last queue_position written
+        self._queue_writes = {}  # cmd_id -> Event set when its in-flight queue write is done
+        self._publish_lock = threading.Lock()
+        self._last_viewer_active = None  # viewer_active as last seen on the device doc
 
         # Subscribe to the device document for config updates. If this throws
         # synchronously (e.g. the network is dead at startup) we want to keep
@@ -612,6 +1397,7 @@ class Agent:
             self.device_watch = self.doc_ref.on_snapshot(self.on_device_update)
         except Exception as e:
             print(f"Failed to subscribe to device config updates (will run with current config): {type(e).__name__}: {e}")
+        self.configure_schedules(save=True)
     
     def load_config_from_firestore(self):
         """Load configuration from Firestore device document on boot.
@@ -636,13 +1422,20 @@ class Agent:
         if doc_snapshot is None:
             print("Could not reach Firestore for config — using defaults; "
                   "live config will apply when the network recovers.")
+            # Scheduled jobs must keep running through an outage.
+            agent_config['schedules'] = schedule_utils.load_cache(SCHEDULES_CACHE_PATH)
             return
 
         try:
             if doc_snapshot.exists:
                 data = doc_snapshot.to_dict()
                 config_keys = ['polling_rate', 'sleep_polling_rate', 'idle_timeout',
-                             'heartbeat_interval', 'max_output_chars']
+                             'deep_sleep_polling_rate', 'deep_idle_timeout',
+                             'heartbeat_interval', 'max_output_chars',
+                             'max_concurrent_commands', 'admission_cpu_threshold',
+                             'admission_memory_threshold', 'command_limits', 'search_roots',
+                             'history_retention_days', 'python_preload', 'schedules',
+                             'compact_output', 'strip_ansi']
 
                 for key in config_keys:
                     if key in data and data[key] is not None:
@@ -662,30 +1455,74 @@ class Agent:
                  data = change.document.to_dict()
                  if data:
                      updated = []
-                     if 'polling_rate' in data:
-                         self.polling_rate = data['polling_rate']
-                         updated.append(f"polling_rate={data['polling_rate']}s")
-                     if 'sleep_polling_rate' in data:
-                         self.sleep_polling_rate = data['sleep_polling_rate']
-                         updated.append(f"sleep_polling_rate={data['sleep_polling_rate']}s")
-                     if 'idle_timeout' in data:
-                         self.idle_timeout = data['idle_timeout']
-                         updated.append(f"idle_timeout={data['idle_timeout']}s")
-                     # Note: heartbeat_interval and max_output_chars only apply to new commands
+                     timing_changed = False
+                     for key in ('polling_rate', 'sleep_polling_rate', 'idle_timeout',
+                                 'deep_sleep_polling_rate', 'deep_idle_timeout'):
+                         if key in data and data[key] is not None and data[key] != agent_config.get(key):
+                             agent_config[key] = data[key]
+                             self.scheduler.configure(**{key: data[key]})
+                             updated.append(f"{key}={data[key]}s")
+                             timing_changed = True
+                     for key in ('max_concurrent_commands', 'admission_cpu_threshold',
+                                 'admission_memory_threshold'):
+                         if key in data and data[key] is not None and data[key] != agent_config.get(key):
+                             agent_config[key] = data[key]
+                             self.admission.configure(**{key: data[key]})
+                             updated.append(f"{key}={data[key]}")
+                             self.timers.schedule('admission', 0)
+                     if 'viewer_active' in data:
+                         self.scheduler.set_viewer_active(data['viewer_active'])
+                         # The agent's own heartbeat writes re-deliver the same value.
+                         if data['viewer_active'] != self._last_viewer_active:
+                             self._last_viewer_active = data['viewer_active']
+                             timing_changed = True
+                     # Note: heartbeat_interval, max_output_chars, compact_output and
+                     # strip_ansi only apply to new commands
                      # They are read from agent_config when CommandExecutor is created
-                     if 'heartbeat_interval' in data:
+                     if 'command_limits' in data and data['command_limits'] != agent_config.get('command_limits'):
+                         agent_config['command_limits'] = data['command_limits'] or {}
+                         updated.append(f"command_limits={data['command_limits']}")
+                     if 'search_roots' in data and data['search_roots'] != agent_config.get('search_roots'):
+                         agent_config['search_roots'] = data['search_roots'] or []
+                         updated.append(f"search_roots={data['search_roots']}")
+                         threading.Thread(
+                             target=lambda: self.search_indexer.index.set_roots(self.search_roots()),
+                             daemon=True,
+                         ).start()
+                     if 'heartbeat_interval' in data and data['heartbeat_interval'] != agent_config.get('heartbeat_interval'):
                          agent_config['heartbeat_interval'] = data['heartbeat_interval']
                          updated.append(f"heartbeat_interval={data['heartbeat_interval']}s")
-                     if 'max_output_chars' in data:
+                     if 'max_output_chars' in data and data['max_output_chars'] != agent_config.get('max_output_chars'):
                          agent_config['max_output_chars'] = data['max_output_chars']
                          updated.append(f"max_output_chars={data['max_output_chars']}")
+                     for key in ('compact_output', 'strip_ansi'):
+                         if key in data and data[key] is not None and data[key] != agent_config.get(key):
+                             agent_config[key] = data[key]
+                             updated.append(f"{key}={data[key]}")
+                     if 'python_preload' in data and data['python_preload'] != agent_config.get('python_preload'):
+                         agent_config['python_preload'] = data['python_preload'] or []
+                         updated.append(f"python_preload={data['python_preload']}")
+                         if python_pool is not None:
+                             python_pool.configure(agent_config['python_preload'])
+                     # Read by the archiver at the start of each pass.
+                     if 'history_retention_days' in data and data['history_retention_days'] != agent_config.get('history_retention_days'):
+                         agent_config['history_retention_days'] = data['history_retention_days']
+                         updated.append(f"history_retention_days={data['history_retention_days']}")
+                     if 'schedules' in data and data['schedules'] != agent_config.get('schedules'):
+                         agent_config['schedules'] = data['schedules'] or {}
+                         updated.append(f"schedules={len(agent_config['schedules'])} entries")
+                         self.configure_schedules(save=True)
                      if updated:
                          print(f"Config updated: {', '.join(updated)}")
+                     # Let the main loop re-derive its deadlines from the new
+                     # intervals / viewer presence right away.
+                     if timing_changed:
+                         self.timers.schedule('reschedule', 0)
 
     def fetch_agent_info(self):
         """Fetches data from the local API with retry logic."""
         def do_fetch():
-            response = requests.get(f"{API_URL}/status", timeout=5)
+            response = api_session.get(f"{API_URL}/status", timeout=5)
             if response.status_code == 200:
                 return response.json()
             raise ConnectionError(f"API returned status {response.status_code}")
@@ -698,52 +1535,108 @@ class Agent:
         )
         return result if result else {}
 
-    def cleanup_stale_commands(self):
-        """Clean up any pending or processing commands from previous runs."""
-        print("Cleaning up stale commands...")
-
-        def build_and_commit():
-            batch = db.batch()
-            commands_ref = self.doc_ref.collection('commands')
+    def is_stale_command(self, cmd_data):
+        """True for commands created before this agent process started.
 
-            processing_docs = list(commands_ref.where(
-                field_path='status', op_string='==', value='processing'
-            ).get())
-            count = 0
-            for doc in processing_docs:
-                batch.update(doc.reference, {
-                    'status': 'completed',
-                    'completed_at': firestore.SERVER_TIMESTAMP,
-                    'output': 'Command interrupted by agent restart.',
-                    'error': 'Agent restarted'
-                })
-                count += 1
-
-            pending_docs = list(commands_ref.where(
-                field_path='status', op_string='==', value='pending'
-            ).get())
-            for doc in pending_docs:
-                batch.update(doc.reference, {
-                    'status': 'cancelled',
-                    'completed_at': firestore.SERVER_TIMESTAMP,
-                    'output': 'Command cancelled by agent restart.',
-                    'error': 'Agent restarted'
-                })
-                count += 1
+        Those belong to a previous run and are resolved by
+        cleanup_stale_commands rather than executed. Both sides are server
+        timestamps, so a wrong local clock can't make new commands look
+        stale; until the boot time is known nothing is treated as stale.
+        """
+        created_at = (cmd_data or {}).get('created_at')
+        boot_time = self.server_boot_time
+        return boot_time is not None and isinstance(created_at, datetime) and created_at < boot_time
 
-            if count > 0:
-                batch.commit()
-                print(f"Cleaned up {count} stale commands.")
+    def cleanup_stale_commands(self):
+        """Resolve pending / queued / processing commands left by previous runs.
 
-        with_retry(
-            build_and_commit,
-            max_retries=5,
-            retry_delay=2.0,
-            max_delay=15.0,
-            operation_name="cleanup stale commands",
-            suppress_final_error=True,
-            should_stop=lambda: not self.running,
+        Pages through each status ordered by document ID and commits one
+        batch per page (well under Firestore's 500-write limit). The page
+        cursor survives failures, so a retry resumes where it stopped rather
+        than starting over. Runs on its own thread in parallel with startup;
+        commands created since boot or owned by this run are left alone.
+        """
+        print("Cleaning up stale commands...")
+        commands_ref = self.doc_ref.collection('commands')
+        resolutions = (
+            ('processing', {
+                'status': 'completed',
+                'output': 'Command interrupted by agent restart.',
+                'error': 'Agent restarted'
+            }),
+            ('pending', {
+                'status': 'cancelled',
+                'output': 'Command cancelled by agent restart.',
+                'error': 'Agent restarted'
+            }),
+            # Commands still waiting in the previous run's admission queue.
+            ('queued', {
+                'status': 'cancelled',
+                'output': 'Command cancelled by agent restart.',
+                'error': 'Agent restarted'
+            }),
         )
+        cursors = {}  # status -> last document processed (the checkpoint)
+        done = set()
+        count = 0
+
+        for attempt in range(CLEANUP_MAX_ATTEMPTS):
+            if not self.running:
+                return
+            try:
+                if self.fetch_boot_time() is None:
+                    raise RuntimeError("boot time not known yet")
+                for status, update in resolutions:
+                    while status not in done:
+                        query = (
+                            commands_ref
+                            .where(field_path='status', op_string='==', value=status)
+                            .order_by('__name__')
+                            .limit(CLEANUP_PAGE_SIZE)
+                        )
+                        if status in cursors:
+                            query = query.start_after(cursors[status])
+                        page = with_retry(
+                            lambda: list(query.get()),
+                            operation_name=f"list stale {status} commands",
+                            should_stop=lambda: not self.running,
+                        )
+                        if page is None:
+                            return
+                        stale = [
+                            doc for doc in page
+                            if doc.id not in self.active_commands
+                            and doc.id not in self.admission
+                            and self.is_stale_command(doc.to_dict())
+                        ]
+                        if stale:
+                            def commit_page(stale=stale, update=update):
+                                batch = db.batch()
+                                for doc in stale:
+                                    batch.update(doc.reference, dict(update, completed_at=firestore.SERVER_TIMESTAMP))
+                                batch.commit()
+                            with_retry(
+                                commit_page,
+                                operation_name=f"resolve stale {status} commands",
+                                should_stop=lambda: not self.running,
+                            )
+                            count += len(stale)
+                        if len(page) < CLEANUP_PAGE_SIZE:
+                            done.add(status)
+                        else:
+                            cursors[status] = page[-1]
+                if count > 0:
+                    print(f"Cleaned up {count} stale commands.")
+                return
+            except Exception as e:
+                delay = min(CLEANUP_RETRY_MAX_DELAY, 5 * (2 ** attempt))
+                print(f"Stale command cleanup interrupted after {count} commands "
+                      f"({type(e).__name__}: {e}); resuming in {delay}s...")
+                for _ in range(delay):
+                    if not self.running:
+                        return
+                    time.sleep(1)
+        print(f"Giving up on stale command cleanup for now ({count} commands resolved).")
 
     def register(self):
         """Register device with retry logic for network failures."""
@@ -762,13 +1655,19 @@ class Agent:
             'polling_rate': agent_config.get('polling_rate', 30),
             'sleep_polling_rate': agent_config.get('sleep_polling_rate', 60),
             'idle_timeout': agent_config.get('idle_timeout', 60),
+            'deep_sleep_polling_rate': agent_config.get('deep_sleep_polling_rate', 240),
+            'deep_idle_timeout': agent_config.get('deep_idle_timeout', 600),
             'heartbeat_interval': agent_config.get('heartbeat_interval', 60),
             'max_output_chars': agent_config.get('max_output_chars', 50000),
-            'allowed_emails': ALLOWED_EMAILS.split(',') if ALLOWED_EMAILS else []
+            'max_concurrent_commands': agent_config.get('max_concurrent_commands', 4),
+            'admission_cpu_threshold': agent_config.get('admission_cpu_threshold', 90),
+            'admission_memory_threshold': agent_config.get('admission_memory_threshold', 90),
+            'allowed_emails': ALLOWED_EMAILS.split(',') if ALLOWED_EMAILS else [],
+            'boot_at': firestore.SERVER_TIMESTAMP,
         }
         
-        with_retry(
-            lambda: self.doc_ref.set(data, merge=True),
+        registered = with_retry(
+            lambda: self.doc_ref.set(data, merge=True) or True,
             max_retries=LONG_MAX_RETRIES,
             retry_delay=2,
             max_delay=LONG_MAX_DELAY,
@@ -777,10 +1676,14 @@ class Agent:
             should_stop=lambda: not self.running,
         )
 
+        self._boot_at_written = registered is not None
+        self.fetch_boot_time()
+
         # Cleanup stale commands regardless of registration outcome — they are
         # leftovers from a previous agent process and we want them resolved
-        # whether or not the initial registration write went through.
-        self.cleanup_stale_commands()
+        # whether or not the initial registration write went through. It runs
+        # in the background so a big backlog doesn't hold up startup.
+        threading.Thread(target=self.cleanup_stale_commands, daemon=True).start()
         print(f"Device {self.device_id} registered.")
 
     def start_watching(self):
@@ -789,6 +1692,7 @@ class Agent:
         print("Starting real-time listener...")
         try:
             commands_ref = self.doc_ref.collection('commands').where(field_path='status', op_string='==', value='pending')
+            self.listener_has_fired = False
             self.watch = commands_ref.on_snapshot(self.on_command_snapshot)
             self.last_listener_event = time.time()
         except Exception as e:
@@ -798,6 +1702,7 @@ class Agent:
             # pulling pending commands in the meantime.
             print(f"Failed to start real-time listener (will retry): {type(e).__name__}: {e}")
             self.watch = None
+            self.timers.schedule('listener_health', LISTENER_RETRY_DELAY)
 
     def stop_watching(self):
         if self.watch:
@@ -808,6 +1713,55 @@ class Agent:
                 print(f"Error unsubscribing listener: {e}")
             self.watch = None
 
+    def start_control_watch(self):
+        """Open the shared listener on processing and queued commands, if it isn't already.
+
+        A failure here only delays kill / output requests until the next
+        listener health check; the commands themselves keep running.
+        """
+        if self.control_watch is not None and getattr(self.control_watch, 'is_active', True):
+            return
+        self.stop_control_watch()
+        try:
+            query = self.doc_ref.collection('commands').where(
+                field_path='status', op_string='in', value=['processing', 'queued'])
+            self.control_watch = query.on_snapshot(self.on_control_snapshot)
+        except Exception as e:
+            print(f"Failed to start command control listener (will retry): {type(e).__name__}: {e}")
+            self.control_watch = None
+            self.timers.schedule('listener_health', LISTENER_RETRY_DELAY)
+
+    def stop_control_watch(self):
+        if self.control_watch:
+            try:
+                self.control_watch.unsubscribe()
+            except Exception as e:
+                print(f"Error unsubscribing command control listener: {e}")
+            self.control_watch = None
+
+    def on_control_snapshot(self, col_snapshot, changes, read_time):
+        """Route kill_signal / output_request changes to the owning executors.
+
+        A kill_signal on a command still waiting in the admission queue
+        cancels it there instead.
+        """
+        updates = []
+        for change in changes:
+            if change.type.name == 'REMOVED':
+                continue
+            executor = self.active_commands.get(change.document.id)
+            if executor is not None:
+                updates.append((executor, change.document))
+            elif (change.document.to_dict() or {}).get('kill_signal') is True:
+                self.cancel_queued_command(change.document.id)
+        # Kills first: they're cheap flag flips, while output requests write
+        # back to Firestore and would otherwise delay them.
+        for executor, doc in updates:
+            if (doc.to_dict() or {}).get('kill_signal') is True:
+                executor.should_stop = True
+        for executor, doc in updates:
+            executor.on_doc_update([doc], None, read_time)
+
     def restart_listener(self):
         """Tear down and re-establish the real-time command listener."""
         self.listener_restart_count += 1
@@ -825,7 +1779,13 @@ class Agent:
         If it hasn't fired in a long time, restart it.
         Also poll for any pending commands as a fallback.
         """
-        # Listener health check: if no event in 5 minutes, restart
+        # Listener health check: restart if it never started, the watch has
+        # shut itself down after an error, or no event in 5 minutes.
+        if self.watch is None or not getattr(self.watch, 'is_active', True):
+            print("Real-time listener is not running — restarting...")
+            self.restart_listener()
+            return
+
         listener_stale_threshold = 5 * 60  # 5 minutes
         time_since_last_event = time.time() - self.last_listener_event
 
@@ -834,23 +1794,101 @@ class Agent:
             self.restart_listener()
             return
 
-        # Fallback poll: directly query for pending commands
-        # This catches anything the listener may have missed
+        if self.active_commands and (self.control_watch is None or not getattr(self.control_watch, 'is_active', True)):
+            print("Command control listener is not running — restarting...")
+            self.start_control_watch()
+
+        # Fallback poll: catches anything the listener may have missed. Once
+        # the listener has proven itself, only poll occasionally.
+        if self.listener_is_healthy() and time.time() - self.last_fallback_poll < FALLBACK_POLL_HEALTHY_INTERVAL:
+            return
         self.poll_pending_commands()
 
+    def listener_is_healthy(self):
+        """True if the command listener is up and has delivered a snapshot recently."""
+        return (
+            self.watch is not None
+            and getattr(self.watch, 'is_active', True)
+            and self.listener_has_fired
+            and time.time() - self.last_listener_event < 5 * 60
+        )
+
+    def fetch_boot_time(self):
+        """Server-side time this run registered, or None while Firestore is unreachable.
+
+        The device clock can't be trusted right after boot (a Pi has no RTC
+        until NTP syncs), so ``boot_at`` is written as a SERVER_TIMESTAMP and
+        read back. Cached once known.
+        """
+        if self.server_boot_time is not None:
+            return self.server_boot_time
+        if not self._boot_at_written:
+            # Registration didn't get through; a boot_at from a previous run
+            # must not be mistaken for ours.
+            written = with_retry(
+                lambda: self.doc_ref.update({'boot_at': firestore.SERVER_TIMESTAMP}) or True,
+                max_retries=2,
+                operation_name="record boot time",
+                suppress_final_error=True,
+                should_stop=lambda: not self.running,
+            )
+            if written is None:
+                return None
+            self._boot_at_written = True
+        snapshot = with_retry(
+            lambda: self.doc_ref.get(field_paths=['boot_at']),
+            max_retries=2,
+            operation_name="read boot time",
+            suppress_final_error=True,
+            should_stop=lambda: not self.running,
+        )
+        boot_at = (snapshot.to_dict() or {}).get('boot_at') if snapshot is not None and snapshot.exists else None
+        if isinstance(boot_at, datetime):
+            self.server_boot_time = boot_at
+        return self.server_boot_time
+
+    def mark_command_seen(self, cmd_id):
+        """Remember a command ID so the fallback poll doesn't start it again."""
+        with self._seen_lock:
+            self.seen_command_ids[cmd_id] = True
+            self.seen_command_ids.move_to_end(cmd_id)
+            while len(self.seen_command_ids) > SEEN_COMMAND_IDS_MAX:
+                self.seen_command_ids.popitem(last=False)
+
     def poll_pending_commands(self):
         """
-        Fallback polling: directly query Firestore for pending commands.
-        Picks up commands the real-time listener may have silently missed.
+        Fallback polling: incrementally query Firestore for commands created
+        after the poll cursor and start any still-pending ones we haven't seen.
+
+        Uses a single-field range on ``created_at`` (no composite index needed)
+        ordered and paged with ``limit``, so each poll only bills reads for new
+        documents rather than every pending doc on every pass.
         """
+        if self.poll_cursor is None:
+            # Server time only: the local clock may be far off until NTP syncs.
+            self.poll_cursor = self.fetch_boot_time()
+            if self.poll_cursor is None:
+                return
+        since = self.poll_cursor - FALLBACK_POLL_OVERLAP
+
         def do_query():
-            return list(
-                self.doc_ref.collection('commands')
-                .where(field_path='status', op_string='==', value='pending')
-                .get()
+            commands_ref = self.doc_ref.collection('commands')
+            query = (
+                commands_ref
+                .where(field_path='created_at', op_string='>', value=since)
+                .order_by('created_at')
+                .limit(FALLBACK_POLL_PAGE_SIZE)
             )
+            docs = []
+            for _ in range(FALLBACK_POLL_MAX_PAGES):
+                page = list(query.get())
+                docs.extend(page)
+                if len(page) < FALLBACK_POLL_PAGE_SIZE:
+                    break
+                query = query.start_after(page[-1])
+            return docs
 
-        pending_docs = with_retry(
+        new_docs = with_retry(
             do_query,
             max_retries=3,
             retry_delay=1.0,
@@ -859,14 +1897,23 @@ class Agent:
             suppress_final_error=True,
             should_stop=lambda: not self.running,
         )
-        if not pending_docs:
+        if new_docs is None:
             return
-        for doc in pending_docs:
+        self.last_fallback_poll = time.time()
+        for doc in new_docs:
             cmd_id = doc.id
-            if cmd_id not in self.active_commands:
-                cmd_data = doc.to_dict()
-                print(f"[poll fallback] Found missed pending command: {cmd_id}")
-                self.start_command(cmd_id, cmd_data)
+            cmd_data = doc.to_dict() or {}
+            already_seen = cmd_id in self.seen_command_ids
+            self.mark_command_seen(cmd_id)
+            created_at = cmd_data.get('created_at')
+            if isinstance(created_at, datetime) and created_at > self.poll_cursor:
+                self.poll_cursor = created_at
+            if already_seen or cmd_id in self.active_commands:
+                continue
+            if cmd_data.get('status') != 'pending':
+                continue
+            print(f"[poll fallback] Found missed pending command: {cmd_id}")
+            self.start_command(cmd_id, cmd_data)
 
     def has_pending_commands(self):
         try:
@@ -888,12 +1935,12 @@ class Agent:
             update_data = {
                 'last_seen': firestore.SERVER_TIMESTAMP,
                 'stats': info.get('stats', {}),
-                'mode': 'active'
+                'mode': self.mode
             }
             if info.get('git'):
                 update_data['git'] = info.get('git')
 
-            with_retry(
+            result = with_retry(
                 lambda: self.doc_ref.update(update_data),
                 max_retries=2,
                 retry_delay=1.0,
@@ -902,54 +1949,393 @@ class Agent:
                 suppress_final_error=True,
                 should_stop=lambda: not self.running,
             )
+            self.scheduler.record_network_result(result is not None)
         except Exception as e:
             print(f"Error preparing heartbeat: {e}")
 
     def start_file_syncer(self):
-        """Start the file syncer if not already running."""
+        """Start the file syncer and the other background threads (search indexer,
+        history archiver) if not already running."""
         if not self.file_syncer.is_alive():
             self.file_syncer.start()
+        if not self.search_indexer.is_alive():
+            self.search_indexer.start()
+        if not self.archiver.is_alive():
+            self.archiver.start()
+
+    def search_roots(self):
+        roots = [SHARED_FOLDER_PATH]
+        extra = agent_config.get('search_roots') or []
+        if isinstance(extra, list):
+            roots += [r for r in extra if isinstance(r, str) and os.path.isdir(r)]
+        return roots
 
     def listen_for_commands(self):
         # Keep the real-time listener open permanently — commands fire instantly via push.
         # Additionally, periodically verify listener health and poll as a fallback,
         # since gRPC-based listeners can silently disconnect after extended periods.
+        #
+        # The loop is event driven: heartbeats, listener health checks and tier
+        # transitions each run on their own deadline from the adaptive scheduler,
+        # while command completion, config changes, listener failures and
+        # shutdown wake it immediately via the timer queue.
         self.start_watching()
         self.start_file_syncer()
 
-        while self.running:
-            finished_ids = [cmd_id for cmd_id, thread in self.active_commands.items() if not thread.is_alive()]
-            for cmd_id in finished_ids:
-                print(f"Command {cmd_id} finished.")
-                del self.active_commands[cmd_id]
+        self.timers.schedule('heartbeat', 0)
+        if not self.timers.is_scheduled('listener_health'):
+            self.timers.schedule('listener_health', 0)
+        self.timers.schedule('mode', 0)
+        self.timers.schedule('schedules', 0)
+        if len(self.schedule_journal):
+            self.timers.schedule('schedule_sync', 0)
 
-            self.send_heartbeat()
-            self.check_listener_health()
-            time.sleep(self.polling_rate)
+        while self.running:
+            due = self.timers.wait()
+            if not self.running:
+                break
+
+            self.reap_finished_commands()
+            if len(self.admission) and ('admission' in due or 'reap' in due):
+                self.drain_command_queue()
+            if 'reap' in due:
+                self.start_queued_schedules()
+            if 'schedules' in due:
+                self.run_due_schedules()
+            if 'schedule_sync' in due:
+                self.sync_schedule_journal()
+
+            if 'reschedule' in due:
+                # Only ever pull deadlines in: pushing them out on every
+                # change could postpone a heartbeat or health check indefinitely.
+                self.timers.schedule('heartbeat', self.scheduler.heartbeat_interval(), earlier_only=True)
+                self.timers.schedule('listener_health', self.scheduler.polling_interval(), earlier_only=True)
+                due.append('mode')
+
+            if 'mode' in due or self.scheduler.tier() != self.mode:
+                self.update_mode()
+
+            if 'heartbeat' in due:
+                self.send_heartbeat()
+                self.timers.schedule('heartbeat', self.scheduler.heartbeat_interval())
+            if 'listener_health' in due:
+                self.check_listener_health()
+                # check_listener_health may already have scheduled a quick retry.
+                if not self.timers.is_scheduled('listener_health'):
+                    self.timers.schedule('listener_health', self.scheduler.polling_interval())
 
         self.file_syncer.stop()
         self.file_syncer.join()
+        self.search_indexer.stop()
+        self.archiver.stop()
+        self.stop_control_watch()
+        if python_pool is not None:
+            python_pool.shutdown()
+        sessions.manager.close_all()
+
+    def stop(self):
+        """Ask the main loop to exit; returns immediately."""
+        self.running = False
+        self.timers.wake()
+
+    def reap_finished_commands(self):
+        finished_ids = [
+            cmd_id for cmd_id, thread in list(self.active_commands.items())
+            if thread.finished or not thread.is_alive()
+        ]
+        for cmd_id in finished_ids:
+            print(f"Command {cmd_id} finished.")
+            del self.active_commands[cmd_id]
+        self.scheduler.set_active_commands(len(self.active_commands))
+
+    def update_mode(self):
+        """Apply a tier change: publish it now and re-derive the periodic deadlines."""
+        tier = self.scheduler.tier()
+        if tier != self.mode:
+            print(f"Agent mode: {self.mode} -> {tier}")
+            self.mode = tier
+            self.timers.schedule('heartbeat', 0)
+            self.timers.schedule('listener_health', self.scheduler.polling_interval())
+        # Re-check when the tier could next change on its own (idle timeouts).
+        until_change = self.scheduler.seconds_until_tier_change()
+        if until_change is not None:
+            self.timers.schedule('mode', until_change + 0.5)
+        else:
+            self.timers.cancel('mode')
+
+    def on_command_finished(self, cmd_id):
+        """Executor completion callback — wakes the main loop to reap it."""
+        self.timers.schedule('reap', 0)
 
     def on_command_snapshot(self, col_snapshot, changes, read_time):
         # Mark that the listener is alive every time it fires (even with no changes)
         self.last_listener_event = time.time()
+        self.listener_has_fired = True
         for change in changes:
             if change.type.name == 'ADDED':
                 self.last_activity_time = time.time()
+                self.scheduler.note_activity()
                 cmd_doc = change.document
                 cmd_data = cmd_doc.to_dict()
                 print(f"Received command: {cmd_data}")
+                self.mark_command_seen(cmd_doc.id)
                 self.start_command(cmd_doc.id, cmd_data)
+            elif change.type.name == 'MODIFIED':
+                # Killed before its 'queued' status was published.
+                if (change.document.to_dict() or {}).get('kill_signal') is True:
+                    self.cancel_queued_command(change.document.id)
 
     def start_command(self, cmd_id, cmd_data):
+        """Queue a command behind admission control and start it when allowed."""
         if cmd_id in self.active_commands:
             print(f"Command {cmd_id} is already running.")
             return
+        if cmd_id in self.admission:
+            return
+        if self.is_stale_command(cmd_data):
+            # Left over from before this agent started; the stale command
+            # cleanup cancels it instead.
+            return
+        self.mark_command_seen(cmd_id)
+
+        # Restarts skip the queue — they must work even when the device is swamped.
+        if (cmd_data or {}).get('type') == 'restart':
+            self.launch_command(cmd_id, cmd_data)
+            return
 
-        executor = CommandExecutor(cmd_id, cmd_data, self.doc_ref)
+        self.admission.push(cmd_id, cmd_data)
+        self.drain_command_queue()
+
+    def drain_command_queue(self):
+        """Start every queued command admission control allows, then publish
+        the remaining queue positions."""
+        with self._admission_lock:
+            admitted, blocked_on = self.admission.admit(len(self.active_commands))
+            for cmd_id, cmd_data in admitted:
+                self._published_queue_positions.pop(cmd_id, None)
+                self.launch_command(cmd_id, cmd_data, after_queue_write=self._queue_writes.get(cmd_id))
+
+        # One publisher at a time, so positions land in order; the writes
+        # themselves happen outside the admission lock. A command admitted
+        # meanwhile waits on `written` before marking itself processing, so a
+        # 'queued' write can never land after its 'processing' one.
+        with self._publish_lock:
+            with self._admission_lock:
+                updates = self.queue_position_updates(self.admission.positions())
+                written = threading.Event()
+                for cmd_id, _ in updates:
+                    self._queue_writes[cmd_id] = written
+            try:
+                self.publish_queue_positions(updates)
+            finally:
+                with self._admission_lock:
+                    for cmd_id, _ in updates:
+                        if self._queue_writes.get(cmd_id) is written:
+                            del self._queue_writes[cmd_id]
+                written.set()
+
+        if blocked_on == 'load':
+            self.timers.schedule('admission', ADMISSION_RETRY_DELAY)
+
+    def queue_position_updates(self, positions):
+        """The (cmd_id, update) writes needed to bring Firestore in line with ``positions``."""
+        updates = []
+        for cmd_id, position in positions.items():
+            previous = self._published_queue_positions.get(cmd_id)
+            if previous == position:
+                continue
+            if previous is not None and position > QUEUE_POSITION_PUBLISH_LIMIT:
+                continue
+            update = {'queue_position': position}
+            if previous is None:
+                update['status'] = 'queued'
+                update['queued_at'] = firestore.SERVER_TIMESTAMP
+            updates.append((cmd_id, update))
+        return updates
+
+    def publish_queue_positions(self, updates):
+        """Mirror the local queue to Firestore as status 'queued' + queue_position."""
+        commands_ref = self.doc_ref.collection('commands')
+        for cmd_id, update in updates:
+            position = update['queue_position']
+            if 'status' in update:
+                print(f"[{cmd_id}] Queued at position {position}")
+            result = with_retry(
+                lambda: commands_ref.document(cmd_id).update(update),
+                max_retries=2,
+                retry_delay=0.5,
+                max_delay=2.0,
+                operation_name="publish queue position",
+                log_prefix=f"[{cmd_id}]",
+                suppress_final_error=True,
+            )
+            if result is not None:
+                with self._admission_lock:
+                    # Not if it was admitted or cancelled while we wrote.
+                    if cmd_id in self.admission:
+                        self._published_queue_positions[cmd_id] = position
+
+    def cancel_queued_command(self, cmd_id):
+        """Drop a command from the admission queue and mark it cancelled."""
+        with self._admission_lock:
+            if not self.admission.remove(cmd_id):
+                return
+            self._published_queue_positions.pop(cmd_id, None)
+            queue_write = self._queue_writes.get(cmd_id)
+        print(f"[{cmd_id}] Cancelled while queued.")
+
+        def write_cancelled():
+            # As for admitted commands: an in-flight 'queued' write must not
+            # land after this one and leave the doc queued forever.
+            if queue_write is not None:
+                queue_write.wait(QUEUE_WRITE_WAIT)
+            with_retry(
+                lambda: self.doc_ref.collection('commands').document(cmd_id).update({
+                    'status': 'cancelled',
+                    'output': 'Command cancelled before it started.',
+                    'queue_position': firestore.DELETE_FIELD,
+                    'completed_at': firestore.SERVER_TIMESTAMP,
+                }),
+                operation_name="mark queued command cancelled",
+                log_prefix=f"[{cmd_id}]",
+                suppress_final_error=True,
+                should_stop=lambda: not self.running,
+            )
+        # Off the listener thread; the rest of the queue moves up a place.
+        threading.Thread(target=write_cancelled, daemon=True).start()
+        self.timers.schedule('admission', 0)
+
+    def launch_command(self, cmd_id, cmd_data, cmd_ref=None, after_queue_write=None):
+        """Start a CommandExecutor right away, bypassing the queue."""
+        executor = CommandExecutor(cmd_id, cmd_data, self.doc_ref, on_finished=self.on_command_finished,
+                                   cmd_ref=cmd_ref)
+        executor.after_queue_write = after_queue_write
         self.active_commands[cmd_id] = executor
+        self.start_control_watch()
+        self.scheduler.set_active_commands(len(self.active_commands))
+        self.timers.schedule('mode', 0)
         executor.start()
 
+    def configure_schedules(self, save=False):
+        """Load agent_config['schedules'] into the schedule table (and cache it on disk)."""
+        specs = agent_config.get('schedules') or {}
+        errors = self.schedules.configure(specs)
+        for name, error in errors.items():
+            print(f"Ignoring schedule '{name}': {error}")
+        if save:
+            try:
+                schedule_utils.save_cache(SCHEDULES_CACHE_PATH, specs)
+            except OSError as e:
+                print(f"Could not cache schedules: {e}")
+        self.timers.schedule('schedules', 0)
+
+    def run_due_schedules(self):
+        """Start every scheduled command that is due, then sleep until the next one."""
+        for sched in self.schedules.due():
+            running = self.running_schedule_runs(sched.name)
+            # Scheduled runs bypass admission, so 'parallel' needs its own bound.
+            at_cap = sched.overlap == 'parallel' and len(running) >= sched.max_parallel
+            if running and (sched.overlap == 'skip' or at_cap):
+                if at_cap:
+                    print(f"Schedule '{sched.name}': {len(running)} runs still going, skipping this one.")
+                else:
+                    print(f"Schedule '{sched.name}': previous run still going, skipping this one.")
+                now = time.time()
+                self.schedule_journal.append({
+                    'id': schedule_utils.run_id(sched.name, now),
+                    'command': sched.cmd_data.get('command'),
+                    'scheduled': sched.name,
+                    'status': 'skipped',
+                    'created_at': now,
+                    'completed_at': now,
+                })
+                self.on_schedule_run_journaled(None)
+            elif running and sched.overlap == 'queue':
+                sched.pending = True
+            else:
+                self.launch_schedule(sched)
+
+        delay = self.schedules.seconds_until_next()
+        if delay is None:
+            self.timers.cancel('schedules')
+        else:
+            self.timers.schedule('schedules', min(delay, SCHEDULE_MAX_SLEEP))
+
+    def running_schedule_runs(self, name):
+        return [cmd_id for cmd_id, executor in list(self.active_commands.items())
+                if executor.cmd_data.get('scheduled') == name and not executor.finished]
+
+    def start_queued_schedules(self):
+        """Start 'queue' runs whose previous run has now finished."""
+        for name in self.schedules.names():
+            sched = self.schedules.get(name)
+            if sched is not None and sched.pending and not self.running_schedule_runs(name):
+                sched.pending = False
+                self.launch_schedule(sched)
+
+    def launch_schedule(self, sched):
+        """Run a schedule through the normal executor, journaling instead of writing a command doc."""
+        now = time.time()
+        run_id = schedule_utils.run_id(sched.name, now)
+        cmd_data = dict(sched.cmd_data, scheduled=sched.name)
+        record = {
+            'command': cmd_data.get('command'),
+            'type': cmd_data.get('type', 'shell'),
+            'scheduled': sched.name,
+            'status': 'pending',
+            'created_at': now,
+        }
+        ref = schedule_utils.JournalRef(
+            run_id, record, self.schedule_journal,
+            server_timestamp=firestore.SERVER_TIMESTAMP,
+            delete_field=firestore.DELETE_FIELD,
+            on_journaled=self.on_schedule_run_journaled,
+        )
+        print(f"Schedule '{sched.name}': starting run {run_id}")
+        self.launch_command(run_id, cmd_data, cmd_ref=ref)
+
+    def on_schedule_run_journaled(self, record):
+        """Batch uploads: the first finished run starts the clock, later ones ride along."""
+        if not self.timers.is_scheduled('schedule_sync'):
+            self.timers.schedule('schedule_sync', SCHEDULE_SYNC_DELAY)
+
+    def sync_schedule_journal(self):
+        """Upload journaled runs as completed command docs, one batch per call.
+
+        The device doc's ``schedule_state`` map gets the latest run per
+        schedule in the same batch. Short retry budget like the heartbeat;
+        on failure the journal is kept and the upload retried later.
+        """
+        records = self.schedule_journal.pending(SCHEDULE_SYNC_BATCH)
+        if not records:
+            return
+        commands_ref = self.doc_ref.collection('commands')
+
+        def do_sync():
+            batch = db.batch()
+            for record in records:
+                batch.set(commands_ref.document(record['id']), schedule_utils.firestore_record(record))
+            batch.update(self.doc_ref, schedule_utils.state_summary(records))
+            batch.commit()
+            return True
+
+        result = with_retry(
+            do_sync,
+            max_retries=2,
+            retry_delay=1.0,
+            max_delay=5.0,
+            operation_name="sync scheduled runs",
+            suppress_final_error=True,
+            should_stop=lambda: not self.running,
+        )
+        if result is None:
+            self.timers.schedule('schedule_sync', SCHEDULE_SYNC_RETRY)
+            return
+        self.schedule_journal.ack(r['id'] for r in records)
+        print(f"Synced {len(records)} scheduled run(s).")
+        if len(self.schedule_journal):
+            self.timers.schedule('schedule_sync', 0)
+
     def run_startup_file(self):
         """Check for and execute the startup file if configured."""
         try:
@@ -987,9 +2373,11 @@ class Agent:
             
             # Determine how to execute based on file extension
             file_ext = os.path.splitext(startup_file)[1].lower()
+            command_type = 'shell'
             
             if file_ext == '.py':
                 command = f"python {startup_path}"
+                command_type = 'python'  # Forked from the warm interpreter
             elif file_ext in ['.sh', '.bash']:
                 command = f"bash {startup_path}"
             elif file_ext in ['.ps1']:
@@ -1008,11 +2396,13 @@ class Agent:
             cmd_id = f"startup_{int(time.time())}"
             cmd_data = {
                 'command': command,
-                'type': 'shell',
+                'type': command_type,
                 'status': 'pending',
                 'created_at': firestore.SERVER_TIMESTAMP,
                 'is_startup': True
             }
+            if command_type == 'python':
+                cmd_data['script'] = startup_path
             
             # Create the document first — best-effort; if it fails the command
             # still runs locally and the next heartbeat / final write will sync.
@@ -1051,6 +2441,9 @@ if __name__ == "__main__":
     time.sleep(2)
     
     agent = Agent(DEVICE_ID)
+    for api_module in ('api', 'agent.api'):
+        if api_module in sys.modules:
+            sys.modules[api_module].search_indexer = agent.search_indexer
     agent.register()
     
     # Start file syncer early so startup files can be synced
@@ -1061,5 +2454,15 @@ if __name__ == "__main__":
     
     # Check for and execute startup file
     agent.run_startup_file()
-    
-    agent.listen_for_commands()
+
+    # Exit the main loop promptly on SIGTERM (e.g. from the launcher) instead
+    # of waiting out the current sleep.
+    try:
+        signal.signal(signal.SIGTERM, lambda signum, frame: agent.stop())
+    except (ValueError, AttributeError):
+        pass
+
+    try:
+        agent.listen_for_commands()
+    except KeyboardInterrupt:
+        agent.stop()
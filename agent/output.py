@@ -0,0 +1,292 @@
+"""
+Server-side queries over a command's in-memory output buffers.
+
+Lets the console find an error line in a long-running command without
+shipping the whole log: only matching lines (plus optional context) are
+returned, over the local API or in answer to a Firestore ``output_request``.
+
+Buffers are lists of ``(timestamp, line)`` tuples that drop their oldest
+lines past the executor's cap, so callers pass ``first_line`` (the absolute
+line number of ``buffer[0]``) to keep reported line numbers stable.
+
+Lines dropped from a buffer aren't lost: they go to an ``OutputSpill`` (a
+gzipped temp file), so the full log can be uploaded to Storage when the
+command finishes.
+
+Before lines reach a buffer, an ``OutputNormalizer`` compacts them. It
+collapses carriage-return progress bars, folds runs of identical lines into
+a count, and can strip ANSI escapes. With compaction off it only strips
+escapes and normalises line endings.
+"""
+import gzip
+import os
+import re
+import tempfile
+import time
+from typing import List, Optional, Sequence, Tuple
+
+MAX_QUERY_MATCHES = 1000
+MAX_CONTEXT_LINES = 20
+MAX_MATCH_LINE = 1000
+
+# Uncompressed characters a spill file may hold; later dropped lines are discarded.
+SPILL_MAX_CHARS = 256 * 1024 * 1024
+# Share of the Firestore output budget given to the head of an overflowed log
+# (the rest goes to the tail).
+PREVIEW_HEAD_FRACTION = 0.25
+# While a progress bar keeps redrawing, or a line keeps repeating, a snapshot /
+# repeat count is written at most this often so the live view still moves.
+COMPACT_SNAPSHOT_INTERVAL = 10.0
+
+# CSI sequences (colours, cursor movement), OSC sequences (window titles,
+# hyperlinks) and the remaining two-character escapes.
+_ANSI_RE = re.compile(r'\x1b\[[0-?]*[ -/]*[@-~]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)|\x1b[@-Z\\-_]')
+
+LEVELS = ('critical', 'error', 'warning', 'info', 'debug')
+_LEVEL_RE = re.compile(r'\b(CRITICAL|FATAL|ERROR|ERR|WARNING|WARN|INFO|DEBUG|TRACE)\b', re.IGNORECASE)
+_LEVEL_ALIASES = {
+    'fatal': 'critical',
+    'err': 'error',
+    'warn': 'warning',
+    'trace': 'debug',
+}
+
+
+def line_level(line: str) -> Optional[str]:
+    """First log-level token in the line, normalised to one of LEVELS."""
+    m = _LEVEL_RE.search(line)
+    if not m:
+        return None
+    level = m.group(1).lower()
+    return _LEVEL_ALIASES.get(level, level)
+
+
+def parse_query(query: dict) -> dict:
+    """Validate a query dict (from the API or an ``output_request``). Raises ValueError."""
+    if not isinstance(query, dict):
+        raise ValueError("query must be a map")
+    pattern = query.get('pattern') or ''
+    regex = bool(query.get('regex', False))
+    case_sensitive = bool(query.get('case_sensitive', False))
+    levels = query.get('levels') or []
+    if isinstance(levels, str):
+        levels = [levels]
+    levels = {_LEVEL_ALIASES.get(str(l).lower(), str(l).lower()) for l in levels}
+    unknown = levels - set(LEVELS)
+    if unknown:
+        raise ValueError(f"Unknown level(s): {', '.join(sorted(unknown))}")
+    if not pattern and not levels:
+        raise ValueError("query needs a pattern or levels")
+    stream = query.get('stream', 'both')
+    if stream not in ('stdout', 'stderr', 'both'):
+        raise ValueError("stream must be stdout, stderr or both")
+    try:
+        matcher = re.compile(pattern if regex else re.escape(pattern),
+                             0 if case_sensitive else re.IGNORECASE) if pattern else None
+    except re.error as e:
+        raise ValueError(f"Invalid regex: {e}")
+    return {
+        'matcher': matcher,
+        'levels': levels,
+        'stream': stream,
+        'context': max(0, min(int(query.get('context', 0) or 0), MAX_CONTEXT_LINES)),
+        'max_matches': max(1, min(int(query.get('max_matches', 100) or 100), MAX_QUERY_MATCHES)),
+        'from_end': bool(query.get('last', False)),
+    }
+
+
+def _line_matches(line: str, parsed: dict) -> bool:
+    if parsed['matcher'] is not None and not parsed['matcher'].search(line):
+        return False
+    if parsed['levels'] and line_level(line) not in parsed['levels']:
+        return False
+    return True
+
+
+def query_buffer(buffer: Sequence[Tuple[float, str]], first_line: int, stream: str, parsed: dict) -> dict:
+    """Run a parsed query over one buffer.
+
+    Returns ``{'matches': [...], 'total_matches': N}``. Each match carries its
+    absolute ``line`` number, ``timestamp`` and ``text`` plus ``before`` /
+    ``after`` context lists. With ``last`` the *last* ``max_matches`` matches are
+    kept instead of the first; either way matches come back in output order.
+    """
+    lines = list(buffer)  # Snapshot: the reader thread keeps appending
+    limit = parsed['max_matches']
+    context = parsed['context']
+    hits: List[int] = []
+    total = 0
+    order = range(len(lines) - 1, -1, -1) if parsed['from_end'] else range(len(lines))
+    for i in order:
+        if _line_matches(lines[i][1], parsed):
+            total += 1
+            if len(hits) < limit:
+                hits.append(i)
+    hits.sort()
+
+    matches = []
+    for i in hits:
+        ts, text = lines[i]
+        matches.append({
+            'stream': stream,
+            'line': first_line + i,
+            'timestamp': ts,
+            'text': text.rstrip('\n')[:MAX_MATCH_LINE],
+            'before': [l.rstrip('\n')[:MAX_MATCH_LINE] for _, l in lines[max(0, i - context):i]],
+            'after': [l.rstrip('\n')[:MAX_MATCH_LINE] for _, l in lines[i + 1:i + 1 + context]],
+        })
+    return {'matches': matches, 'total_matches': total}
+
+
+class OutputSpill:
+    """Gzipped temp file holding the lines a command's buffer has dropped.
+
+    Not thread-safe; the executor calls it under its output lock.
+    """
+
+    def __init__(self, cmd_id: str, stream: str, head_chars: int):
+        fd, self.path = tempfile.mkstemp(prefix=f"dpf-{cmd_id}-{stream}-", suffix='.log.gz')
+        os.close(fd)
+        self._file = gzip.open(self.path, 'wt', encoding='utf-8', compresslevel=6)
+        self.head_chars = head_chars
+        self.head = ''      # First head_chars characters, for the preview
+        self.chars = 0      # Characters written
+        self.lines = 0
+        self.discarded = 0  # Lines dropped after hitting SPILL_MAX_CHARS
+
+    def write(self, line: str):
+        if self._file is None or self.chars >= SPILL_MAX_CHARS:
+            self.discarded += 1
+            return
+        if len(self.head) < self.head_chars:
+            self.head += line[:self.head_chars - len(self.head)]
+        self._file.write(line)
+        self.chars += len(line)
+        self.lines += 1
+
+    def finish(self, tail_lines: Sequence[str]) -> str:
+        """Append the still-buffered lines, close, and return the gzip path."""
+        if self._file is not None:
+            if self.discarded:
+                self._file.write(f"... ({self.discarded} lines discarded: spill limit reached)\n")
+            for line in tail_lines:
+                self._file.write(line)
+            self._file.close()
+            self._file = None
+        return self.path
+
+    def cleanup(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def preview(head: str, tail: str, total_chars: int, budget: int) -> str:
+    """Head + tail of an overflowed log that fits in ``budget`` characters."""
+    head_budget = int(budget * PREVIEW_HEAD_FRACTION)
+    head = head[:head_budget]
+    tail = tail[-(budget - len(head)):] if budget > len(head) else ''
+    omitted = max(0, total_chars - len(head) - len(tail))
+    return f"{head}\n... ({omitted} characters omitted; full output in Storage) ...\n{tail}"
+
+
+def strip_ansi(text: str) -> str:
+    return _ANSI_RE.sub('', text)
+
+
+class OutputNormalizer:
+    """Compacts one stream's lines on their way into the executor's buffer.
+
+    Expects lines read with ``newline=''``, so a carriage-return redraw arrives
+    as a line ending in ``\\r``. Only the latest redraw is kept; it is written
+    once the bar finishes (or at most every ``interval`` seconds while it
+    runs). A run of identical lines keeps the first one, followed by a
+    "repeated N more times" line. Output is append-only: nothing already
+    handed out is rewritten, so line cursors stay valid.
+
+    With ``compact`` off every line passes through, with ``\r\n`` / ``\r``
+    endings turned into ``\n`` as universal newlines would.
+    """
+
+    def __init__(self, strip_escapes: bool = False, interval: float = COMPACT_SNAPSHOT_INTERVAL,
+                 compact: bool = True):
+        self.compact = compact
+        self.strip_escapes = strip_escapes
+        self.interval = interval
+        self.collapsed = 0          # Input lines that didn't become output lines
+        self._progress = None       # Latest redraw not yet written
+        self._progress_at = 0.0     # When a redraw snapshot was last written
+        self._last = None           # Last line written
+        self._repeats = 0           # Copies of _last swallowed since it was written
+        self._repeats_at = 0.0
+
+    def feed(self, line: str, now: Optional[float] = None) -> List[str]:
+        """Lines to append for one line read from the pipe (often none)."""
+        now = time.time() if now is None else now
+        if self.strip_escapes:
+            line = _ANSI_RE.sub('', line)
+        if line.endswith('\r\n'):
+            line = line[:-2] + '\n'
+        if not self.compact:
+            return [line[:-1] + '\n' if line.endswith('\r') else line]
+
+        if line.endswith('\r'):
+            self._progress = line[:-1]
+            if now - self._progress_at >= self.interval:
+                self._progress_at = now
+                return self._emit(self._progress + '\n', now)
+            self.collapsed += 1
+            return []
+
+        if self._progress is not None:
+            # A bare newline ends the bar on its last redraw; anything else
+            # overwrites it.
+            final = self._progress + '\n' if line == '\n' else line
+            self._progress = None
+            self._progress_at = 0.0
+            if final == self._last:
+                self.collapsed += 1
+                return []
+            return self._emit(final, now)
+
+        return self._emit(line, now)
+
+    def flush(self) -> List[str]:
+        """Whatever is still held back, at end of stream."""
+        out = []
+        if self._progress is not None:
+            final = self._progress + '\n'
+            self._progress = None
+            if final != self._last:
+                out += self._emit(final, time.time())
+        return out + self._repeat_line()
+
+    def _emit(self, line: str, now: float) -> List[str]:
+        if line == self._last:
+            self._repeats += 1
+            self.collapsed += 1
+            if now - self._repeats_at >= self.interval:
+                self._repeats_at = now
+                return self._repeat_line()
+            return []
+        out = self._repeat_line()
+        self._last = line
+        self._repeats_at = now
+        out.append(line)
+        return out
+
+    def _repeat_line(self) -> List[str]:
+        if not self._repeats:
+            return []
+        n, self._repeats = self._repeats, 0
+        self.collapsed -= 1  # The marker is an output line too
+        if n == 1:
+            return [self._last]  # A marker would be no shorter
+        return [f"... (previous line repeated {n} more times)\n"]
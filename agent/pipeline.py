@@ -0,0 +1,197 @@
+"""
+DAG pipelines for the ``pipeline`` command type.
+
+A pipeline command carries a list of shell steps instead of one command::
+
+    {type: "pipeline", max_parallel: 2, steps: [
+        {name: "fetch", command: "git pull"},
+        {name: "build", command: "make", needs: ["fetch"], timeout: 600},
+        {name: "lint",  command: "make lint", needs: ["fetch"], on_failure: "ignore"},
+        {name: "test",  command: "make test", needs: ["build"]},
+    ]}
+
+Steps whose ``needs`` have all succeeded start right away, up to
+``max_parallel`` at once, so independent branches run side by side. A step
+that fails or exceeds its ``timeout`` (seconds) is handled by its
+``on_failure`` policy:
+
+ - ``stop`` (default): start nothing new; steps already running finish.
+ - ``continue``: skip the steps that depend on it; other branches go on.
+ - ``ignore``: treat it as a success for its dependents.
+
+``PipelineRun`` is only the bookkeeping; the executor owns the processes
+and reports ``status()`` as the command doc's ``steps`` list.
+"""
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+FAILURE_POLICIES = ('stop', 'continue', 'ignore')
+MAX_STEPS = 100
+DEFAULT_MAX_PARALLEL = 4
+MAX_PARALLEL = 16
+
+_NAME_RE = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+
+class Step:
+    def __init__(self, index: int, spec: dict):
+        if not isinstance(spec, dict):
+            raise ValueError(f"Step {index + 1} must be a map")
+        self.name = str(spec.get('name') or f"step{index + 1}")
+        if not _NAME_RE.match(self.name):
+            raise ValueError(f"Bad step name '{self.name}'")
+        self.command = spec.get('command')
+        if not self.command or not isinstance(self.command, str):
+            raise ValueError(f"Step '{self.name}' needs a 'command'")
+        needs = spec.get('needs') or []
+        self.needs = [needs] if isinstance(needs, str) else [str(n) for n in needs]
+        self.timeout = float(spec['timeout']) if spec.get('timeout') else None
+        self.on_failure = spec.get('on_failure') or 'stop'
+        if self.on_failure not in FAILURE_POLICIES:
+            raise ValueError(f"Step '{self.name}': on_failure must be one of {', '.join(FAILURE_POLICIES)}")
+        self.env = {str(k): str(v) for k, v in (spec.get('env') or {}).items()}
+        self.cwd = spec.get('cwd')
+        self.status = 'pending'
+        self.return_code = None
+        self.started_at = None
+        self.finished_at = None
+        self.resources = None
+
+    @property
+    def ok(self) -> bool:
+        """Whether dependents may run after this step."""
+        if self.status == 'succeeded':
+            return True
+        return self.status in ('failed', 'timed_out') and self.on_failure == 'ignore'
+
+    def to_status(self) -> dict:
+        status = {'name': self.name, 'status': self.status}
+        if self.return_code is not None:
+            status['return_code'] = self.return_code
+        if self.started_at is not None:
+            status['duration'] = round((self.finished_at or time.time()) - self.started_at, 2)
+        if self.resources:
+            status['cpu_seconds'] = self.resources.get('cpu_seconds')
+            status['peak_rss_bytes'] = self.resources.get('peak_rss_bytes')
+        return status
+
+
+def parse_pipeline(cmd_data: dict):
+    """Validate a pipeline command. Returns ``(steps, max_parallel)``; raises ValueError."""
+    specs = cmd_data.get('steps')
+    if not isinstance(specs, list) or not specs:
+        raise ValueError("A pipeline needs a non-empty 'steps' list")
+    if len(specs) > MAX_STEPS:
+        raise ValueError(f"At most {MAX_STEPS} steps per pipeline")
+    steps: Dict[str, Step] = OrderedDict()
+    for i, spec in enumerate(specs):
+        step = Step(i, spec)
+        if step.name in steps:
+            raise ValueError(f"Duplicate step name '{step.name}'")
+        steps[step.name] = step
+    for step in steps.values():
+        for need in step.needs:
+            if need not in steps:
+                raise ValueError(f"Step '{step.name}' needs unknown step '{need}'")
+
+    # Kahn's algorithm: anything left over is on a cycle.
+    indegree = {name: len(set(step.needs)) for name, step in steps.items()}
+    ready = [name for name, n in indegree.items() if n == 0]
+    seen = 0
+    while ready:
+        name = ready.pop()
+        seen += 1
+        for other in steps.values():
+            if name in other.needs:
+                indegree[other.name] -= 1
+                if indegree[other.name] == 0:
+                    ready.append(other.name)
+    if seen != len(steps):
+        cyclic = sorted(name for name, n in indegree.items() if n > 0)
+        raise ValueError(f"Pipeline has a dependency cycle through: {', '.join(cyclic)}")
+
+    max_parallel = int(cmd_data.get('max_parallel') or DEFAULT_MAX_PARALLEL)
+    return steps, max(1, min(max_parallel, MAX_PARALLEL))
+
+
+class PipelineRun:
+    """Which steps may start, and what a finished step means for the rest."""
+
+    def __init__(self, steps: Dict[str, Step], max_parallel: int = DEFAULT_MAX_PARALLEL):
+        self.steps = steps
+        self.max_parallel = max_parallel
+        self.stopping = False
+
+    def running(self) -> List[Step]:
+        return [s for s in self.steps.values() if s.status == 'running']
+
+    def ready(self) -> List[Step]:
+        """Pending steps whose dependencies are satisfied, up to the parallel limit."""
+        if self.stopping:
+            return []
+        slots = self.max_parallel - len(self.running())
+        ready = []
+        for step in self.steps.values():
+            if len(ready) >= slots:
+                break
+            if step.status == 'pending' and all(self.steps[n].ok for n in step.needs):
+                ready.append(step)
+        return ready
+
+    def start(self, step: Step):
+        step.status = 'running'
+        step.started_at = time.time()
+
+    def finish(self, step: Step, return_code: Optional[int], timed_out: bool = False,
+               resources: Optional[dict] = None):
+        step.return_code = return_code
+        step.finished_at = time.time()
+        step.resources = resources
+        if timed_out:
+            step.status = 'timed_out'
+        else:
+            step.status = 'succeeded' if return_code == 0 else 'failed'
+        if step.ok:
+            return
+        if step.on_failure == 'stop':
+            self.stopping = True
+            self.cancel_pending('skipped')
+        else:
+            self._skip_dependents()
+
+    def _skip_dependents(self):
+        # Repeat until stable: skipping a step can strand its own dependents.
+        changed = True
+        while changed:
+            changed = False
+            for step in self.steps.values():
+                if step.status != 'pending':
+                    continue
+                blockers = [self.steps[n] for n in step.needs]
+                if any(b.status in ('failed', 'timed_out', 'skipped', 'cancelled') and not b.ok for b in blockers):
+                    step.status = 'skipped'
+                    changed = True
+
+    def cancel_pending(self, status: str = 'cancelled'):
+        for step in self.steps.values():
+            if step.status == 'pending':
+                step.status = status
+
+    def done(self) -> bool:
+        return all(s.status not in ('pending', 'running') for s in self.steps.values())
+
+    def return_code(self) -> int:
+        """0 if every step succeeded (or failed with ``ignore``), else the first failure's code."""
+        for step in self.steps.values():
+            if step.ok:
+                continue
+            if step.status in ('failed', 'timed_out'):
+                return step.return_code if step.return_code else 1
+        if any(s.status in ('skipped', 'cancelled') for s in self.steps.values()):
+            return 1
+        return 0
+
+    def status(self) -> List[dict]:
+        return [s.to_status() for s in self.steps.values()]
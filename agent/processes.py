@@ -0,0 +1,224 @@
+"""
+Cached process table for the local API.
+
+``psutil.Process.cpu_percent()`` with no interval compares against the
+previous call on the *same* Process object, so a fresh ``process_iter`` on
+every request reports 0.0 for nearly everything. ``ProcessTable`` instead runs
+a sampler thread that walks the process list on a cadence, keeps each
+process's previous CPU time keyed by ``(pid, create_time)`` (so a recycled PID
+doesn't inherit someone else's counter) and turns the delta into a real CPU%.
+
+Requests read the cached snapshot, so listing processes costs a sort and a
+filter rather than a walk of /proc. The sampler only runs while somebody is
+looking: it starts on the first read and stops after ``idle_timeout`` seconds
+without one.
+"""
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+import psutil
+
+DEFAULT_INTERVAL = 2.0
+DEFAULT_IDLE_TIMEOUT = 120.0
+# Gap between the two walks on a cold start so the first response already
+# has CPU deltas to show.
+PRIMING_INTERVAL = 0.5
+
+_ATTRS = ['pid', 'ppid', 'name', 'username', 'status', 'create_time',
+          'cpu_times', 'memory_info', 'num_threads', 'cmdline']
+
+SORT_KEYS = {
+    'cpu': lambda p: p['cpu_percent'],
+    'memory': lambda p: p['rss_bytes'],
+    'pid': lambda p: p['pid'],
+    'name': lambda p: (p['name'] or '').lower(),
+    'threads': lambda p: p['num_threads'],
+    'started': lambda p: p['create_time'],
+}
+
+
+class ProcessTable:
+    """Background-refreshed snapshot of all processes with accurate CPU%. Thread-safe."""
+
+    def __init__(self, interval: float = DEFAULT_INTERVAL, idle_timeout: float = DEFAULT_IDLE_TIMEOUT):
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._cpu_seen: Dict[tuple, tuple] = {}  # (pid, create_time) -> (cpu seconds, wall time)
+        self._snapshot: List[dict] = []
+        self.sampled_at = 0.0
+        self._last_read = 0.0
+        self._thread: Optional[threading.Thread] = None
+        self._wake = threading.Event()
+        self._ready = threading.Event()  # Set once a primed snapshot exists
+        self._cpu_count = psutil.cpu_count() or 1
+        self._total_memory = psutil.virtual_memory().total or 1
+
+    def _sample(self):
+        now = time.time()
+        seen = {}
+        procs = []
+        for proc in psutil.process_iter(_ATTRS):
+            info = proc.info
+            times = info.get('cpu_times')
+            mem = info.get('memory_info')
+            key = (info['pid'], info.get('create_time'))
+            cpu_percent = 0.0
+            if times is not None:
+                cpu = times.user + times.system
+                prev = self._cpu_seen.get(key)
+                if prev and now > prev[1]:
+                    cpu_percent = max(0.0, (cpu - prev[0]) / (now - prev[1]) * 100)
+                seen[key] = (cpu, now)
+            rss = mem.rss if mem is not None else 0
+            cmdline = info.get('cmdline') or []
+            procs.append({
+                'pid': info['pid'],
+                'ppid': info.get('ppid'),
+                'name': info.get('name'),
+                'username': info.get('username'),
+                'status': info.get('status'),
+                'create_time': info.get('create_time') or 0,
+                # Like top: 100% is one full core, so a busy multi-threaded
+                # process can exceed 100.
+                'cpu_percent': round(cpu_percent, 1),
+                'memory_percent': round(rss / self._total_memory * 100, 2),
+                'rss_bytes': rss,
+                'num_threads': info.get('num_threads') or 0,
+                'cmdline': ' '.join(cmdline)[:300],
+            })
+        with self._lock:
+            # Dropping keys we didn't see this round forgets exited processes.
+            self._cpu_seen = seen
+            self._snapshot = procs
+            self.sampled_at = now
+
+    def _run(self):
+        # snapshot() has just sampled, so wait out one interval first.
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            with self._lock:
+                if time.time() - self._last_read > self.idle_timeout:
+                    self._thread = None
+                    return
+            try:
+                self._sample()
+            except Exception as e:
+                print(f"Error sampling processes: {type(e).__name__}: {e}")
+
+    def snapshot(self) -> List[dict]:
+        """Current table, starting (and priming) the sampler if it isn't running."""
+        with self._lock:
+            self._last_read = time.time()
+            running = self._thread is not None
+            if not running:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+        if not running:
+            if time.time() - self.sampled_at > self.interval:
+                self._ready.clear()
+                self._sample()
+                time.sleep(PRIMING_INTERVAL)
+                self._sample()
+            self._ready.set()
+            self._thread.start()
+        else:
+            # Another request is priming a cold table; wait for it rather
+            # than returning an empty or CPU-less snapshot.
+            self._ready.wait(timeout=5)
+        with self._lock:
+            return list(self._snapshot)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'sampled_at': self.sampled_at,
+                'interval': self.interval,
+                'cpu_count': self._cpu_count,
+            }
+
+
+def current_username() -> Optional[str]:
+    try:
+        return psutil.Process(os.getpid()).username()
+    except Exception:
+        return None
+
+
+def filter_processes(procs: List[dict], user: Optional[str] = None, name: Optional[str] = None,
+                     status: Optional[str] = None, min_cpu: float = 0.0,
+                     min_rss_bytes: int = 0) -> List[dict]:
+    name = name.lower() if name else None
+    out = []
+    for p in procs:
+        if user and p['username'] != user:
+            continue
+        if name and name not in (p['name'] or '').lower() and name not in p['cmdline'].lower():
+            continue
+        if status and p['status'] != status:
+            continue
+        if p['cpu_percent'] < min_cpu or p['rss_bytes'] < min_rss_bytes:
+            continue
+        out.append(p)
+    return out
+
+
+def sort_processes(procs: List[dict], sort: str = 'cpu', descending: bool = True) -> List[dict]:
+    return sorted(procs, key=SORT_KEYS.get(sort, SORT_KEYS['cpu']), reverse=descending)
+
+
+def build_tree(procs: List[dict], root_pid: Optional[int] = None) -> List[dict]:
+    """Nest processes under their parents, adding subtree totals.
+
+    Each node gets ``children`` plus ``tree_cpu_percent`` / ``tree_rss_bytes`` /
+    ``tree_processes`` covering itself and all descendants, so a shell that
+    spawned a busy build shows up as the hog. Processes whose parent isn't in
+    ``procs`` become roots. With ``root_pid`` only that process's subtree is
+    returned.
+    """
+    nodes = {p['pid']: dict(p, children=[]) for p in procs}
+    roots = []
+    for node in nodes.values():
+        parent = nodes.get(node['ppid'])
+        if parent is not None and parent is not node:
+            parent['children'].append(node)
+        else:
+            roots.append(node)
+
+    def total(node):
+        # Iterative post-order walk; process trees can be deep enough to hit
+        # the recursion limit.
+        stack = [(node, False)]
+        while stack:
+            current, expanded = stack.pop()
+            if not expanded:
+                stack.append((current, True))
+                stack.extend((child, False) for child in current['children'])
+                continue
+            current['tree_cpu_percent'] = round(
+                current['cpu_percent'] + sum(c['tree_cpu_percent'] for c in current['children']), 1)
+            current['tree_rss_bytes'] = current['rss_bytes'] + sum(c['tree_rss_bytes'] for c in current['children'])
+            current['tree_processes'] = 1 + sum(c['tree_processes'] for c in current['children'])
+
+    for root in roots:
+        total(root)
+    if root_pid is not None:
+        return [nodes[root_pid]] if root_pid in nodes else []
+    return roots
+
+
+def sort_tree(nodes: List[dict], sort: str = 'cpu', descending: bool = True) -> List[dict]:
+    """Sort siblings at every level, using subtree totals for cpu / memory."""
+    tree_keys = {
+        'cpu': lambda n: n['tree_cpu_percent'],
+        'memory': lambda n: n['tree_rss_bytes'],
+    }
+    key = tree_keys.get(sort) or SORT_KEYS.get(sort, SORT_KEYS['cpu'])
+    stack = [nodes]
+    while stack:
+        level = stack.pop()
+        level.sort(key=key, reverse=descending)
+        stack.extend(n['children'] for n in level if n['children'])
+    return nodes
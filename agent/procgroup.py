@@ -0,0 +1,124 @@
+"""
+Process-group management for command subprocesses.
+
+Commands run through ``/bin/sh`` (``shell=True``), so signalling only the Popen
+handle hits the shell wrapper and leaves pipelines, ``make -j`` workers or
+background servers running — still holding CPU, memory and the stdout pipe, so
+the reader threads never see EOF. Instead each command is started in its own
+session / process group, and cancellation escalates SIGTERM -> SIGKILL across
+the whole group plus any descendants that moved to a group of their own.
+
+On Windows the command gets a new process group and the tree is walked with
+psutil instead.
+"""
+import os
+import signal
+import subprocess
+import time
+
+import psutil
+
+IS_POSIX = os.name == 'posix'
+DEFAULT_GRACE = 5.0
+
+
+def popen_group_kwargs() -> dict:
+    """Extra ``Popen`` kwargs that put the command in its own process group."""
+    if IS_POSIX:
+        return {'start_new_session': True}
+    return {'creationflags': getattr(subprocess, 'CREATE_NEW_PROCESS_GROUP', 0)}
+
+
+def _descendants(pid):
+    try:
+        return psutil.Process(pid).children(recursive=True)
+    except (psutil.NoSuchProcess, psutil.AccessDenied):
+        return []
+
+
+def _signal_group(pgid, sig) -> bool:
+    """Send ``sig`` to a process group; False if the group no longer exists."""
+    try:
+        os.killpg(pgid, sig)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # Someone in the group changed uid; treat as still alive
+
+
+def _group_alive(pgid) -> bool:
+    return _signal_group(pgid, 0)
+
+
+def _signal_procs(procs, kill=False):
+    for proc in procs:
+        try:
+            proc.kill() if kill else proc.terminate()
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+
+
+def _wait_group(pgid, deadline) -> bool:
+    """Wait until the group is empty or the deadline passes. True if it emptied."""
+    while time.time() < deadline:
+        if not _group_alive(pgid):
+            return True
+        time.sleep(0.1)
+    return not _group_alive(pgid)
+
+
+def terminate_process_tree(process: subprocess.Popen, grace: float = DEFAULT_GRACE):
+    """SIGTERM the command's whole group / tree, then SIGKILL whatever is left after ``grace``."""
+    # Snapshot descendants before signalling: once the shell dies its children
+    # are reparented and can no longer be found through it.
+    descendants = _descendants(process.pid)
+    deadline = time.time() + grace
+
+    if IS_POSIX:
+        pgid = process.pid  # start_new_session makes the shell a group leader
+        _signal_group(pgid, signal.SIGTERM)
+        _signal_procs(descendants)
+        try:
+            process.wait(timeout=max(0.0, deadline - time.time()))
+        except subprocess.TimeoutExpired:
+            pass
+        _wait_group(pgid, deadline)
+        _, alive = psutil.wait_procs(descendants, timeout=max(0.0, deadline - time.time()))
+        _signal_group(pgid, signal.SIGKILL)
+        _signal_procs(alive, kill=True)
+    else:
+        _signal_procs(descendants)
+        try:
+            process.terminate()
+        except OSError:
+            pass
+        _, alive = psutil.wait_procs(descendants, timeout=grace)
+        _signal_procs(alive, kill=True)
+
+    if process.poll() is None:
+        try:
+            process.kill()
+        except OSError:
+            pass
+    try:
+        process.wait(timeout=1)
+    except subprocess.TimeoutExpired:
+        pass
+
+
+def reap_orphans(process: subprocess.Popen, grace: float = DEFAULT_GRACE) -> bool:
+    """After the shell exits, terminate anything it left running in its group.
+
+    Returns True if there were leftovers. POSIX only; on Windows orphans can't be
+    found once their parent has gone, so this is a no-op.
+    """
+    if not IS_POSIX or process.poll() is None:
+        return False
+    pgid = process.pid
+    if not _group_alive(pgid):
+        return False
+    _signal_group(pgid, signal.SIGTERM)
+    if not _wait_group(pgid, time.time() + grace):
+        _signal_group(pgid, signal.SIGKILL)
+    return True
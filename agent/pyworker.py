@@ -0,0 +1,429 @@
+"""
+Warm Python interpreters for ``python`` commands.
+
+Starting a Python script from scratch costs interpreter startup plus every
+heavy import, which is seconds on a Pi. Instead the agent keeps a warm parent
+interpreter (the "zygote") that has already imported the configured
+``python_preload`` modules. Each job is a fresh ``os.fork()`` of it, so jobs are
+still isolated from each other and from the parent but start in milliseconds.
+
+The agent and the zygote talk over a Unix socket pair: the agent sends a
+newline-delimited JSON job together with the write ends of two pipes
+(``SCM_RIGHTS``), the forked child points fd 1 / 2 at them, and the agent
+reads the read ends through the normal CommandExecutor buffer machinery. The
+zygote reports ``ready`` once its preloads are imported (no job is sent
+before that), then each child's PID and, once it has reaped it, its exit code.
+
+Only a ``SpawnError`` means the job definitely did not start, so a caller may
+run it some other way. Any other failure after the job was sent leaves its
+fate unknown and must not be retried.
+
+The child calls ``setsid()``, so procgroup's whole-group termination works
+on it as on any shell command. POSIX only (``socket.send_fds``, Python
+3.9+); callers fall back to a plain subprocess elsewhere.
+"""
+import importlib
+import itertools
+import json
+import os
+import select
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import traceback
+from typing import Dict, List, Optional
+
+MAX_MESSAGE = 65536
+# How long a ready zygote gets to confirm it forked a job before the job is
+# abandoned and the zygote retired. Preloading isn't covered; that can take minutes.
+SPAWN_TIMEOUT = 10.0
+
+
+class SpawnError(RuntimeError):
+    """The warm interpreter did not start the job, and never will."""
+
+
+def pool_supported() -> bool:
+    return os.name == 'posix' and hasattr(socket, 'send_fds') and hasattr(os, 'fork')
+
+
+def _send(sock, msg: dict):
+    sock.sendall(json.dumps(msg).encode('utf-8') + b'\n')
+
+
+class WarmProcess:
+    """``Popen``-like handle for a job forked by the zygote."""
+
+    def __init__(self, job_id: int, stdout_fd: int, stderr_fd: int):
+        self.job_id = job_id
+        self.pid = None
+        self.returncode = None
+        self.error = None
+        self.abandoned = False  # Gave up waiting for the fork; kill it if it turns up
+        self.stdout = os.fdopen(stdout_fd, 'r', encoding='utf-8', errors='replace')
+        self.stderr = os.fdopen(stderr_fd, 'r', encoding='utf-8', errors='replace')
+        self._started = threading.Event()
+        self._exited = threading.Event()
+
+    def _on_started(self, pid: Optional[int], error: Optional[str] = None):
+        self.pid = pid
+        self.error = error
+        self._started.set()
+
+    def _on_exit(self, returncode: int):
+        self.returncode = returncode
+        self._started.set()
+        self._exited.set()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if not self._exited.wait(timeout):
+            raise subprocess.TimeoutExpired(f"python job {self.job_id}", timeout)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None and self.pid:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class _Zygote:
+    """One warm parent interpreter and the jobs it has forked."""
+
+    def __init__(self, python: str, preload: List[str]):
+        self._sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.process = subprocess.Popen(
+                [python, '-u', os.path.abspath(__file__), '--zygote',
+                 str(child_sock.fileno()), json.dumps(preload)],
+                pass_fds=[child_sock.fileno()],
+                stdin=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        finally:
+            child_sock.close()
+        self.retiring = False
+        self._ready = threading.Event()  # Set on 'ready', or when the link closes
+        self._link_open = True
+        self._jobs: Dict[int, WarmProcess] = {}
+        self._jobs_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._ids = itertools.count(1)
+        threading.Thread(target=self._read_events, daemon=True).start()
+
+    def usable(self) -> bool:
+        return not self.retiring and self.process.poll() is None
+
+    def spawn(self, job: dict) -> WarmProcess:
+        # No timeout: a heavy preload on a Pi is slow, not broken.
+        while not self._ready.wait(1.0):
+            if self.process.poll() is not None:
+                break
+        if not self._link_open or not self._ready.is_set():
+            raise SpawnError("Warm Python interpreter exited while preloading")
+
+        job_id = next(self._ids)
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        proc = WarmProcess(job_id, out_r, err_r)
+        with self._jobs_lock:
+            self._jobs[job_id] = proc
+        try:
+            payload = json.dumps(dict(job, id=job_id)).encode('utf-8') + b'\n'
+            with self._send_lock:
+                socket.send_fds(self._sock, [payload], [out_w, err_w])
+        except OSError as e:
+            self._forget(job_id)
+            proc.stdout.close()
+            proc.stderr.close()
+            raise SpawnError(f"Could not send the job: {e}") from e
+        finally:
+            # The child holds the write ends now; keeping ours would stop the
+            # readers from ever seeing EOF.
+            os.close(out_w)
+            os.close(err_w)
+
+        if not proc._started.wait(SPAWN_TIMEOUT):
+            with self._jobs_lock:
+                proc.abandoned = not proc._started.is_set()
+            if proc.abandoned:
+                # It may still fork the job, so the caller mustn't run it
+                # elsewhere; _read_events kills it if it does start. New jobs
+                # go to a fresh zygote, while this one's running jobs carry on
+                # and still report their exit codes.
+                self.retire()
+                proc.stdout.close()
+                proc.stderr.close()
+                raise RuntimeError("Warm Python interpreter stopped responding; the job was abandoned")
+        if proc.pid is None:
+            self._forget(job_id)
+            proc.stdout.close()
+            proc.stderr.close()
+            if proc.error:
+                raise SpawnError(proc.error)  # The zygote reported that fork() failed
+            raise RuntimeError("Warm Python interpreter exited before confirming the job")
+        return proc
+
+    def retire(self):
+        """Stop taking jobs; the zygote exits once its running jobs finish."""
+        self.retiring = True
+        try:
+            with self._send_lock:
+                _send(self._sock, {'retire': True})
+        except OSError:
+            pass
+
+    def _forget(self, job_id: int):
+        with self._jobs_lock:
+            self._jobs.pop(job_id, None)
+
+    def _read_events(self):
+        buf = b''
+        try:
+            while True:
+                data = self._sock.recv(MAX_MESSAGE)
+                if not data:
+                    break
+                buf += data
+                while b'\n' in buf:
+                    line, buf = buf.split(b'\n', 1)
+                    msg = json.loads(line)
+                    if msg.get('ready'):
+                        self._ready.set()
+                        continue
+                    with self._jobs_lock:
+                        proc = self._jobs.get(msg.get('id'))
+                        if proc is not None and proc.abandoned:
+                            self._jobs.pop(proc.job_id, None)
+                            if msg.get('pid'):
+                                # The child may not have called setsid() yet.
+                                for kill in (os.killpg, os.kill):
+                                    try:
+                                        kill(msg['pid'], signal.SIGKILL)
+                                    except OSError:
+                                        pass
+                            continue
+                        if proc is not None and ('pid' in msg or 'error' in msg):
+                            # Under the lock, so spawn() can't abandon it halfway.
+                            proc._on_started(msg.get('pid'), msg.get('error'))
+                            continue
+                    if proc is None:
+                        continue
+                    if 'exit' in msg:
+                        self._forget(proc.job_id)
+                        proc._on_exit(msg['exit'])
+        except (OSError, ValueError) as e:
+            print(f"Warm Python interpreter link failed: {type(e).__name__}: {e}")
+        finally:
+            self._sock.close()
+            self.retiring = True
+            self._link_open = False
+            self._ready.set()
+            # Without the zygote nobody can report these jobs' exit codes, so
+            # end them rather than leave their executors waiting forever.
+            with self._jobs_lock:
+                orphans = list(self._jobs.values())
+                self._jobs.clear()
+            for proc in orphans:
+                if proc.pid:
+                    try:
+                        os.killpg(proc.pid, signal.SIGKILL)
+                    except OSError:
+                        pass
+                proc._on_exit(-signal.SIGKILL)
+
+
+class WarmPythonPool:
+    """Hands ``python`` jobs to a warm zygote, (re)starting it as needed. Thread-safe."""
+
+    def __init__(self, preload: Optional[List[str]] = None, python: Optional[str] = None):
+        self.preload = list(preload or [])
+        self.python = python or sys.executable
+        self._lock = threading.Lock()
+        self._zygote: Optional[_Zygote] = None
+
+    def configure(self, preload: Optional[List[str]]):
+        """Change the preloaded modules. Running jobs are unaffected."""
+        preload = [m for m in (preload or []) if isinstance(m, str) and m]
+        with self._lock:
+            if preload == self.preload:
+                return
+            self.preload = preload
+            old, self._zygote = self._zygote, None
+        if old:
+            old.retire()
+
+    def spawn(self, job: dict) -> WarmProcess:
+        """Fork a job from the warm interpreter.
+
+        Raises SpawnError if the job was not started, RuntimeError if it may
+        have been (the zygote hung after taking it).
+
+        ``job`` keys: ``script`` (path) or ``code``, ``args``, ``cwd``, ``env``,
+        plus optional ``limits`` / ``cgroup_path`` (see limits.py).
+        """
+        with self._lock:
+            if self._zygote is None or not self._zygote.usable():
+                try:
+                    self._zygote = _Zygote(self.python, self.preload)
+                except OSError as e:
+                    raise SpawnError(f"Could not start the warm interpreter: {e}") from e
+            zygote = self._zygote
+        return zygote.spawn(job)
+
+    def shutdown(self):
+        with self._lock:
+            old, self._zygote = self._zygote, None
+        if old:
+            old.retire()
+
+
+# -- zygote side -------------------------------------------------------------
+
+def _run_job(job: dict, out_fd: int, err_fd: int):
+    """Body of a forked child. Never returns."""
+    code = 1
+    try:
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(out_fd, 1)
+        os.dup2(err_fd, 2)
+        for fd in (devnull, out_fd, err_fd):
+            os.close(fd)
+        sys.stdin = open(0, 'r', closefd=False)
+        sys.stdout = open(1, 'w', buffering=1, encoding='utf-8', errors='replace', closefd=False)
+        sys.stderr = open(2, 'w', buffering=1, encoding='utf-8', errors='replace', closefd=False)
+
+        if job.get('limits'):
+            from limits import CommandLimits
+            limits = CommandLimits(str(job['id']), job['limits'])
+            limits.cgroup_path = job.get('cgroup_path')
+            apply = limits.preexec_fn()
+            if apply:
+                apply()
+
+        os.environ.clear()
+        os.environ.update(job.get('env') or {})
+        if job.get('cwd'):
+            os.chdir(job['cwd'])
+
+        script = job.get('script')
+        sys.argv = [script or '-c'] + [str(a) for a in job.get('args') or []]
+        try:
+            if script:
+                import runpy
+                sys.path[0] = os.path.dirname(os.path.abspath(script))
+                runpy.run_path(script, run_name='__main__')
+            else:
+                sys.path[0] = ''
+                exec(compile(job.get('code') or '', '<command>', 'exec'), {'__name__': '__main__'})
+            code = 0
+        except SystemExit as e:
+            if e.code is None:
+                code = 0
+            elif isinstance(e.code, int):
+                code = e.code
+            else:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+        os._exit(code)
+
+
+def _zygote_main(sock_fd: int, preload: List[str]):
+    sock = socket.socket(fileno=sock_fd)
+    for name in preload:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print(f"Warm Python: could not preload {name}: {type(e).__name__}: {e}", file=sys.stderr)
+    _send(sock, {'ready': True})
+
+    # SIGCHLD wakes the select() below so exits are reported promptly.
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_w, False)
+    signal.set_wakeup_fd(wake_w)
+    signal.signal(signal.SIGCHLD, lambda *_: None)
+
+    children: Dict[int, int] = {}  # pid -> job id
+    pending_fds: List[int] = []
+    buf = b''
+    retiring = False
+    while True:
+        while children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            job_id = children.pop(pid, None)
+            if job_id is not None:
+                _send(sock, {'id': job_id, 'exit': os.waitstatus_to_exitcode(status)})
+        if retiring and not children:
+            return
+
+        try:
+            ready, _, _ = select.select([sock, wake_r], [], [])
+        except InterruptedError:
+            continue
+        if wake_r in ready:
+            os.read(wake_r, 4096)
+        if sock not in ready:
+            continue
+
+        data, fds, _, _ = socket.recv_fds(sock, MAX_MESSAGE, 16)
+        if not data:
+            return  # Agent went away; running jobs carry on by themselves
+        buf += data
+        pending_fds.extend(fds)
+        while b'\n' in buf:
+            line, buf = buf.split(b'\n', 1)
+            msg = json.loads(line)
+            if msg.get('retire'):
+                retiring = True
+                continue
+            out_fd, err_fd = pending_fds.pop(0), pending_fds.pop(0)
+            try:
+                pid = os.fork()
+            except OSError as e:
+                os.close(out_fd)
+                os.close(err_fd)
+                _send(sock, {'id': msg['id'], 'error': f"fork failed: {e}"})
+                continue
+            if pid == 0:
+                signal.set_wakeup_fd(-1)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                for fd in [wake_r, wake_w] + pending_fds:
+                    os.close(fd)
+                sock.close()
+                _run_job(msg, out_fd, err_fd)
+            os.close(out_fd)
+            os.close(err_fd)
+            children[pid] = msg['id']
+            _send(sock, {'id': msg['id'], 'pid': pid})
+
+
+if __name__ == '__main__' and len(sys.argv) == 4 and sys.argv[1] == '--zygote':
+    _zygote_main(int(sys.argv[2]), json.loads(sys.argv[3]))
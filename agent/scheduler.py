@@ -0,0 +1,244 @@
+"""
+Activity-aware scheduling for the agent's periodic network work.
+
+The agent moves between three tiers based on recent command activity, whether
+someone has the web console open (``viewer_active`` on the device doc) and how
+healthy the link currently is:
+
+ - ``active``: commands running, a viewer present, or activity within
+   ``idle_timeout``. Heartbeats / fallback polls run at ``polling_rate``.
+ - ``idle``: nothing happened for ``idle_timeout``. Runs at ``sleep_polling_rate``.
+ - ``sleep``: nothing happened for ``deep_idle_timeout``. Runs at
+   ``deep_sleep_polling_rate`` (named ``sleep`` because that is the mode the web
+   console already renders for a dormant device).
+
+Heartbeat cadence, fallback polling and FileSyncer frequency are all derived
+from here so an idle device uses very little of the hotspot's data allowance.
+
+``TimerQueue`` drives the agent's main loop: each periodic task has its own
+deadline, and events (command finished, config changed, shutdown) wake the
+loop immediately instead of waiting out a fixed sleep.
+"""
+import heapq
+import threading
+import time
+from typing import List, Optional
+
+TIER_ACTIVE = 'active'
+TIER_IDLE = 'idle'
+TIER_SLEEP = 'sleep'
+
+# The web console marks a device offline after 5 minutes without a heartbeat,
+# so never let the heartbeat interval drift past this, whatever the tier.
+MAX_HEARTBEAT_INTERVAL = 240.0
+
+# A ``viewer_active`` flag left behind by a closed browser tab shouldn't keep the
+# device awake forever. The console (web/app/hooks/useDevice.ts) refreshes it
+# every few minutes while visible and clears it on unmount.
+VIEWER_PRESENCE_TTL = 600.0
+
+# FileSyncer interval per tier (seconds). The shared folder is mostly touched
+# while someone is working in the console, so it can back off hard when idle.
+SYNC_INTERVALS = {
+    TIER_ACTIVE: 10.0,
+    TIER_IDLE: 60.0,
+    TIER_SLEEP: 300.0,
+}
+
+# Cap on the link-quality multiplier applied while the network is failing.
+MAX_LINK_BACKOFF = 8
+
+
+class AdaptiveScheduler:
+    """Tracks activity / presence / link quality and hands out intervals.
+
+    All methods are thread-safe: snapshot callbacks, executor threads, the
+    FileSyncer and the main loop all talk to the same instance.
+    """
+
+    def __init__(self, config: dict):
+        self._lock = threading.Lock()
+        self.polling_rate = float(config.get('polling_rate', 30))
+        self.sleep_polling_rate = float(config.get('sleep_polling_rate', 60))
+        self.deep_sleep_polling_rate = float(config.get('deep_sleep_polling_rate', MAX_HEARTBEAT_INTERVAL))
+        self.idle_timeout = float(config.get('idle_timeout', 60))
+        self.deep_idle_timeout = float(config.get('deep_idle_timeout', 600))
+        self.last_activity_time = time.time()
+        self._viewer_active = False
+        self._viewer_seen_at = 0.0
+        self._consecutive_network_failures = 0
+        self._active_commands = 0
+
+    def configure(self, **settings):
+        """Apply config values (from boot or a live device-doc update)."""
+        with self._lock:
+            for key, value in settings.items():
+                if value is None or not hasattr(self, key):
+                    continue
+                setattr(self, key, float(value))
+
+    def note_activity(self):
+        """Record user-visible activity (a command arrived, a viewer showed up)."""
+        with self._lock:
+            self.last_activity_time = time.time()
+
+    def set_viewer_active(self, value):
+        """Apply the device doc's ``viewer_active`` field.
+
+        Accepts a boolean or a timestamp (the console's last refresh). A boolean
+        only counts as a fresh sighting when it flips to True, since the agent's
+        own heartbeat writes re-deliver the unchanged field on every snapshot.
+        """
+        with self._lock:
+            if hasattr(value, 'timestamp'):
+                seen_at = value.timestamp()
+                self._viewer_active = True
+            elif value and not self._viewer_active:
+                seen_at = time.time()
+                self._viewer_active = True
+            else:
+                self._viewer_active = bool(value)
+                return
+            if seen_at > self._viewer_seen_at:
+                self._viewer_seen_at = seen_at
+                self.last_activity_time = max(self.last_activity_time, seen_at)
+
+    def set_active_commands(self, count: int):
+        with self._lock:
+            self._active_commands = count
+
+    def record_network_result(self, ok: bool):
+        """Feed the outcome of a Firestore / Storage call into link quality."""
+        with self._lock:
+            if ok:
+                self._consecutive_network_failures = 0
+            else:
+                self._consecutive_network_failures += 1
+
+    @property
+    def link_backoff(self) -> int:
+        """Multiplier applied to intervals while the link keeps failing."""
+        with self._lock:
+            failures = self._consecutive_network_failures
+        return min(2 ** min(failures, 3), MAX_LINK_BACKOFF) if failures else 1
+
+    def tier(self, now: Optional[float] = None) -> str:
+        now = now if now is not None else time.time()
+        with self._lock:
+            viewer_present = (
+                self._viewer_active and (now - self._viewer_seen_at) < VIEWER_PRESENCE_TTL
+            )
+            if self._active_commands > 0 or viewer_present:
+                return TIER_ACTIVE
+            idle_for = now - self.last_activity_time
+            if idle_for < self.idle_timeout:
+                return TIER_ACTIVE
+            if idle_for < self.deep_idle_timeout:
+                return TIER_IDLE
+            return TIER_SLEEP
+
+    def seconds_until_tier_change(self, now: Optional[float] = None) -> Optional[float]:
+        """Seconds until the tier could change on its own, or None if it can't.
+
+        Only the passage of time is considered here; events such as a command
+        arriving change the tier directly and wake the main loop themselves.
+        """
+        now = now if now is not None else time.time()
+        candidates = []
+        with self._lock:
+            if self._viewer_active:
+                candidates.append(self._viewer_seen_at + VIEWER_PRESENCE_TTL - now)
+            if self._active_commands == 0:
+                idle_for = now - self.last_activity_time
+                for timeout in (self.idle_timeout, self.deep_idle_timeout):
+                    if idle_for < timeout:
+                        candidates.append(timeout - idle_for)
+        candidates = [c for c in candidates if c > 0]
+        return min(candidates) if candidates else None
+
+    def _base_interval(self, tier: str) -> float:
+        if tier == TIER_ACTIVE:
+            return self.polling_rate
+        if tier == TIER_IDLE:
+            return self.sleep_polling_rate
+        return self.deep_sleep_polling_rate
+
+    def polling_interval(self) -> float:
+        """Interval between fallback polls / listener health checks."""
+        return self._base_interval(self.tier()) * self.link_backoff
+
+    def heartbeat_interval(self) -> float:
+        """Interval between device heartbeats, capped below the console's offline timeout."""
+        interval = self._base_interval(self.tier()) * self.link_backoff
+        return max(1.0, min(interval, MAX_HEARTBEAT_INTERVAL))
+
+    def sync_interval(self) -> float:
+        """Interval between FileSyncer passes."""
+        return SYNC_INTERVALS[self.tier()] * self.link_backoff
+
+
+class TimerQueue:
+    """Named deadlines in a min-heap plus a wakeup event.
+
+    ``schedule(name, delay)`` replaces any existing deadline for ``name``;
+    with ``earlier_only`` it only ever moves a deadline forward.
+    ``wait()`` blocks until the earliest deadline passes or ``wake()`` is
+    called, and returns the names that are due (empty on a bare wakeup).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heap = []
+        self._deadlines = {}
+        self._event = threading.Event()
+
+    def schedule(self, name: str, delay: float, earlier_only: bool = False):
+        deadline = time.monotonic() + max(0.0, delay)
+        with self._lock:
+            existing = self._deadlines.get(name)
+            if earlier_only and existing is not None and existing <= deadline:
+                return
+            head = self._next_deadline()
+            self._deadlines[name] = deadline
+            heapq.heappush(self._heap, (deadline, name))
+        # Only a new earliest deadline needs to interrupt a sleeping wait().
+        if head is None or deadline < head:
+            self._event.set()
+
+    def cancel(self, name: str):
+        with self._lock:
+            self._deadlines.pop(name, None)
+
+    def is_scheduled(self, name: str) -> bool:
+        with self._lock:
+            return name in self._deadlines
+
+    def wake(self):
+        self._event.set()
+
+    def _next_deadline(self) -> Optional[float]:
+        # Drop heap entries superseded by a later schedule() / cancel().
+        while self._heap and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def wait(self, max_wait: Optional[float] = None) -> List[str]:
+        with self._lock:
+            deadline = self._next_deadline()
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        if max_wait is not None:
+            timeout = max_wait if timeout is None else min(timeout, max_wait)
+        self._event.wait(timeout)
+        self._event.clear()
+
+        due = []
+        now = time.monotonic()
+        with self._lock:
+            while True:
+                deadline = self._next_deadline()
+                if deadline is None or deadline > now:
+                    break
+                _, name = heapq.heappop(self._heap)
+                del self._deadlines[name]
+                due.append(name)
+        return due
@@ -0,0 +1,409 @@
+"""
+Recurring commands run by the agent itself.
+
+The device doc's ``schedules`` map names recurring jobs::
+
+    schedules:
+      backup:  {cron: "30 3 * * *", command: "./backup.sh", jitter: 600}
+      ping:    {every: 300, command: "ping -c1 1.1.1.1", overlap: "queue"}
+
+Each entry has either a 5-field ``cron`` expression (local time; lists,
+ranges, steps, month / weekday names and ``@daily``-style aliases) or
+``every`` (seconds). ``jitter`` adds up to that many random seconds to each
+run. ``overlap`` says what happens when a run is due while the last one is
+still going: ``skip`` (default), ``queue`` (run once it finishes) or
+``parallel``; ``max_parallel`` (default 4) caps how many ``parallel`` runs
+overlap, and a run due past the cap is skipped. ``enabled: false`` pauses
+an entry. Every other key (``type``,
+``session``, ``limits``, ...) is passed on as the command's own fields.
+
+The map is cached on disk, so schedules keep firing after a reboot with no
+network. Runs don't have a Firestore doc while they execute. Instead the
+executor writes to a ``JournalRef``, and finished runs are appended to a
+local ``RunJournal``. The agent uploads the journal in batches as completed
+command docs.
+"""
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+OVERLAP_POLICIES = ('skip', 'queue', 'parallel')
+# Keys that configure the schedule itself rather than the command it runs.
+SCHEDULE_KEYS = ('cron', 'every', 'jitter', 'overlap', 'max_parallel', 'enabled')
+DEFAULT_MAX_PARALLEL_RUNS = 4
+MIN_EVERY_SECONDS = 10
+# Oldest journaled runs are dropped past this (a long outage with a
+# once-a-minute job shouldn't fill the disk).
+MAX_JOURNAL_RECORDS = 5000
+# Fields the executor sets to SERVER_TIMESTAMP; journaled as epoch seconds.
+TIMESTAMP_FIELDS = ('created_at', 'started_at', 'completed_at', 'last_activity')
+TERMINAL_STATUSES = ('completed', 'cancelled', 'skipped')
+
+_NAME_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+_ALIASES = {
+    '@yearly': '0 0 1 1 *',
+    '@annually': '0 0 1 1 *',
+    '@monthly': '0 0 1 * *',
+    '@weekly': '0 0 * * 0',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@hourly': '0 * * * *',
+}
+_MONTHS = {m: i + 1 for i, m in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'])}
+_WEEKDAYS = {d: i for i, d in enumerate(['sun', 'mon', 'tue', 'wed', 'thu', 'fri', 'sat'])}
+# Enough steps to cross several years of non-matching months / days, so a
+# leap-day schedule is found while an impossible one (Feb 30) still fails.
+_MAX_SEARCH_STEPS = 20000
+
+
+def _parse_field(text: str, lo: int, hi: int, names: Dict[str, int]) -> set:
+    values = set()
+    for part in text.lower().split(','):
+        step = None
+        if '/' in part:
+            part, step_text = part.split('/', 1)
+            step = int(step_text)
+            if step < 1:
+                raise ValueError(f"Bad step in '{text}'")
+        if part == '*':
+            start, end = lo, hi
+        elif '-' in part:
+            a, b = part.split('-', 1)
+            start = names[a] if a in names else int(a)
+            end = names[b] if b in names else int(b)
+        else:
+            start = names[part] if part in names else int(part)
+            # "5/15" means every 15 starting at 5.
+            end = hi if step else start
+        if not (lo <= start <= end <= hi):
+            raise ValueError(f"'{text}' is out of range {lo}-{hi}")
+        values.update(range(start, end + 1, step or 1))
+    return values
+
+
+class CronExpr:
+    """A standard 5-field cron expression (minute hour day-of-month month day-of-week)."""
+
+    def __init__(self, expr: str):
+        self.expr = expr
+        fields = _ALIASES.get(expr.strip().lower(), expr).split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression needs 5 fields: '{expr}'")
+        try:
+            self.minutes = _parse_field(fields[0], 0, 59, {})
+            self.hours = _parse_field(fields[1], 0, 23, {})
+            self.days = _parse_field(fields[2], 1, 31, {})
+            self.months = _parse_field(fields[3], 1, 12, _MONTHS)
+            self.weekdays = {d % 7 for d in _parse_field(fields[4], 0, 7, _WEEKDAYS)}  # 7 is Sunday too
+        except (KeyError, ValueError) as e:
+            raise ValueError(f"Bad cron expression '{expr}': {e}")
+        # Like cron: when both day fields are restricted, either may match.
+        self._dom_any = fields[2] == '*'
+        self._dow_any = fields[4] == '*'
+
+    def _day_matches(self, t: datetime) -> bool:
+        dom = t.day in self.days
+        dow = (t.weekday() + 1) % 7 in self.weekdays  # cron: 0 = Sunday
+        if self._dom_any or self._dow_any:
+            return dom and dow
+        return dom or dow
+
+    def next_after(self, after: datetime) -> datetime:
+        """First matching minute strictly after ``after`` (naive local time)."""
+        t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        for _ in range(_MAX_SEARCH_STEPS):
+            if t.month not in self.months:
+                year, month = (t.year + 1, 1) if t.month == 12 else (t.year, t.month + 1)
+                t = t.replace(year=year, month=month, day=1, hour=0, minute=0)
+            elif not self._day_matches(t):
+                t = (t + timedelta(days=1)).replace(hour=0, minute=0)
+            elif t.hour not in self.hours:
+                t = (t + timedelta(hours=1)).replace(minute=0)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f"Cron expression '{self.expr}' never fires")
+
+
+class Schedule:
+    """One parsed ``schedules`` entry plus its next run time."""
+
+    def __init__(self, name: str, spec: dict):
+        if not _NAME_RE.match(name):
+            raise ValueError("Schedule names may only use letters, digits, '-' and '_'")
+        if not isinstance(spec, dict):
+            raise ValueError("Schedule must be a map")
+        self.name = name
+        self.spec = spec
+        self.cron = CronExpr(str(spec['cron'])) if spec.get('cron') else None
+        self.every = float(spec['every']) if spec.get('every') else None
+        if (self.cron is None) == (self.every is None):
+            raise ValueError("Schedule needs exactly one of 'cron' or 'every'")
+        if self.every is not None and self.every < MIN_EVERY_SECONDS:
+            raise ValueError(f"'every' must be at least {MIN_EVERY_SECONDS} seconds")
+        self.jitter = max(0.0, float(spec.get('jitter') or 0))
+        self.overlap = spec.get('overlap') or 'skip'
+        if self.overlap not in OVERLAP_POLICIES:
+            raise ValueError(f"'overlap' must be one of {', '.join(OVERLAP_POLICIES)}")
+        self.max_parallel = int(spec.get('max_parallel', DEFAULT_MAX_PARALLEL_RUNS))
+        if self.max_parallel < 1:
+            raise ValueError("'max_parallel' must be at least 1")
+        self.enabled = spec.get('enabled', True) is not False
+        self.cmd_data = {k: v for k, v in spec.items() if k not in SCHEDULE_KEYS}
+        command_type = self.cmd_data.get('type', 'shell')
+        if command_type == 'restart':
+            raise ValueError("Restarts can't be scheduled")
+        if not self.cmd_data.get('command') and command_type == 'shell':
+            raise ValueError("Schedule needs a 'command'")
+        self.base_next = 0.0   # Next slot, before jitter
+        self.next_run = 0.0    # When it actually fires
+        self.pending = False   # A 'queue' run is waiting for the last one to finish
+        self.advance(time.time())
+
+    def advance(self, now: float):
+        """Move to the first slot after ``now`` (one run per slot, missed slots are skipped)."""
+        if self.cron is not None:
+            base = self.cron.next_after(datetime.fromtimestamp(max(now, self.base_next))).timestamp()
+        elif self.base_next and self.base_next <= now:
+            missed = int((now - self.base_next) // self.every) + 1
+            base = self.base_next + missed * self.every
+        else:
+            base = self.base_next or now + self.every
+        self.base_next = base
+        self.next_run = base + random.uniform(0, self.jitter)
+
+
+class ScheduleTable:
+    """The agent's parsed schedules. Thread-safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._schedules: Dict[str, Schedule] = {}
+        self._last_check = time.time()
+
+    def configure(self, specs) -> Dict[str, str]:
+        """Replace the table from a ``schedules`` map. Returns ``{name: error}`` for bad entries.
+
+        Unchanged entries keep their next run time, so an unrelated device-doc
+        edit doesn't shift them. An edited entry keeps a waiting 'queue' run.
+        """
+        errors = {}
+        specs = specs if isinstance(specs, dict) else {}
+        with self._lock:
+            table = {}
+            for name, spec in specs.items():
+                old = self._schedules.get(name)
+                if old is not None and old.spec == spec:
+                    table[name] = old
+                    continue
+                try:
+                    table[name] = Schedule(name, spec)
+                    if old is not None:
+                        table[name].pending = old.pending
+                except (ValueError, TypeError) as e:
+                    errors[name] = str(e)
+            self._schedules = table
+        return errors
+
+    def get(self, name: str) -> Optional[Schedule]:
+        with self._lock:
+            return self._schedules.get(name)
+
+    def names(self) -> List[str]:
+        with self._lock:
+            return list(self._schedules)
+
+    def due(self, now: Optional[float] = None) -> List[Schedule]:
+        """Schedules whose run time has come, each advanced to its next slot."""
+        now = time.time() if now is None else now
+        with self._lock:
+            # The clock went backwards (a Pi without an RTC gets NTP time
+            # after boot): next runs computed from the wrong time are bogus.
+            if now < self._last_check - 60:
+                for sched in self._schedules.values():
+                    sched.base_next = 0.0
+                    sched.advance(now)
+            self._last_check = now
+            due = []
+            for sched in self._schedules.values():
+                if sched.next_run <= now:
+                    sched.advance(now)
+                    if sched.enabled:
+                        due.append(sched)
+            return due
+
+    def seconds_until_next(self, now: Optional[float] = None) -> Optional[float]:
+        now = time.time() if now is None else now
+        with self._lock:
+            runs = [s.next_run for s in self._schedules.values() if s.enabled]
+        return max(0.0, min(runs) - now) if runs else None
+
+
+def run_id(name: str, now: Optional[float] = None) -> str:
+    """Command id for one run, unique and sortable by start time."""
+    stamp = datetime.fromtimestamp(now or time.time(), tz=timezone.utc).strftime('%Y%m%d%H%M%S')
+    return f"sched-{name}-{stamp}-{os.urandom(3).hex()}"
+
+
+def load_cache(path: str) -> dict:
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(path: str, specs: dict):
+    _write_atomic(path, json.dumps(specs or {}, sort_keys=True, default=str))
+
+
+def _write_atomic(path: str, text: str):
+    directory = os.path.dirname(path) or '.'
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class RunJournal:
+    """Append-only NDJSON file of finished runs not yet uploaded. Thread-safe."""
+
+    def __init__(self, path: str, max_records: int = MAX_JOURNAL_RECORDS):
+        self.path = path
+        self.max_records = max_records
+        self._lock = threading.Lock()
+        self._records: List[dict] = []
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self._records.append(json.loads(line))
+                    except ValueError:
+                        continue  # Torn last line from a crash
+        except OSError:
+            pass
+
+    def __len__(self):
+        with self._lock:
+            return len(self._records)
+
+    def append(self, record: dict):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            self._records.append(json.loads(line))
+            if len(self._records) > self.max_records:
+                dropped = len(self._records) - self.max_records
+                del self._records[:dropped]
+                print(f"Schedule journal full: dropped {dropped} oldest unsynced runs")
+                self._rewrite()
+                return
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(line + '\n')
+            except OSError as e:
+                print(f"Could not write schedule journal: {e}")
+
+    def pending(self, limit: int) -> List[dict]:
+        with self._lock:
+            return list(self._records[:limit])
+
+    def ack(self, run_ids):
+        """Forget runs that have been uploaded."""
+        run_ids = set(run_ids)
+        with self._lock:
+            self._records = [r for r in self._records if r.get('id') not in run_ids]
+            self._rewrite()
+
+    def _rewrite(self):
+        try:
+            _write_atomic(self.path, ''.join(json.dumps(r) + '\n' for r in self._records))
+        except OSError as e:
+            print(f"Could not rewrite schedule journal: {e}")
+
+
+class JournalRef:
+    """Stands in for a command's DocumentReference during a scheduled run.
+
+    ``update()`` merges fields into a local record (``server_timestamp`` becomes
+    the current time, ``delete_field`` removes the key). When the status turns
+    terminal the record is appended to the journal and ``on_journaled`` runs.
+    """
+
+    def __init__(self, run_id_: str, record: dict, journal: RunJournal,
+                 server_timestamp=None, delete_field=None, on_journaled=None):
+        self.id = run_id_
+        self.record = dict(record, id=run_id_)
+        self.journal = journal
+        self._server_timestamp = server_timestamp
+        self._delete_field = delete_field
+        self._on_journaled = on_journaled
+        self._lock = threading.Lock()
+        self._journaled = False
+
+    def update(self, data: dict):
+        with self._lock:
+            for key, value in data.items():
+                if self._delete_field is not None and value is self._delete_field:
+                    self.record.pop(key, None)
+                elif self._server_timestamp is not None and value is self._server_timestamp:
+                    self.record[key] = time.time()
+                else:
+                    self.record[key] = value
+            if self._journaled or self.record.get('status') not in TERMINAL_STATUSES:
+                return
+            self._journaled = True
+            record = dict(self.record)
+        self.journal.append(record)
+        if self._on_journaled:
+            self._on_journaled(record)
+
+
+def firestore_record(record: dict) -> dict:
+    """A journaled run as a command doc: epoch timestamps become datetimes."""
+    doc = {k: v for k, v in record.items() if k != 'id'}
+    for key in TIMESTAMP_FIELDS:
+        if isinstance(doc.get(key), (int, float)):
+            doc[key] = datetime.fromtimestamp(doc[key], tz=timezone.utc)
+    return doc
+
+
+def _field_segment(name: str) -> str:
+    # Firestore field paths need backticks around segments that aren't identifiers.
+    return name if re.match(r'^[_a-zA-Z][_a-zA-Z0-9]*$', name) else f"`{name}`"
+
+
+def state_summary(records: List[dict]) -> Dict[str, dict]:
+    """Latest run per schedule, as dotted ``schedule_state.<name>`` device-doc updates."""
+    latest: Dict[str, dict] = {}
+    for record in records:
+        name = record.get('scheduled')
+        if name and (name not in latest or (record.get('created_at') or 0) >= (latest[name].get('created_at') or 0)):
+            latest[name] = record
+    return {
+        f"schedule_state.{_field_segment(name)}": {
+            'last_run_id': r.get('id'),
+            'last_status': r.get('status'),
+            'last_return_code': r.get('return_code'),
+            'last_run_at': datetime.fromtimestamp(r['created_at'], tz=timezone.utc)
+            if isinstance(r.get('created_at'), (int, float)) else None,
+        }
+        for name, r in latest.items()
+    }
@@ -0,0 +1,419 @@
+"""
+Content search over the shared folder (and any configured extra roots).
+
+A trigram index maps every 3-character sequence (lower-cased) to the files
+containing it. A query is narrowed to the files containing all of its literal
+trigrams and only those are scanned line by line to confirm real matches, so
+most searches touch a handful of files instead of the whole tree.
+
+The index is persisted as gzipped JSON and kept fresh incrementally: a
+periodic rescan only re-reads files whose size / mtime changed, and FileSyncer
+and the file-writing API endpoints notify it about files they touch.
+"""
+import gzip
+import json
+import os
+import re
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+INDEX_VERSION = 1
+# Bigger files aren't indexed but stay searchable: they are always candidates.
+MAX_INDEX_FILE_SIZE = 2 * 1024 * 1024
+BINARY_SNIFF_BYTES = 8192
+MAX_RESULT_LINE = 500
+# How long one /files/search call may spend scanning before it returns a
+# partial page with a cursor to continue from.
+SEARCH_TIME_BUDGET = 5.0
+# Cap on files walked when searching a path outside the indexed roots.
+MAX_UNINDEXED_FILES = 20000
+
+_REGEX_META = set('.^$*+?{}[]()|\\')
+# Payload length after escapes like \x41 / \u00e9 / \U0001f600.
+_FIXED_ESCAPES = {'x': 2, 'u': 4, 'U': 8}
+# An inline flag group turning on re.VERBOSE, e.g. (?x) or (?ix).
+_VERBOSE_FLAG_RE = re.compile(r'\(\?[aiLmsux]*x')
+# The persisted index is rewritten at most this often (plus after rescans and on stop).
+SAVE_INTERVAL = 60.0
+
+
+def _trigrams(text: str) -> Set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _escape_end(pattern: str, i: int) -> int:
+    """Index just past the alphanumeric escape starting at ``pattern[i]`` (a backslash)."""
+    kind, j = pattern[i + 1], i + 2
+    if kind in _FIXED_ESCAPES:
+        return min(j + _FIXED_ESCAPES[kind], len(pattern))
+    if kind == 'N' and pattern[j:j + 1] == '{':
+        end = pattern.find('}', j)
+        return end + 1 if end > 0 else len(pattern)
+    if kind.isdigit():
+        # Octal escape or back-reference: up to three digits in all.
+        while j < len(pattern) and j < i + 4 and pattern[j].isdigit():
+            j += 1
+    return j
+
+
+def _required_literals(pattern: str, regex: bool) -> List[str]:
+    """Literal runs that every match must contain (lower-cased), for trigram filtering.
+
+    Deliberately conservative: alternation, anything inside a group or verbose
+    mode (where whitespace isn't literal) yields no requirement rather than
+    risk dropping a real match.
+    """
+    if not regex:
+        return [pattern.lower()]
+    if '|' in pattern or _VERBOSE_FLAG_RE.search(pattern):
+        return []
+    runs, run, depth, i = [], [], 0, 0
+    while i < len(pattern):
+        c = pattern[i]
+        nxt = pattern[i + 1] if i + 1 < len(pattern) else ''
+        if c == '\\' and nxt and not nxt.isalnum():
+            literal, i = nxt, i + 2
+        elif c in _REGEX_META:
+            if c == '(':
+                depth += 1
+            elif c == ')':
+                depth = max(0, depth - 1)
+            elif c in '*?{':
+                if run:
+                    run.pop()  # The preceding character is optional / repeated
+                if c == '{':
+                    end = pattern.find('}', i + 1)
+                    i = end if end > 0 else i
+            elif c == '[':
+                end = pattern.find(']', i + 2)
+                i = end if end > 0 else i
+            runs.append(''.join(run))
+            run = []
+            # Class escapes (\d, \b) and character escapes (\x41, \n) both
+            # break the run; the latter's payload is not literal text.
+            i = _escape_end(pattern, i) if c == '\\' and nxt else i + 1
+            continue
+        else:
+            literal, i = c, i + 1
+        if depth == 0:
+            run.append(literal)
+        elif run:
+            runs.append(''.join(run))
+            run = []
+    runs.append(''.join(run))
+    return [r.lower() for r in runs if len(r) >= 3]
+
+
+def _read_text(path: str) -> Optional[str]:
+    try:
+        with open(path, 'rb') as f:
+            data = f.read(MAX_INDEX_FILE_SIZE + 1)
+    except OSError:
+        return None
+    if b'\0' in data[:BINARY_SNIFF_BYTES]:
+        return None
+    return data.decode('utf-8', errors='replace')
+
+
+class SearchIndex:
+    """Persistent trigram index over a set of root directories. Thread-safe."""
+
+    def __init__(self, roots: Iterable[str], index_path: str):
+        self.roots = [os.path.abspath(r) for r in roots]
+        self.index_path = index_path
+        self._lock = threading.RLock()
+        self._files: Dict[str, list] = {}     # path -> [file_id, mtime, size, indexed]
+        self._postings: Dict[str, Set[int]] = {}
+        self._next_id = 0
+        self._stale_ids = 0  # removed files whose IDs still sit in postings
+        self._dirty = False
+        self.last_refresh = 0.0
+        self._load()
+
+    # -- persistence -------------------------------------------------------
+
+    def _load(self):
+        try:
+            with gzip.open(self.index_path, 'rt', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') != INDEX_VERSION:
+            return
+        self._files = data.get('files', {})
+        self._postings = {tri: set(ids) for tri, ids in data.get('postings', {}).items()}
+        self._next_id = data.get('next_id', 0)
+
+    def _compact_locked(self):
+        live = {entry[0] for entry in self._files.values()}
+        for tri in list(self._postings):
+            ids = self._postings[tri] & live
+            if ids:
+                self._postings[tri] = ids
+            else:
+                del self._postings[tri]
+        self._stale_ids = 0
+
+    @property
+    def dirty(self) -> bool:
+        """Whether there are changes not yet saved."""
+        return self._dirty
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            if self._stale_ids > max(1000, len(self._files) // 4):
+                self._compact_locked()
+            data = {
+                'version': INDEX_VERSION,
+                'files': dict(self._files),
+                'postings': {tri: sorted(ids) for tri, ids in self._postings.items()},
+                'next_id': self._next_id,
+            }
+            self._dirty = False
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        tmp = self.index_path + '.tmp'
+        with gzip.open(tmp, 'wt', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.index_path)
+
+    # -- maintenance -------------------------------------------------------
+
+    def set_roots(self, roots: Iterable[str]):
+        roots = [os.path.abspath(r) for r in roots]
+        with self._lock:
+            if roots == self.roots:
+                return
+            self.roots = roots
+        self.refresh()
+
+    def covers(self, path: str) -> bool:
+        path = os.path.abspath(path)
+        return any(path == r or path.startswith(r.rstrip(os.sep) + os.sep) for r in self.roots)
+
+    def _remove_locked(self, path: str):
+        # Postings are cleaned lazily: a removed file's ID can't match because
+        # candidates() only returns paths still in _files, and save() compacts
+        # once enough stale IDs pile up.
+        if self._files.pop(path, None) is not None:
+            self._stale_ids += 1
+            self._dirty = True
+
+    def update_path(self, path: str):
+        """(Re)index one file, or drop it if it no longer exists."""
+        path = os.path.abspath(path)
+        if not self.covers(path):
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            with self._lock:
+                self._remove_locked(path)
+            return
+        if not os.path.isfile(path):
+            return
+        indexed = st.st_size <= MAX_INDEX_FILE_SIZE
+        text = _read_text(path) if indexed else None
+        grams = _trigrams(text.lower()) if text is not None else set()
+        with self._lock:
+            self._remove_locked(path)
+            file_id = self._next_id
+            self._next_id += 1
+            # Binary files are recorded (so rescans skip them) but never match.
+            self._files[path] = [file_id, st.st_mtime, st.st_size, indexed and text is not None]
+            for tri in grams:
+                self._postings.setdefault(tri, set()).add(file_id)
+            self._dirty = True
+
+    def remove_path(self, path: str):
+        with self._lock:
+            self._remove_locked(os.path.abspath(path))
+
+    def refresh(self) -> int:
+        """Rescan the roots, re-indexing only changed files. Returns how many changed."""
+        seen = set()
+        changed = 0
+        for root in list(self.roots):
+            for path, st in _walk_files(root):
+                seen.add(path)
+                with self._lock:
+                    entry = self._files.get(path)
+                if entry and entry[1] == st.st_mtime and entry[2] == st.st_size:
+                    continue
+                self.update_path(path)
+                changed += 1
+        with self._lock:
+            for path in [p for p in self._files if p not in seen]:
+                self._remove_locked(path)
+                changed += 1
+            self.last_refresh = time.time()
+        return changed
+
+    # -- querying ----------------------------------------------------------
+
+    def candidates(self, pattern: str, regex: bool, under: Optional[str] = None) -> List[str]:
+        """Sorted files that may match: all literal trigrams present, or unindexed."""
+        required = set()
+        for literal in _required_literals(pattern, regex):
+            required |= _trigrams(literal)
+        with self._lock:
+            if required:
+                postings = [self._postings.get(tri, set()) for tri in required]
+                ids = set.intersection(*sorted(postings, key=len))
+            else:
+                ids = None
+            paths = [
+                p for p, (file_id, _, size, indexed) in self._files.items()
+                if (not indexed and size > MAX_INDEX_FILE_SIZE)
+                or (indexed and (ids is None or file_id in ids))
+            ]
+        if under:
+            prefix = os.path.abspath(under).rstrip(os.sep) + os.sep
+            paths = [p for p in paths if p.startswith(prefix)]
+        return sorted(paths)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'roots': list(self.roots),
+                'files': len(self._files),
+                'trigrams': len(self._postings),
+                'last_refresh': self.last_refresh,
+            }
+
+
+def _walk_files(root: str, limit: Optional[int] = None) -> Iterable[Tuple[str, os.stat_result]]:
+    """Yield ``(path, stat)`` for regular files under ``root`` (no symlinked dirs)."""
+    stack = [root]
+    count = 0
+    while stack:
+        directory = stack.pop()
+        try:
+            it = os.scandir(directory)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        yield entry.path, entry.stat()
+                        count += 1
+                        if limit and count >= limit:
+                            return
+                except OSError:
+                    continue
+
+
+def search(pattern: str, paths: List[str], regex: bool = False, case_sensitive: bool = False,
+           limit: int = 100, cursor: Optional[Tuple[str, int]] = None) -> dict:
+    """Confirm matches line by line in ``paths`` (sorted), resuming after ``cursor``.
+
+    ``cursor`` is ``(path, line_number)`` of the last match already returned.
+    """
+    flags = 0 if case_sensitive else re.IGNORECASE
+    matcher = re.compile(pattern if regex else re.escape(pattern), flags)
+    deadline = time.time() + SEARCH_TIME_BUDGET
+    matches = []
+    next_cursor = None
+    files_scanned = 0
+
+    start_index = 0
+    if cursor:
+        cursor_path, cursor_line = cursor
+        start_index = next((i for i, p in enumerate(paths) if p >= cursor_path), len(paths))
+
+    for i in range(start_index, len(paths)):
+        path = paths[i]
+        skip_through = cursor[1] if cursor and path == cursor[0] else 0
+        if time.time() > deadline:
+            next_cursor = (path, skip_through)
+            break
+        files_scanned += 1
+        try:
+            with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                for line_no, line in enumerate(f, 1):
+                    if line_no <= skip_through or not matcher.search(line):
+                        continue
+                    matches.append({
+                        'path': path,
+                        'line': line_no,
+                        'text': line.rstrip('\n')[:MAX_RESULT_LINE],
+                    })
+                    if len(matches) >= limit:
+                        next_cursor = (path, line_no)
+                        break
+        except OSError:
+            continue
+        if next_cursor:
+            break
+
+    return {
+        'matches': matches,
+        'files_scanned': files_scanned,
+        'next_cursor': next_cursor,
+    }
+
+
+def unindexed_candidates(root: str) -> List[str]:
+    """All text-file candidates under a root the index doesn't cover (bounded walk)."""
+    return sorted(path for path, _ in _walk_files(os.path.abspath(root), limit=MAX_UNINDEXED_FILES))
+
+
+class SearchIndexer(threading.Thread):
+    """Background thread that keeps a SearchIndex fresh.
+
+    Rescans on an interval and applies per-file notifications (from FileSyncer
+    and API writes) as they arrive. The index is saved after each rescan, at
+    most every ``SAVE_INTERVAL`` seconds for notifications, and on stop.
+    """
+
+    def __init__(self, index: SearchIndex, interval: float = 300.0):
+        super().__init__(daemon=True)
+        self.index = index
+        self.interval = interval
+        self.should_stop = False
+        self._pending: Set[str] = set()
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+
+    def notify(self, path: str):
+        with self._lock:
+            self._pending.add(os.path.abspath(path))
+        self._event.set()
+
+    def run(self):
+        next_refresh = 0.0
+        next_save = 0.0
+        while not self.should_stop:
+            try:
+                refreshed = False
+                if time.time() >= next_refresh:
+                    changed = self.index.refresh()
+                    if changed:
+                        print(f"Search index: {changed} file(s) updated.")
+                    next_refresh = time.time() + self.interval
+                    refreshed = True
+                with self._lock:
+                    pending, self._pending = self._pending, set()
+                for path in pending:
+                    self.index.update_path(path)
+                if refreshed or time.time() >= next_save:
+                    self.index.save()
+                    next_save = time.time() + SAVE_INTERVAL
+            except Exception as e:
+                print(f"Error in SearchIndexer: {type(e).__name__}: {e}")
+            wake_at = next_refresh if not self.index.dirty else min(next_refresh, next_save)
+            self._event.wait(max(1.0, wake_at - time.time()))
+            self._event.clear()
+        try:
+            self.index.save()
+        except Exception as e:
+            print(f"Error saving search index: {type(e).__name__}: {e}")
+
+    def stop(self):
+        self.should_stop = True
+        self._event.set()
@@ -0,0 +1,386 @@
+"""
+Persistent shell sessions.
+
+A normal command is a fresh ``/bin/sh`` in the agent directory, so ``cd``,
+exported variables and virtualenv activation are gone by the next command.
+A command with a ``session`` name instead runs inside a long-lived bash
+process kept per name, so state carries over and there is no shell startup
+per command.
+
+Each command is written to the session's stdin as a single ``eval`` of an
+ANSI-C quoted string, so a syntax error fails that command instead of
+leaving bash waiting for more input. The ``eval`` runs in a subshell with
+stdin from ``/dev/null``. The session runs with job control on (``set -m``),
+so that subshell is its own process group. Its first line of output reports
+the group ID. When it exits, an EXIT trap writes its cwd and exported
+variables to a state file, and the session's bash sources that file. After
+that, bash prints a sentinel line carrying a random per-command token and
+the exit status, on stdout and stderr. Reader threads route lines to the
+running command until both sentinels arrive.
+
+``SessionCommand`` looks enough like ``Popen`` (``pid``, ``stdout``, ``stderr``,
+``poll``, ``wait``) for CommandExecutor to drive it like any other process.
+Cancelling a session command signals its process group, which includes any
+background jobs it started; the session's bash survives. Only the cwd and
+environment carry over between commands; shell functions and unexported
+variables don't. rlimits / cgroups can't be applied to an already-running
+shell, so only the wall-clock limit applies to session commands.
+"""
+import os
+import queue
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+import psutil
+
+SESSION_IDLE_TIMEOUT = 30 * 60
+MAX_SESSIONS = 8
+REAP_INTERVAL = 60
+DEFAULT_GRACE = 5.0
+# After the shell exits, how long to let the readers drain before ending the
+# running command anyway (background jobs may hold the pipes open).
+EXIT_DRAIN_TIMEOUT = 2.0
+
+# Sourced once per session. __dpf_dump is the EXIT trap of each command's
+# subshell: it writes what the parent must pick up, including unsetting
+# variables the command unexported.
+_SESSION_SETUP = r'''set -m
+__dpf_dump() {
+    {
+        builtin export -p
+        __dpf_env1=$'\n'"$(builtin compgen -e)"$'\n'
+        for __dpf_v in $__dpf_env0; do
+            [[ $__dpf_env1 == *$'\n'"$__dpf_v"$'\n'* ]] || builtin printf 'builtin unset -v %s\n' "$__dpf_v"
+        done
+        builtin printf 'builtin cd -- %q\n' "$PWD"
+    } >"$__dpf_state" 2>/dev/null
+}
+'''
+
+
+def _ansi_c_quote(text: str) -> str:
+    """Quote ``text`` as a bash ``$'...'`` string (safe for any content)."""
+    out = []
+    for ch in text:
+        if ch == '\\':
+            out.append('\\\\')
+        elif ch == "'":
+            out.append("\\'")
+        elif ch == '\n':
+            out.append('\\n')
+        elif ord(ch) < 0x20 or ord(ch) == 0x7f:
+            out.append('\\x%02x' % ord(ch))
+        else:
+            out.append(ch)
+    return "$'" + ''.join(out) + "'"
+
+
+def _group_alive(pgid: int) -> bool:
+    try:
+        os.killpg(pgid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class _LineStream:
+    """File-like end of a session stream for one command: ``readline()`` until the sentinel."""
+
+    def __init__(self):
+        self._lines = queue.Queue()
+
+    def put(self, line: str):
+        self._lines.put(line)
+
+    def end(self):
+        self._lines.put('')
+
+    def readline(self) -> str:
+        return self._lines.get()
+
+    def close(self):
+        pass
+
+
+class SessionCommand:
+    """``Popen``-like handle for one command running in a ShellSession."""
+
+    def __init__(self, session: 'ShellSession', token: str):
+        self.session = session
+        self.token = token
+        self.pid = session.process.pid
+        self.stdout = _LineStream()
+        self.stderr = _LineStream()
+        self.returncode = None
+        self._exit_status = None
+        self._stdout_done = False
+        self._stderr_done = False
+        self._done = threading.Event()
+        self.pgid = None  # The command subshell's process group, once reported
+        self._started = threading.Event()
+
+    def _set_pgid(self, pgid: int):
+        self.pgid = pgid
+        self._started.set()
+
+    def _finish_stream(self, name: str, status: Optional[int] = None):
+        if name == 'stdout' and not self._stdout_done:
+            self._stdout_done = True
+            self._exit_status = status
+            self.stdout.end()
+        elif name == 'stderr' and not self._stderr_done:
+            self._stderr_done = True
+            self.stderr.end()
+        if self._stdout_done and self._stderr_done and not self._done.is_set():
+            self.returncode = self._exit_status if self._exit_status is not None else -1
+            self._done.set()
+            self.session._command_done(self)
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise subprocess.TimeoutExpired(f"session command {self.token}", timeout)
+        return self.returncode
+
+    def interrupt(self, grace: float = DEFAULT_GRACE):
+        """Terminate this command's process group, leaving the shell itself alive."""
+        if self._started.wait(grace) and self.pgid:
+            for sig in (signal.SIGTERM, signal.SIGKILL):
+                try:
+                    os.killpg(self.pgid, sig)
+                except ProcessLookupError:
+                    break
+                deadline = time.time() + grace
+                while time.time() < deadline and _group_alive(self.pgid):
+                    time.sleep(0.1)
+        # Still not back at the prompt (or the subshell never started): the
+        # only way out is ending the shell.
+        if not self._done.wait(grace):
+            self.session.close()
+
+
+class ShellSession:
+    """One long-lived bash process running commands one at a time."""
+
+    def __init__(self, name: str, cwd: str, env: Dict[str, str]):
+        bash = shutil.which('bash')
+        if not bash:
+            raise RuntimeError("Persistent sessions need bash")
+        self.name = name
+        self.process = subprocess.Popen(
+            [bash, '--noprofile', '--norc'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            cwd=cwd,
+            env=env,
+            bufsize=1,
+            start_new_session=True,
+        )
+        self.created_at = time.time()
+        self.last_used = time.time()
+        self.commands_run = 0
+        self.current: Optional[SessionCommand] = None
+        self._busy = threading.Lock()  # Held while a command is running
+        fd, self.state_path = tempfile.mkstemp(prefix='dpf-session-')
+        os.close(fd)
+        self._eof = {'stdout': threading.Event(), 'stderr': threading.Event()}
+        for name_, stream in (('stdout', self.process.stdout), ('stderr', self.process.stderr)):
+            # Untranslated, for the executor's output compaction; its
+            # OutputNormalizer turns '\r\n' / '\r' into '\n' when compaction is off.
+            stream.reconfigure(newline='')
+            threading.Thread(target=self._read, args=(name_, stream), daemon=True).start()
+        threading.Thread(target=self._watch_exit, daemon=True).start()
+        self.process.stdin.write(f"__dpf_state={_ansi_c_quote(self.state_path)}\n{_SESSION_SETUP}")
+        self.process.stdin.flush()
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def run(self, command: str, should_stop=None) -> SessionCommand:
+        """Start ``command`` once the session is free. Raises if the session dies or ``should_stop``."""
+        while not self._busy.acquire(timeout=0.5):
+            if should_stop and should_stop():
+                raise RuntimeError("Cancelled while waiting for the session")
+            if not self.alive():
+                raise RuntimeError(f"Session {self.name} has exited")
+        if not self.alive():
+            self._busy.release()
+            raise RuntimeError(f"Session {self.name} has exited")
+        token = uuid.uuid4().hex
+        cmd = SessionCommand(self, token)
+        self.current = cmd
+        script = (
+            f": >\"$__dpf_state\"; "
+            f"( printf '%s%d__\\n' '__DPF_PGID_{token}_' \"$BASHPID\"; "
+            f"__dpf_env0=$(compgen -e); trap __dpf_dump EXIT; "
+            f"eval {_ansi_c_quote(command)} ) </dev/null; __dpf_rc=$?; "
+            f"[[ -s $__dpf_state ]] && . \"$__dpf_state\"; "
+            f"printf '%s%d__\\n' '__DPF_DONE_{token}_' \"$__dpf_rc\"; "
+            f"printf '%s\\n' '__DPF_DONE_{token}__' >&2\n"
+        )
+        try:
+            self.process.stdin.write(script)
+            self.process.stdin.flush()
+        except (OSError, ValueError):
+            self.current = None
+            self._busy.release()
+            raise RuntimeError(f"Session {self.name} has exited")
+        self.last_used = time.time()
+        self.commands_run += 1
+        return cmd
+
+    def _command_done(self, cmd: SessionCommand):
+        if self.current is cmd:
+            self.current = None
+            self.last_used = time.time()
+            self._busy.release()
+
+    def _read(self, name: str, stream):
+        try:
+            for line in iter(stream.readline, ''):
+                cmd = self.current
+                if cmd is None:
+                    continue  # Background job output between commands
+                if name == 'stdout' and cmd.pgid is None:
+                    started = f"__DPF_PGID_{cmd.token}_"
+                    if line.startswith(started):
+                        try:
+                            cmd._set_pgid(int(line[len(started):].strip().rstrip('_')))
+                        except ValueError:
+                            pass
+                        continue
+                marker = f"__DPF_DONE_{cmd.token}_" if name == 'stdout' else f"__DPF_DONE_{cmd.token}__"
+                if marker not in line:
+                    (cmd.stdout if name == 'stdout' else cmd.stderr).put(line)
+                    continue
+                before, _, rest = line.partition(marker)
+                if before:
+                    (cmd.stdout if name == 'stdout' else cmd.stderr).put(before)
+                status = None
+                if name == 'stdout':
+                    try:
+                        status = int(rest.strip().rstrip('_'))
+                    except ValueError:
+                        status = -1
+                cmd._finish_stream(name, status)
+        except (OSError, ValueError):
+            pass
+        self._eof[name].set()
+
+    def _watch_exit(self):
+        """End the running command once the shell itself has exited.
+
+        Waits on the process, not the pipes: background jobs keep those open
+        after the shell is gone.
+        """
+        status = self.process.wait()
+        deadline = time.time() + EXIT_DRAIN_TIMEOUT
+        for event in self._eof.values():
+            event.wait(max(0.0, deadline - time.time()))
+        cmd = self.current
+        if cmd is not None:
+            cmd._finish_stream('stdout', status)
+            cmd._finish_stream('stderr')
+        try:
+            os.unlink(self.state_path)
+        except OSError:
+            pass
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            os.killpg(self.process.pid, 9)
+        except OSError:
+            pass
+
+    def info(self) -> dict:
+        try:
+            cwd = psutil.Process(self.process.pid).cwd()
+        except psutil.Error:
+            cwd = None
+        return {
+            'name': self.name,
+            'pid': self.process.pid,
+            'cwd': cwd,
+            'busy': self.current is not None,
+            'alive': self.alive(),
+            'commands_run': self.commands_run,
+            'created_at': self.created_at,
+            'idle_seconds': round(time.time() - self.last_used, 1) if self.current is None else 0,
+        }
+
+
+class SessionManager:
+    """Named ShellSessions, created on first use and closed when idle. Thread-safe."""
+
+    def __init__(self, idle_timeout: float = SESSION_IDLE_TIMEOUT, max_sessions: int = MAX_SESSIONS):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self._sessions: Dict[str, ShellSession] = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def run(self, name: str, command: str, cwd: str, env: Dict[str, str], should_stop=None) -> SessionCommand:
+        with self._lock:
+            session = self._sessions.get(name)
+            if session is None or not session.alive():
+                live = [s for s in self._sessions.values() if s.alive()]
+                if len(live) >= self.max_sessions:
+                    raise RuntimeError(f"Too many sessions (max {self.max_sessions}); close one first")
+                session = self._sessions[name] = ShellSession(name, cwd, env)
+                print(f"Started shell session '{name}' (pid {session.process.pid})")
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap_loop, daemon=True)
+                self._reaper.start()
+        return session.run(command, should_stop)
+
+    def list(self) -> List[dict]:
+        with self._lock:
+            return [s.info() for s in self._sessions.values()]
+
+    def close(self, name: str) -> bool:
+        with self._lock:
+            session = self._sessions.pop(name, None)
+        if session is None:
+            return False
+        session.close()
+        return True
+
+    def close_all(self):
+        with self._lock:
+            sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            session.close()
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(REAP_INTERVAL)
+            now = time.time()
+            with self._lock:
+                stale = [
+                    name for name, s in self._sessions.items()
+                    if not s.alive() or (s.current is None and now - s.last_used > self.idle_timeout)
+                ]
+                closing = [self._sessions.pop(name) for name in stale]
+            for session in closing:
+                print(f"Closing idle shell session '{session.name}'")
+                session.close()
+
+
+# Shared by the executor (main.py) and the local API.
+manager = SessionManager()
@@ -21,7 +21,7 @@ import ConsoleToolbar from "./ConsoleToolbar";
 import ActiveCommandCard from "./ActiveCommandCard";
 import HistoryCommandItem from "./HistoryCommandItem";
 import CommandInput from "./CommandInput";
-import { CommandLog } from "../../types/command";
+import { CommandLog, OutputCursor } from "../../types/command";
 import { ErrorIcon, CloseIcon, TerminalIcon, TrashIcon } from "../Icons";
 import { PulsingDot, useToast } from "../ui";
 import {
@@ -40,6 +40,22 @@ import { getLastLines } from "../../utils";
 // Prefix for optimistic command IDs to distinguish them from real Firestore IDs
 const OPTIMISTIC_ID_PREFIX = "__optimistic__";
 
+// Cap on output accumulated from incremental deltas per active command
+const MAX_ACCUMULATED_OUTPUT_CHARS = 200000;
+
+// Output stitched together from the agent's incremental output_delta answers
+interface AccumulatedOutput {
+  cursor: OutputCursor | null;
+  output: string;
+  error: string;
+  requestId: string | null;
+}
+
+const appendCapped = (current: string, delta: string) => {
+  const next = current + delta;
+  return next.length > MAX_ACCUMULATED_OUTPUT_CHARS ? next.slice(-MAX_ACCUMULATED_OUTPUT_CHARS) : next;
+};
+
 interface ConsoleViewProps {
   deviceId: string;
   user: User;
@@ -57,6 +73,10 @@ export default function ConsoleView({ deviceId, user, platform }: ConsoleViewPro
   
   // Track pending optimistic command texts to match against server responses
   const pendingCommandsRef = useRef<Map<string, string>>(new Map());
+
+  // Per active command: cursor + output built from incremental deltas, so each
+  // output request only transfers what is new since the last one
+  const accumulatedOutputRef = useRef<Map<string, AccumulatedOutput>>(new Map());
   
   // Merge server logs with optimistic commands, removing optimistic ones that have been confirmed
   const logs = useMemo(() => {
@@ -89,10 +109,28 @@ export default function ConsoleView({ deviceId, user, platform }: ConsoleViewPro
       const q = query(commandsRef, orderBy("created_at", "desc"), limit(CONSOLE_HISTORY_LIMIT));
       const snapshot = await getDocs(q);
       
-      const newLogs: CommandLog[] = snapshot.docs.map(d => ({
-        id: d.id,
-        ...d.data()
-      } as CommandLog));
+      const accumulated = accumulatedOutputRef.current;
+      const newLogs: CommandLog[] = snapshot.docs.map(d => {
+        const log = { id: d.id, ...d.data() } as CommandLog;
+        if (!ACTIVE_COMMAND_STATUSES.includes(log.status)) {
+          // Finished commands carry their final output; drop the running state
+          accumulated.delete(log.id);
+          return log;
+        }
+        const state = accumulated.get(log.id);
+        const delta = log.output_delta;
+        // Only apply the answer to our latest request, and only once
+        if (state && delta && delta.request_id === state.requestId) {
+          state.requestId = null;
+          state.output = appendCapped(state.output, delta.stdout || "");
+          state.error = appendCapped(state.error, delta.stderr || "");
+          state.cursor = delta.cursor;
+        }
+        if (state && (state.output || state.error)) {
+          return { ...log, output: state.output || log.output, error: state.error || log.error };
+        }
+        return log;
+      });
       
       setServerLogs(newLogs);
       
@@ -113,14 +151,19 @@ export default function ConsoleView({ deviceId, user, platform }: ConsoleViewPro
         const activeLogs = newLogs.filter(log => ACTIVE_COMMAND_STATUSES.includes(log.status));
         if (activeLogs.length > 0) {
           // Fire and forget - don't await, agent will update and we'll see it on next fetch
-          Promise.all(activeLogs.map(log => 
-            updateDoc(doc(db, ...getCommandDocumentPath(deviceId, log.id)), {
+          Promise.all(activeLogs.map(log => {
+            const state = accumulated.get(log.id) ?? { cursor: null, output: "", error: "", requestId: null };
+            state.requestId = `${Date.now()}-${Math.random()}`;
+            accumulated.set(log.id, state);
+            return updateDoc(doc(db, ...getCommandDocumentPath(deviceId, log.id)), {
               output_request: {
                 seconds: CONSOLE_OUTPUT_REQUEST_TIMEOUT_SECONDS,
-                request_id: `${Date.now()}-${Math.random()}`
+                request_id: state.requestId,
+                // Agent returns only output after this cursor (null = last N seconds)
+                since: state.cursor
               }
-            }).catch(() => {})
-          ));
+            }).catch(() => {});
+          }));
         }
       }
     } catch (error) {
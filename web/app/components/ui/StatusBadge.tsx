@@ -17,6 +17,11 @@ const statusStyles: Record<string, { bg: string; text: string; dotColor: "accent
     text: "text-yellow-400",
     dotColor: "warning",
   },
+  queued: {
+    bg: "bg-yellow-500/10",
+    text: "text-yellow-400",
+    dotColor: "warning",
+  },
   processing: {
     bg: "bg-terminal-accent/10",
     text: "text-terminal-accent",
@@ -32,6 +37,11 @@ const statusStyles: Record<string, { bg: string; text: string; dotColor: "accent
     text: "text-terminal-error",
     dotColor: "error",
   },
+  skipped: {
+    bg: "bg-yellow-500/10",
+    text: "text-yellow-400",
+    dotColor: "warning",
+  },
 };
 
 const sizeClasses = {
@@ -49,7 +59,7 @@ export const StatusBadge = memo(function StatusBadge({
   className = "",
 }: StatusBadgeProps) {
   const style = statusStyles[status] || statusStyles.pending;
-  const isActive = status === "pending" || status === "processing";
+  const isActive = status === "pending" || status === "queued" || status === "processing";
 
   return (
     <span
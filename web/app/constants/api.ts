@@ -3,12 +3,18 @@ import type { ApiEndpoint } from "../types";
 export const API_ENDPOINTS: ApiEndpoint[] = [
   { path: "/status", method: "GET", description: "Get full system status including hardware stats and git info" },
   { path: "/health", method: "GET", description: "Simple health check endpoint" },
-  { path: "/exec", method: "POST", description: "Execute a shell command", defaultBody: '{\n  "command": "ls -la",\n  "cwd": "."\n}' },
-  { path: "/files/list", method: "GET", description: "List files in a directory (use ?path=/path/to/dir in real request, here defaults to current)" },
-  { path: "/files/read", method: "POST", description: "Read a file content", defaultBody: '{\n  "path": "README.md"\n}' },
-  { path: "/files/write", method: "POST", description: "Write content to a file", defaultBody: '{\n  "path": "test.txt",\n  "content": "Hello world!"\n}' },
-  { path: "/processes", method: "GET", description: "List running processes" },
+  { path: "/exec", method: "POST", description: "Execute a shell command (bounded by timeout seconds and max_output bytes; stream: true returns NDJSON)", defaultBody: '{\n  "command": "ls -la",\n  "cwd": ".",\n  "timeout": 30\n}' },
+  { path: "/files/list", method: "GET", description: "List files in a directory (use ?path=/path/to/dir in real request, here defaults to current; supports limit/cursor, sort, order, glob, type, min_size, modified_since, recursive)" },
+  { path: "/files/read", method: "POST", description: "Read a file content (optional offset/length byte range, tail_lines, or encoding: base64 for binary)", defaultBody: '{\n  "path": "README.md"\n}' },
+  { path: "/files/raw", method: "GET", description: "Stream raw file bytes with HTTP Range support (use ?path=/path/to/file, optional &gzip=true)" },
+  { path: "/files/write", method: "POST", description: "Write content to a file (atomically: temp file, fsync, rename)", defaultBody: '{\n  "path": "test.txt",\n  "content": "Hello world!"\n}' },
+  { path: "/files/upload", method: "PUT", description: "Stream a raw request body to a file atomically (use ?path=/path/to/file, optional &sha256=...)" },
+  { path: "/files/uploads", method: "POST", description: "Start a resumable upload; append chunks with PUT /files/uploads/{id}?offset=N, then POST /files/uploads/{id}/complete", defaultBody: '{\n  "path": "big.bin",\n  "size": 1048576\n}' },
+  { path: "/files/search", method: "GET", description: "Search file contents (use ?q=text; optional &regex=true, &case_sensitive=true, &path=dir, &limit, &cursor). The shared folder is indexed" },
+  { path: "/processes", method: "GET", description: "List running processes from a cached table with measured CPU% (optional user=all, name, status, min_cpu, min_memory_mb, sort, order, limit, offset, tree=true, root_pid)" },
   { path: "/processes/{pid}", method: "DELETE", description: "Kill a process (replace {pid} in path - not supported in this UI yet, requires manual implementation)" },
+  { path: "/sessions", method: "GET", description: "List persistent shell sessions (commands sent with a 'session' name) with their cwd and state" },
+  { path: "/sessions/{name}", method: "DELETE", description: "Close a shell session (replace {name} in path); its next command starts a fresh shell" },
 ];
 
 export const API_COMMAND_TYPE = "api" as const;
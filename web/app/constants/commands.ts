@@ -2,24 +2,39 @@
 export const COMMAND_TYPE_SHELL = "shell" as const;
 export const COMMAND_TYPE_API = "api" as const;
 export const COMMAND_TYPE_RESTART = "restart" as const;
+// Python script (script/args or inline code) forked from the agent's warm interpreter
+export const COMMAND_TYPE_PYTHON = "python" as const;
+// DAG of shell steps ('steps' with needs / timeout / on_failure) run in parallel where possible
+export const COMMAND_TYPE_PIPELINE = "pipeline" as const;
 
-export type CommandType = typeof COMMAND_TYPE_SHELL | typeof COMMAND_TYPE_API | typeof COMMAND_TYPE_RESTART;
+export type CommandType =
+  | typeof COMMAND_TYPE_SHELL
+  | typeof COMMAND_TYPE_API
+  | typeof COMMAND_TYPE_RESTART
+  | typeof COMMAND_TYPE_PYTHON
+  | typeof COMMAND_TYPE_PIPELINE;
 
 // Command statuses
 export const COMMAND_STATUS_PENDING = "pending" as const;
+export const COMMAND_STATUS_QUEUED = "queued" as const;
 export const COMMAND_STATUS_PROCESSING = "processing" as const;
 export const COMMAND_STATUS_COMPLETED = "completed" as const;
 export const COMMAND_STATUS_CANCELLED = "cancelled" as const;
+// Scheduled run not started because the previous one was still going
+export const COMMAND_STATUS_SKIPPED = "skipped" as const;
 
 export type CommandStatus = 
   | typeof COMMAND_STATUS_PENDING
+  | typeof COMMAND_STATUS_QUEUED
   | typeof COMMAND_STATUS_PROCESSING
   | typeof COMMAND_STATUS_COMPLETED
-  | typeof COMMAND_STATUS_CANCELLED;
+  | typeof COMMAND_STATUS_CANCELLED
+  | typeof COMMAND_STATUS_SKIPPED;
 
 // Active statuses (commands that are still running)
 export const ACTIVE_COMMAND_STATUSES: CommandStatus[] = [
   COMMAND_STATUS_PENDING,
+  COMMAND_STATUS_QUEUED,
   COMMAND_STATUS_PROCESSING,
 ];
 
@@ -27,4 +42,5 @@ export const ACTIVE_COMMAND_STATUSES: CommandStatus[] = [
 export const COMPLETED_COMMAND_STATUSES: CommandStatus[] = [
   COMMAND_STATUS_COMPLETED,
   COMMAND_STATUS_CANCELLED,
+  COMMAND_STATUS_SKIPPED,
 ];
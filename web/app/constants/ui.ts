@@ -6,3 +6,7 @@ export const RELATIVE_TIME_UPDATE_INTERVAL_MS = 10000; // 10 seconds
 
 // Device connection timeout (milliseconds)
 export const DEVICE_CONNECTION_TIMEOUT_MS = 5 * 60 * 1000; // 5 minutes
+
+// How often an open console refreshes the device's viewer_active timestamp.
+// The agent ignores a timestamp older than 10 minutes (VIEWER_PRESENCE_TTL).
+export const VIEWER_PRESENCE_REFRESH_MS = 4 * 60 * 1000; // 4 minutes
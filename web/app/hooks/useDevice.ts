@@ -8,9 +8,15 @@ import {
   serverTimestamp,
   doc,
   onSnapshot,
+  updateDoc,
 } from "firebase/firestore";
 import type { Device } from "../types";
-import { COMMAND_TYPE_SHELL, COMMAND_TYPE_RESTART, COMMAND_STATUS_PENDING } from "../constants";
+import {
+  COMMAND_TYPE_SHELL,
+  COMMAND_TYPE_RESTART,
+  COMMAND_STATUS_PENDING,
+  VIEWER_PRESENCE_REFRESH_MS,
+} from "../constants";
 import { useToast } from "../components/ui";
 
 interface UseDeviceReturn {
@@ -51,6 +57,34 @@ export function useDevice(): UseDeviceReturn {
     return () => unsub();
   }, [selectedDeviceId]);
 
+  // Tell the agent someone is watching, so it stays in its responsive tier.
+  // A timestamp rather than a flag: a tab that closes without cleaning up
+  // simply stops refreshing it and the agent lets it expire.
+  useEffect(() => {
+    if (!selectedDeviceId) return;
+    const deviceRef = doc(db, "devices", selectedDeviceId);
+    const setPresence = (present: boolean) => {
+      updateDoc(deviceRef, { viewer_active: present ? serverTimestamp() : false }).catch((error) => {
+        console.error("Error updating viewer presence:", error);
+      });
+    };
+    const refresh = () => {
+      if (document.visibilityState === "visible") setPresence(true);
+    };
+    const handleVisibilityChange = () => {
+      setPresence(document.visibilityState === "visible");
+    };
+
+    refresh();
+    const interval = setInterval(refresh, VIEWER_PRESENCE_REFRESH_MS);
+    document.addEventListener("visibilitychange", handleVisibilityChange);
+    return () => {
+      clearInterval(interval);
+      document.removeEventListener("visibilitychange", handleVisibilityChange);
+      setPresence(false);
+    };
+  }, [selectedDeviceId]);
+
   const handleDeviceSelect = useCallback((id: string) => {
     setSelectedDeviceId(id);
     localStorage.setItem("selectedDeviceId", id);
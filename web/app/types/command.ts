@@ -6,10 +6,72 @@ export interface CommandLog {
   command: string;
   output?: string;
   error?: string;
+  // Set when output overflowed the doc: output/error then hold a head + tail preview
+  output_ref?: OutputRef;
+  error_ref?: OutputRef;
   status: CommandStatus;
   created_at: Timestamp | null;
   completed_at?: Timestamp | null;
   last_activity?: Timestamp | null;
   output_lines?: number;
   error_lines?: number;
+  // Progress-bar redraws / repeated lines folded away by the agent
+  compacted_lines?: number;
+  output_query?: OutputQueryResult;
+  output_delta?: OutputDelta;
+  priority?: number;
+  queue_position?: number;
+  // Run in this named persistent shell (cwd / env carry over between commands)
+  session?: string;
+  // Name of the device 'schedules' entry that ran this (uploaded after the fact)
+  scheduled?: string;
+  // Per-step state of a 'pipeline' command, in step order
+  steps?: PipelineStepStatus[];
+}
+
+export interface PipelineStepStatus {
+  name: string;
+  status: "pending" | "running" | "succeeded" | "failed" | "timed_out" | "skipped" | "cancelled";
+  return_code?: number;
+  duration?: number;
+  cpu_seconds?: number;
+  peak_rss_bytes?: number;
+}
+
+export interface OutputQueryMatch {
+  stream: "stdout" | "stderr";
+  line: number;
+  timestamp: number;
+  text: string;
+  before: string[];
+  after: string[];
+}
+
+export interface OutputQueryResult {
+  request_id: string;
+  matches?: OutputQueryMatch[];
+  total_matches?: number;
+  truncated?: boolean;
+  error?: string;
+}
+
+export interface OutputCursor {
+  stdout: number;
+  stderr: number;
+}
+
+export interface OutputDelta {
+  request_id: string;
+  since: OutputCursor | null;
+  stdout: string;
+  stderr: string;
+  cursor: OutputCursor;
+  gap: boolean;
+  more: boolean;
+}
+
+export interface OutputRef {
+  path: string;
+  lines: number;
+  compressed_bytes: number;
 }
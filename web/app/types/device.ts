@@ -44,5 +44,6 @@ export interface Device {
   max_output_chars?: number;
   allowed_emails?: string[];
   startup_file?: string | null;
+  viewer_active?: Timestamp | boolean | null;
 }
 